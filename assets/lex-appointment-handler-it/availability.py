@@ -0,0 +1,170 @@
+"""
+Availability engine.
+
+Works on slot indices instead of "HH:MM" strings: a day's availability is a bitmask in
+which bit i is set when the slot starting at opening time + i * slot minutes is free.
+Business hours and slot granularity are configurable through BUSINESS_HOURS
+(e.g. "10:00-17:00") and SLOT_MINUTES.
+"""
+
+import os
+
+BUSINESS_HOURS = os.environ.get("BUSINESS_HOURS", "10:00-17:00")
+SLOT_MINUTES = int(os.environ.get("SLOT_MINUTES", "30"))
+
+MINUTES_PER_DAY = 24 * 60
+
+_default_engine = None
+
+
+def parse_minutes(value):
+    """
+    Minutes since midnight of a "HH:MM" string, or None if it is not a valid time.
+    """
+    try:
+        hour, minute = value.split(":")
+        hour, minute = int(hour), int(minute)
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        return None
+    return hour * 60 + minute
+
+
+def format_minutes(minutes):
+    return "{}:{:02d}".format(minutes // 60, minutes % 60)
+
+
+class AvailabilityEngine:
+    def __init__(self, opening_minute=600, closing_minute=1020, slot_minutes=30):
+        if slot_minutes <= 0 or closing_minute <= opening_minute:
+            raise ValueError(
+                "Invalid business hours {}-{} with {} minute slots".format(
+                    format_minutes(opening_minute),
+                    format_minutes(closing_minute),
+                    slot_minutes,
+                )
+            )
+        self.opening_minute = opening_minute
+        self.closing_minute = closing_minute
+        self.slot_minutes = slot_minutes
+        self.slot_count = (closing_minute - opening_minute) // slot_minutes
+        self.full_day_mask = (1 << self.slot_count) - 1
+
+    @classmethod
+    def from_business_hours(cls, business_hours, slot_minutes=30):
+        opening, _, closing = business_hours.partition("-")
+        opening_minute = parse_minutes(opening.strip())
+        closing_minute = parse_minutes(closing.strip())
+        if opening_minute is None or closing_minute is None:
+            raise ValueError("Invalid business hours {}".format(business_hours))
+        return cls(opening_minute, closing_minute, slot_minutes)
+
+    def time_to_slot(self, appointment_time):
+        """
+        Slot index of a "HH:MM" time, or None if it is not a slot start within business hours.
+        """
+        return self.minute_to_slot(parse_minutes(appointment_time))
+
+    def minute_to_slot(self, minutes):
+        if minutes is None or minutes < self.opening_minute:
+            return None
+        slot, offset = divmod(minutes - self.opening_minute, self.slot_minutes)
+        if offset or slot >= self.slot_count:
+            return None
+        return slot
+
+    def slot_to_time(self, slot):
+        return format_minutes(self.opening_minute + slot * self.slot_minutes)
+
+    def is_within_business_hours(self, appointment_time):
+        return self.is_open_at_minute(parse_minutes(appointment_time))
+
+    def is_open_at_minute(self, minutes):
+        return minutes is not None and (
+            self.opening_minute <= minutes < self.closing_minute
+        )
+
+    def mask_from_times(self, times):
+        mask = 0
+        for appointment_time in times:
+            slot = self.time_to_slot(appointment_time)
+            if slot is not None:
+                mask |= 1 << slot
+        return mask
+
+    def times_from_mask(self, mask):
+        times = []
+        slot = 0
+        while mask:
+            if mask & 1:
+                times.append(self.slot_to_time(slot))
+            mask >>= 1
+            slot += 1
+        return times
+
+    def duration_slots(self, duration):
+        """
+        Number of consecutive slots an appointment of the given duration (in minutes) occupies.
+        """
+        return max(1, -(-duration // self.slot_minutes))
+
+    def duration_mask(self, appointment_time, duration):
+        """
+        Mask of the slots covered by an appointment, or None if it does not fit in the day.
+        """
+        slot = self.time_to_slot(appointment_time)
+        slots = self.duration_slots(duration)
+        if slot is None or slot + slots > self.slot_count:
+            return None
+        return ((1 << slots) - 1) << slot
+
+    def is_available(self, mask, appointment_time, duration):
+        needed = self.duration_mask(appointment_time, duration)
+        return needed is not None and mask & needed == needed
+
+    def start_mask(self, mask, duration):
+        """
+        Mask of the slots at which an appointment of the given duration can start.
+        """
+        mask &= self.full_day_mask
+        starts = mask
+        for shift in range(1, self.duration_slots(duration)):
+            starts &= mask >> shift
+        return starts
+
+    def start_times(self, mask, duration):
+        return self.times_from_mask(self.start_mask(mask, duration))
+
+    def start_times_for_dates(self, masks_by_date, duration):
+        """
+        All start times for the given duration on several dates in one pass.
+        The day masks are packed into one integer with a zero guard bit between days, so the
+        shift-and runs over every date at once without letting an appointment span two days.
+        """
+        dates = list(masks_by_date)
+        stride = self.slot_count + 1
+        packed = 0
+        for index, date in enumerate(dates):
+            packed |= (masks_by_date[date] & self.full_day_mask) << (index * stride)
+
+        starts = packed
+        for shift in range(1, self.duration_slots(duration)):
+            starts &= packed >> shift
+
+        return {
+            date: self.times_from_mask(starts >> (index * stride) & self.full_day_mask)
+            for index, date in enumerate(dates)
+        }
+
+
+def get_engine():
+    """
+    Returns the availability engine configured from BUSINESS_HOURS and SLOT_MINUTES.
+    """
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = AvailabilityEngine.from_business_hours(
+            BUSINESS_HOURS, SLOT_MINUTES
+        )
+    return _default_engine
@@ -0,0 +1,114 @@
+"""
+Compact encoding of the bookingMap session attribute.
+
+Each date's availability is stored as the availability engine's slot bitmask, prefixed
+with the slot layout it was written with, e.g. "v2@600/30;2020-10-21=c001;2020-10-23=3"
+(slots start at minute 600 of the day and are 30 minutes long). Dates in the past are
+dropped and only the most recently used dates are kept, so the attribute stays small.
+
+Older layouts are still decoded for sessions that are already in flight: the legacy
+JSON dict ({"2020-10-21": ["10:00", ...]}) and "v1" half-hour masks starting at 10:00.
+"""
+
+import collections
+import datetime
+import json
+import os
+
+import availability
+
+BOOKING_MAP_MAX_DATES = int(os.environ.get("BOOKING_MAP_MAX_DATES", "5"))
+
+VERSION_PREFIX = "v2"
+V1_LAYOUT = (600, 30)
+
+
+class BookingMap:
+    """
+    Availability masks by date, ordered from least to most recently used.
+    """
+
+    def __init__(self, days=None, engine=None):
+        self.engine = engine or availability.get_engine()
+        self.days = collections.OrderedDict(days or ())
+
+    def __contains__(self, date):
+        return date in self.days
+
+    def __len__(self):
+        return len(self.days)
+
+    def get(self, date):
+        mask = self.days.get(date)
+        if mask is not None:
+            self.days.move_to_end(date)
+        return mask
+
+    def set(self, date, mask):
+        self.days[date] = mask
+        self.days.move_to_end(date)
+
+    def encode(self, today=None, max_dates=BOOKING_MAP_MAX_DATES):
+        today = (today or datetime.date.today()).isoformat()
+        # ISO dates compare chronologically as strings
+        days = [
+            (date, mask)
+            for date, mask in self.days.items()
+            if not _is_iso_date(date) or date >= today
+        ]
+        days = days[len(days) - max_dates :] if max_dates else []
+        self.days = collections.OrderedDict(days)
+
+        header = "{}@{}/{}".format(
+            VERSION_PREFIX, self.engine.opening_minute, self.engine.slot_minutes
+        )
+        return ";".join(
+            [header] + ["{}={:x}".format(date, mask) for date, mask in days]
+        )
+
+    @classmethod
+    def decode(cls, value, engine=None):
+        booking_map = cls(engine=engine)
+        engine = booking_map.engine
+        if not value:
+            return booking_map
+
+        if value.startswith("{"):
+            for date, times in json.loads(value).items():
+                booking_map.days[date] = engine.mask_from_times(times or ())
+            return booking_map
+
+        header, _, payload = value.partition(";")
+        version, _, layout = header.partition("@")
+        if version == "v1":
+            layout = V1_LAYOUT
+        elif version == VERSION_PREFIX:
+            opening_minute, _, slot_minutes = layout.partition("/")
+            layout = (int(opening_minute), int(slot_minutes))
+        else:
+            return booking_map
+
+        for item in payload.split(";") if payload else ():
+            date, _, mask = item.rpartition("=")
+            booking_map.days[date] = _convert_mask(int(mask, 16), layout, engine)
+        return booking_map
+
+
+def _convert_mask(mask, layout, engine):
+    """
+    Re-map a mask written with another slot layout onto the engine's layout.
+    """
+    if layout == (engine.opening_minute, engine.slot_minutes):
+        return mask
+    source = availability.AvailabilityEngine(
+        layout[0], availability.MINUTES_PER_DAY, layout[1]
+    )
+    return engine.mask_from_times(source.times_from_mask(mask))
+
+
+def _is_iso_date(date):
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+        return True
+    except ValueError:
+        return False
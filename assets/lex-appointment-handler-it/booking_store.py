@@ -0,0 +1,242 @@
+"""
+Shared appointment booking store.
+
+Bookings are recorded as one claim per (date, slot start time). A booking is an atomic
+conditional write: every slot of the appointment is claimed only if it is still free
+(or already held by the same owner, so retried requests are idempotent), otherwise
+nothing is written. Booked slots are read per day, for several days in one call.
+
+BOOKING_STORE selects the implementation:
+    sqlite:<path>        local SQLite file (default sqlite:/tmp/bookings.db), for local
+                         runs and the tools
+    dynamodb:<table>     DynamoDB table with "date" (hash) and "time" (range) string keys,
+                         what the CloudFormation template deploys
+"""
+
+import abc
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import availability
+import aws_clients
+
+logger = logging.getLogger()
+
+BOOKING_STORE = os.environ.get("BOOKING_STORE", "sqlite:/tmp/bookings.db")
+
+_booking_store = None
+
+
+class BookingStore(abc.ABC):
+    """
+    Repository interface. Slot sets are passed around as availability engine bitmasks.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or availability.get_engine()
+
+    @abc.abstractmethod
+    def get_booked(self, dates):
+        """
+        Returns a map of date to the bitmask of booked slots, for every requested date.
+        """
+
+    @abc.abstractmethod
+    def claim(self, date, slots, owner):
+        """
+        Claims all slots in the bitmask for owner if they are still free.
+        Returns True when the slots are held by owner afterwards, False if any was taken.
+        """
+
+    @abc.abstractmethod
+    def release(self, date, slots, owner):
+        """
+        Releases the slots in the bitmask that are held by owner.
+        """
+
+
+class SQLiteBookingStore(BookingStore):
+    def __init__(self, path, engine=None):
+        super().__init__(engine)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS claims ("
+            " date TEXT NOT NULL,"
+            " time TEXT NOT NULL,"
+            " owner TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " PRIMARY KEY (date, time))"
+        )
+
+    def get_booked(self, dates):
+        dates = list(dates)
+        booked = {date: 0 for date in dates}
+        if not dates:
+            return booked
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT date, time FROM claims WHERE date IN ({})".format(
+                    ",".join("?" * len(dates))
+                ),
+                dates,
+            ).fetchall()
+        for date, start_time in rows:
+            booked[date] |= self.engine.mask_from_times([start_time])
+        return booked
+
+    def claim(self, date, slots, owner):
+        times = self.engine.times_from_mask(slots)
+        if not times:
+            return False
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO claims (date, time, owner, created) VALUES (?, ?, ?, ?)",
+                    [(date, start_time, owner, now) for start_time in times],
+                )
+                owners = cursor.execute(
+                    "SELECT owner FROM claims WHERE date = ? AND time IN ({})".format(
+                        ",".join("?" * len(times))
+                    ),
+                    [date] + times,
+                ).fetchall()
+                claimed = all(row[0] == owner for row in owners)
+                cursor.execute("COMMIT" if claimed else "ROLLBACK")
+            except sqlite3.Error:
+                cursor.execute("ROLLBACK")
+                raise
+        return claimed
+
+    def release(self, date, slots, owner):
+        times = self.engine.times_from_mask(slots)
+        if not times:
+            return
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM claims WHERE date = ? AND owner = ? AND time IN ({})".format(
+                    ",".join("?" * len(times))
+                ),
+                [date, owner] + times,
+            )
+
+
+class DynamoDBBookingStore(BookingStore):
+    """
+    One item per claimed slot. Claims are conditional puts, appointments spanning several
+    slots are claimed in a single transaction.
+    """
+
+    CLAIM_CONDITION = "attribute_not_exists(#date) OR #owner = :owner"
+
+    def __init__(self, table_name, client=None, engine=None):
+        super().__init__(engine)
+        self.table_name = table_name
+        self.client = client or aws_clients.get_client("dynamodb")
+
+    def get_booked(self, dates):
+        booked = {}
+        for date in dates:
+            mask = 0
+            kwargs = {
+                "TableName": self.table_name,
+                "KeyConditionExpression": "#date = :date",
+                "ExpressionAttributeNames": {"#date": "date", "#time": "time"},
+                "ExpressionAttributeValues": {":date": {"S": date}},
+                "ProjectionExpression": "#time",
+            }
+            while True:
+                response = self.client.query(**kwargs)
+                mask |= self.engine.mask_from_times(
+                    item["time"]["S"] for item in response.get("Items", [])
+                )
+                if "LastEvaluatedKey" not in response:
+                    break
+                kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+            booked[date] = mask
+        return booked
+
+    def _claim_put(self, date, start_time, owner):
+        return {
+            "TableName": self.table_name,
+            "Item": {
+                "date": {"S": date},
+                "time": {"S": start_time},
+                "owner": {"S": owner},
+                "created": {"N": str(time.time())},
+            },
+            "ConditionExpression": self.CLAIM_CONDITION,
+            "ExpressionAttributeNames": {"#date": "date", "#owner": "owner"},
+            "ExpressionAttributeValues": {":owner": {"S": owner}},
+        }
+
+    def claim(self, date, slots, owner):
+        puts = [
+            self._claim_put(date, start_time, owner)
+            for start_time in self.engine.times_from_mask(slots)
+        ]
+        if not puts:
+            return False
+        try:
+            if len(puts) == 1:
+                self.client.put_item(**puts[0])
+            else:
+                self.client.transact_write_items(
+                    TransactItems=[{"Put": put} for put in puts]
+                )
+        except (
+            self.client.exceptions.ConditionalCheckFailedException,
+            self.client.exceptions.TransactionCanceledException,
+        ):
+            return False
+        return True
+
+    def release(self, date, slots, owner):
+        for start_time in self.engine.times_from_mask(slots):
+            try:
+                self.client.delete_item(
+                    TableName=self.table_name,
+                    Key={"date": {"S": date}, "time": {"S": start_time}},
+                    ConditionExpression="#owner = :owner",
+                    ExpressionAttributeNames={"#owner": "owner"},
+                    ExpressionAttributeValues={":owner": {"S": owner}},
+                )
+            except self.client.exceptions.ConditionalCheckFailedException:
+                pass
+
+
+def create_booking_store(url):
+    kind, _, location = url.partition(":")
+    if kind == "sqlite":
+        return SQLiteBookingStore(location)
+    if kind == "dynamodb":
+        return DynamoDBBookingStore(location)
+    raise ValueError("Unsupported BOOKING_STORE {}".format(url))
+
+
+def get_booking_store():
+    """
+    Returns the module level booking store configured by BOOKING_STORE.
+    """
+    global _booking_store
+    if _booking_store is None:
+        _booking_store = create_booking_store(BOOKING_STORE)
+        logger.debug("Using booking store %s", BOOKING_STORE)
+        if isinstance(_booking_store, SQLiteBookingStore) and os.environ.get(
+            "AWS_LAMBDA_FUNCTION_NAME"
+        ):
+            logger.warning(
+                "BOOKING_STORE %s is local to this Lambda container, the same slot can "
+                "be booked twice; use a dynamodb:<table> store",
+                BOOKING_STORE,
+            )
+    return _booking_store
@@ -0,0 +1,88 @@
+"""
+Date and time normalization.
+
+Slot values are parsed once into typed values and the results are memoized, so the
+several checks a turn makes on the same "Date" or "Time" string share one parse:
+
+    parse_date("2021-03-10")  -> datetime.date(2021, 3, 10), None if invalid
+    parse_time("16:30")       -> 990 (minutes since midnight), None if invalid
+
+Values derived from the current day, such as the weekday suggestions, are cached with
+@daily_cache until the date changes.
+"""
+
+import datetime
+import functools
+import os
+
+import availability
+
+DATE_CACHE_SIZE = int(os.environ.get("DATE_CACHE_SIZE", "1024"))
+
+
+def parse_date(value):
+    """
+    Date of a slot value, or None if it is not a valid date.
+    """
+    if not value:
+        return None
+    # dateutil fills in missing parts from today, so the day is part of the cache key
+    return _parse_date(value, datetime.date.today())
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_date(value, today):
+    try:
+        # Lex resolves AMAZON.DATE slots to ISO dates, which do not need dateutil
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        pass
+
+    import dateutil.parser
+
+    try:
+        return dateutil.parser.parse(
+            value, default=datetime.datetime.combine(today, datetime.time())
+        ).date()
+    except (ValueError, OverflowError):
+        return None
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_time(value):
+    """
+    Minutes since midnight of a "HH:MM" slot value, or None if it is not a valid time.
+    """
+    return availability.parse_minutes(value)
+
+
+def daily_cache(func):
+    """
+    Caches the result of a function of the current day per argument tuple, until midnight.
+    """
+    cache = {}
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        today = datetime.date.today()
+        entry = cache.get(args)
+        if entry is None or entry[0] != today:
+            entry = cache[args] = (today, func(*args))
+        return entry[1]
+
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+@daily_cache
+def upcoming_weekdays(count):
+    """
+    The next count weekdays, starting tomorrow.
+    """
+    days = []
+    day = datetime.date.today()
+    while len(days) < count:
+        day += datetime.timedelta(days=1)
+        if day.weekday() < 5:
+            days.append(day)
+    return tuple(days)
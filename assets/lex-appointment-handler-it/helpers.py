@@ -16,24 +16,26 @@
 #
 
 import json
-import dateutil.parser
 import datetime
 import time
 import os
 import math
 import random
 import logging
-import boto3
 import config as covid_help_desk_config
+import availability
+import booking_store
+import dates
+import metrics
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-kendra_client = boto3.client("kendra")
 
 """ --- Helpers to build responses which match the structure of the necessary dialog actions --- """
 
 
+@metrics.timed("ResponseBuilding")
 def elicit_intent(
     session_attributes, intent_name, slots, message=None, response_card=None
 ):
@@ -49,6 +51,7 @@ def elicit_intent(
     }
 
 
+@metrics.timed("ResponseBuilding")
 def elicit_slot(
     session_attributes, intent_name, slots, slot_to_elicit, message, response_card=None
 ):
@@ -65,6 +68,7 @@ def elicit_slot(
     }
 
 
+@metrics.timed("ResponseBuilding")
 def confirm_intent(session_attributes, intent_name, slots, message, response_card=None):
     return {
         "sessionAttributes": session_attributes,
@@ -78,19 +82,21 @@ def confirm_intent(session_attributes, intent_name, slots, message, response_car
     }
 
 
+@metrics.timed("ResponseBuilding")
 def close(session_attributes, fulfillment_state, message, response_card=None):
     response = {
         "sessionAttributes": session_attributes,
         "dialogAction": {
             "type": "Close",
             "fulfillmentState": fulfillment_state,
-            "message": message
+            "message": message,
         },
     }
 
     return response
 
 
+@metrics.timed("ResponseBuilding")
 def delegate(session_attributes, slots):
     return {
         "sessionAttributes": session_attributes,
@@ -98,6 +104,7 @@ def delegate(session_attributes, slots):
     }
 
 
+@metrics.timed("ResponseBuilding")
 def build_response_card(title, subtitle, options):
     """
     Build a responseCard with a title, subtitle, and an optional set of options which should be displayed as buttons.
@@ -141,19 +148,14 @@ def try_ex(func):
         return None
 
 
-def increment_time_by_thirty_mins(appointment_time):
-    hour, minute = map(int, appointment_time.split(":"))
-    return "{}:00".format(hour + 1) if minute == 30 else "{}:30".format(hour)
-
-
-def get_random_int(minimum, maximum):
+def get_random_int(minimum, maximum, rng=random):
     """
     Returns a random integer between min (included) and max (excluded)
     """
     min_int = math.ceil(minimum)
     max_int = math.floor(maximum)
 
-    return random.randint(min_int, max_int - 1)
+    return rng.randint(min_int, max_int - 1)
 
 
 def get_availabilities(date):
@@ -162,20 +164,22 @@ def get_availabilities(date):
     The output of this function is an array of 30 minute periods of availability, expressed in ISO-8601 time format.
 
     In order to enable quick demonstration of all possible conversation paths supported in this example, the function
-    returns a mixture of fixed and randomized results.
+    returns a mixture of fixed and randomized results.  The randomized results are seeded by the date, so every session
+    sees the same calendar; bookings are tracked separately in the booking store.
 
     On Mondays, availability is randomized; otherwise there is no availability on Tuesday / Thursday and availability at
     10:00 - 10:30 and 4:00 - 5:00 on Wednesday / Friday.
     """
-    day_of_week = dateutil.parser.parse(date).weekday()
+    day_of_week = dates.parse_date(date).weekday()
     availabilities = []
     available_probability = 0.3
+    rng = random.Random(date)
     if day_of_week == 0:
         start_hour = 10
         while start_hour <= 16:
-            if random.random() < available_probability:
+            if rng.random() < available_probability:
                 # Add an availability window for the given hour, with duration determined by another random number.
-                vaccine_type = get_random_int(1, 4)
+                vaccine_type = get_random_int(1, 4, rng)
                 if vaccine_type == 1:
                     availabilities.append("{}:00".format(start_hour))
                 elif vaccine_type == 2:
@@ -193,30 +197,31 @@ def get_availabilities(date):
     return availabilities
 
 
+def get_open_availabilities(dates):
+    """
+    Helper function to return a map of date to the bitmask of slots that are still free on that date.
+    Bookings for all the dates are read from the booking store in one call.
+    """
+    engine = availability.get_engine()
+    booked = booking_store.get_booking_store().get_booked(dates)
+    return {
+        date: engine.mask_from_times(get_availabilities(date)) & ~booked[date]
+        for date in dates
+    }
+
+
 def isvalid_date(date):
-    try:
-        dateutil.parser.parse(date)
-        return True
-    except ValueError:
-        return False
+    return dates.parse_date(date) is not None
 
 
 def is_available(appointment_time, duration, availabilities):
     """
     Helper function to check if the given time and duration fits within a known set of availability windows.
-    Duration is assumed to be one of 30, 60 (meaning minutes).  Availabilities is expected to contain entries of the format HH:MM.
+    Duration is in minutes.  Availabilities is expected to be a bitmask of free slots, see availability.
     """
-    if duration == 30:
-        return appointment_time in availabilities
-    elif duration == 60:
-        second_half_hour_time = increment_time_by_thirty_mins(appointment_time)
-        return (
-            appointment_time in availabilities
-            and second_half_hour_time in availabilities
-        )
-
-    # Invalid duration ; throw error.  We should not have reached this branch due to earlier validation.
-    raise Exception("Was not able to understand duration {}".format(duration))
+    return availability.get_engine().is_available(
+        availabilities, appointment_time, duration
+    )
 
 
 def get_duration(vaccine_type):
@@ -226,20 +231,20 @@ def get_duration(vaccine_type):
 
 def get_availabilities_for_duration(duration, availabilities):
     """
-    Helper function to return the windows of availability of the given duration, when provided a set of 30 minute windows.
+    Helper function to return the windows of availability of the given duration, when provided a bitmask of
+    free slots.
     """
-    duration_availabilities = []
-    start_time = "10:00"
-    while start_time != "17:00":
-        if start_time in availabilities:
-            if duration == 30:
-                duration_availabilities.append(start_time)
-            elif increment_time_by_thirty_mins(start_time) in availabilities:
-                duration_availabilities.append(start_time)
+    return availability.get_engine().start_times(availabilities, duration)
 
-        start_time = increment_time_by_thirty_mins(start_time)
 
-    return duration_availabilities
+def get_availabilities_for_dates(duration, availabilities_by_date):
+    """
+    Helper function to return the windows of availability of the given duration for several dates at once,
+    when provided a bitmask of free slots for each date.
+    """
+    return availability.get_engine().start_times_for_dates(
+        availabilities_by_date, duration
+    )
 
 
 def build_validation_result(is_valid, violated_slot, message_content):
@@ -259,58 +264,55 @@ def validate_book_appointment(vaccine_type, date, appointment_time):
         )
 
     if appointment_time:
-        if len(appointment_time) != 5:
-            return build_validation_result(
-                False,
-                "Time",
-                "I did not recognize that, what time would you like to book your appointment?",
-            )
-
-        hour, minute = appointment_time.split(":")
-        hour = parse_int(hour)
-        minute = parse_int(minute)
-        if math.isnan(hour) or math.isnan(minute):
+        engine = availability.get_engine()
+        minutes = dates.parse_time(appointment_time)
+        if minutes is None:
             return build_validation_result(
                 False,
                 "Time",
                 "I did not recognize that, what time would you like to book your appointment?",
             )
 
-        if hour < 10 or hour > 16:
+        if not engine.is_open_at_minute(minutes):
             # Outside of business hours
             return build_validation_result(
                 False,
                 "Time",
-                "Our business hours are ten a.m. to five p.m.  What time works best for you?",
+                "Our business hours are {} to {}, what time works best for you?".format(
+                    build_time_output_string(
+                        availability.format_minutes(engine.opening_minute)
+                    ),
+                    build_time_output_string(
+                        availability.format_minutes(engine.closing_minute)
+                    ),
+                ),
             )
 
-        if minute not in [30, 0]:
-            # Must be booked on the hour or half hour
+        if engine.minute_to_slot(minutes) is None:
+            # Must be booked on a slot boundary
             return build_validation_result(
                 False,
                 "Time",
-                "We schedule appointments every half hour, what time works best for you?",
+                "We schedule appointments every {} minutes, what time works best for you?".format(
+                    engine.slot_minutes
+                ),
             )
 
     if date:
-        if not isvalid_date(date):
+        appointment_date = dates.parse_date(date)
+        if appointment_date is None:
             return build_validation_result(
                 False,
                 "Date",
                 "I did not understand that, what date works best for you?",
             )
-        elif (
-            datetime.datetime.strptime(date, "%Y-%m-%d").date() <= datetime.date.today()
-        ):
+        elif appointment_date <= datetime.date.today():
             return build_validation_result(
                 False,
                 "Date",
                 "Appointments must be scheduled a day in advance.  Can you try a different date?",
             )
-        elif (
-            dateutil.parser.parse(date).weekday() == 5
-            or dateutil.parser.parse(date).weekday() == 6
-        ):
+        elif appointment_date.weekday() >= 5:
             return build_validation_result(
                 False,
                 "Date",
@@ -336,13 +338,15 @@ def build_time_output_string(appointment_time):
 
 def build_available_time_string(availabilities):
     """
-    Build a string eliciting for a possible time slot among at least two availabilities.
+    Build a string eliciting for a possible time slot among the availabilities.
     """
     prefix = "We have time availabilities at "
     if len(availabilities) > 3:
         prefix = "We have plenty of availability, including "
 
     prefix += build_time_output_string(availabilities[0])
+    if len(availabilities) == 1:
+        return prefix
     if len(availabilities) == 2:
         return "{} and {}".format(prefix, build_time_output_string(availabilities[1]))
 
@@ -353,11 +357,11 @@ def build_available_time_string(availabilities):
     )
 
 
+@metrics.timed("ResponseBuilding")
 def build_options(slot, vaccine_type=None, date=None, booking_map=None):
     """
     Build a list of potential options for a given slot, to be used in responseCard generation.
     """
-    day_strings = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
     if slot == "VaccineType":
         return [
             {"text": "macbook Repair (30 min)", "value": "macbook"},
@@ -365,165 +369,65 @@ def build_options(slot, vaccine_type=None, date=None, booking_map=None):
     elif slot == "Menu":
         return [
             {"text": "Question", "value": "Question"},
-            {"text": "Scheduling", "value": "Schedule appointment"}
+            {"text": "Scheduling", "value": "Schedule appointment"},
         ]
     elif slot == "Date":
         # Return the next five weekdays.
-        options = []
-        potential_date = datetime.date.today()
-        while len(options) < 5:
-            potential_date = potential_date + datetime.timedelta(days=1)
-            if potential_date.weekday() < 5:
-                options.append(
-                    {
-                        "text": "{}-{} ({})".format(
-                            (potential_date.month),
-                            potential_date.day,
-                            day_strings[potential_date.weekday()],
-                        ),
-                        "value": potential_date.strftime("%A, %B %d, %Y"),
-                    }
-                )
-        return options
+        return list(build_date_options(5))
     elif slot == "Time":
         # Return the availabilities on the given date.
         if not vaccine_type or not date:
             return None
 
-        availabilities = try_ex(lambda: booking_map[date])
+        availabilities = booking_map.get(date) if booking_map else None
         if not availabilities:
             return None
 
-        availabilities = get_availabilities_for_duration(
-            get_duration(vaccine_type), availabilities
-        )
-        if len(availabilities) == 0:
-            return None
-
-        options = []
-        for i in range(min(len(availabilities), 5)):
-            options.append(
-                {
-                    "text": build_time_output_string(availabilities[i]),
-                    "value": build_time_output_string(availabilities[i]),
-                }
-            )
-
-        return options
-
-
-## Kendra HELP DESK
-
-
-def get_slot_values(slot_values, intent_request):
-    if slot_values is None:
-        slot_values = {key: None for key in covid_help_desk_config.SLOT_CONFIG}
-
-    slots = intent_request["currentIntent"]["slots"]
-
-    for key, config in covid_help_desk_config.SLOT_CONFIG.items():
-        slot_values[key] = slots.get(key)
-        logger.debug(
-            "<<covid_help_desk_bot>> retrieving slot value for %s = %s",
-            key,
-            slot_values[key],
+        return build_time_options(
+            get_availabilities_for_duration(get_duration(vaccine_type), availabilities)
         )
-        if slot_values[key]:
-            if (
-                config.get("type", covid_help_desk_config.ORIGINAL_VALUE)
-                == covid_help_desk_config.TOP_RESOLUTION
-            ):
-                # get the resolved slot name of what the user said/typed
-                if (
-                    len(
-                        intent_request["currentIntent"]["slotDetails"][key][
-                            "resolutions"
-                        ]
-                    )
-                    > 0
-                ):
-                    slot_values[key] = intent_request["currentIntent"]["slotDetails"][
-                        key
-                    ]["resolutions"][0]["value"]
-                else:
-                    errorMsg = covid_help_desk_config.SLOT_CONFIG[key].get(
-                        "error", 'Sorry, I don\'t understand "{}".'
-                    )
-                    raise covid_help_desk_config.SlotError(
-                        errorMsg.format(slots.get(key))
-                    )
-
-    return slot_values
 
 
-def get_remembered_slot_values(slot_values, session_attributes):
-    logger.debug(
-        "<<covid_help_desk_bot>> get_remembered_slot_values() - session_attributes: %s",
-        session_attributes,
-    )
-
-    str = session_attributes.get("rememberedSlots")
-    remembered_slot_values = (
-        json.loads(str)
-        if str is not None
-        else {key: None for key in covid_help_desk_config.SLOT_CONFIG}
-    )
-
-    if slot_values is None:
-        slot_values = {key: None for key in covid_help_desk_config.SLOT_CONFIG}
-
-    for key, config in covid_help_desk_config.SLOT_CONFIG.items():
-        if config.get("remember", False):
-            logger.debug(
-                "<<covid_help_desk_bot>> get_remembered_slot_values() - slot_values[%s] = %s",
-                key,
-                slot_values.get(key),
-            )
-            logger.debug(
-                "<<covid_help_desk_bot>> get_remembered_slot_values() - remembered_slot_values[%s] = %s",
-                key,
-                remembered_slot_values.get(key),
-            )
-            if slot_values.get(key) is None:
-                slot_values[key] = remembered_slot_values.get(key)
-
-    return slot_values
-
-
-def remember_slot_values(slot_values, session_attributes):
-    if slot_values is None:
-        slot_values = {
-            key: None
-            for key, config in covid_help_desk_config.SLOT_CONFIG.items()
-            if config["remember"]
+@dates.daily_cache
+def build_date_options(count):
+    """
+    Build the "Date" options for the next weekdays, computed once a day.
+    """
+    day_strings = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+    return tuple(
+        {
+            "text": "{}-{} ({})".format(
+                potential_date.month,
+                potential_date.day,
+                day_strings[potential_date.weekday()],
+            ),
+            "value": potential_date.strftime("%A, %B %d, %Y"),
         }
-    session_attributes["rememberedSlots"] = json.dumps(slot_values)
-    logger.debug("<<covid_help_desk_bot>> Storing updated slot values: %s", slot_values)
-    return slot_values
-
+        for potential_date in dates.upcoming_weekdays(count)
+    )
 
-def get_latest_slot_values(intent_request, session_attributes):
-    slot_values = session_attributes.get("slot_values")
 
-    try:
-        slot_values = get_slot_values(slot_values, intent_request)
-    except covid_help_desk_config.SlotError as err:
-        raise covid_help_desk_config.SlotError(err)
+@metrics.timed("ResponseBuilding")
+def build_time_options(availabilities):
+    """
+    Build the "Time" options from start times that were already computed for the requested duration.
+    """
+    if len(availabilities) == 0:
+        return None
 
-    logger.debug(
-        '<<covid_help_desk_bot>> "get_latest_slot_values(): slot_values: %s',
-        slot_values,
-    )
+    options = []
+    for i in range(min(len(availabilities), 5)):
+        options.append(
+            {
+                "text": build_time_output_string(availabilities[i]),
+                "value": build_time_output_string(availabilities[i]),
+            }
+        )
 
-    slot_values = get_remembered_slot_values(slot_values, session_attributes)
-    logger.debug(
-        '<<covid_help_desk_bot>> "get_latest_slot_values(): slot_values after get_remembered_slot_values: %s',
-        slot_values,
-    )
+    return options
 
-    remember_slot_values(slot_values, session_attributes)
 
-    return slot_values
+## Kendra HELP DESK
 
 
 def increment_counter(session_attributes, counter):
@@ -537,78 +441,3 @@ def increment_counter(session_attributes, counter):
     session_attributes[counter] = count
 
     return count
-
-
-def get_kendra_answer(question):
-    try:
-        KENDRA_INDEX = os.environ["KENDRA_INDEX"]
-    except KeyError:
-        return "Configuration error - please set the Kendra index ID in the environment variable KENDRA_INDEX."
-
-    try:
-        response = kendra_client.query(IndexId=KENDRA_INDEX, QueryText=question)
-    except:
-        return None
-
-    logger.debug(
-        "<<covid_help_desk_bot>> get_kendra_answer() - response = "
-        + json.dumps(response)
-    )
-
-    #
-    # determine which is the top result from Kendra, based on the Type attribue
-    #  - QUESTION_ANSWER = a result from a FAQ: just return the FAQ answer
-    #  - ANSWER = text found in a document: return the text passage found in the document plus a link to the document
-    #  - DOCUMENT = link(s) to document(s): check for several documents and return the links
-    #
-
-    first_result_type = ""
-    try:
-        first_result_type = response["ResultItems"][0]["Type"]
-    except KeyError:
-        return None
-
-    if first_result_type == "QUESTION_ANSWER":
-        try:
-            faq_answer_text = response["ResultItems"][0]["DocumentExcerpt"]["Text"]
-        except KeyError:
-            faq_answer_text = "Sorry, I could not find an answer in our FAQs."
-
-        return faq_answer_text
-
-    elif first_result_type == "ANSWER":
-        # return the text answer from the document, plus the URL link to the document
-        try:
-            document_title = response["ResultItems"][0]["DocumentTitle"]["Text"]
-            document_excerpt_text = response["ResultItems"][0]["DocumentExcerpt"][
-                "Text"
-            ]
-            document_url = response["ResultItems"][0]["DocumentURI"]
-            answer_text = "I couldn't find a specific answer, but here's an excerpt from a document ("
-            answer_text += "<" + document_url + "|" + document_title + ">"
-            answer_text += ") that might help:\n\n" + document_excerpt_text + "...\n"
-        except KeyError:
-            answer_text = "Sorry, I could not find the answer in our documents."
-
-        return answer_text
-
-    elif first_result_type == "DOCUMENT":
-        # assemble the list of document links
-        document_list = "Here are some documents you could review:\n"
-        for item in response["ResultItems"]:
-            document_title = None
-            document_url = None
-            if item["Type"] == "DOCUMENT":
-                if item.get("DocumentTitle", None):
-                    if item["DocumentTitle"].get("Text", None):
-                        document_title = item["DocumentTitle"]["Text"]
-                if item.get("DocumentId", None):
-                    document_url = item["DocumentURI"]
-
-            if document_title is not None:
-                document_list += "-  <" + document_url + "|" + document_title + ">\n"
-
-        return document_list
-
-    else:
-        return None
@@ -1,41 +1,37 @@
 import json
-import dateutil.parser
-import datetime
 import time
 import os
-import math
-import random
 import logging
-import boto3
 import helpers
 import config
+import booking_codec
+import booking_store
+import kendra_answers
+import router
+import metrics
+import session_state
+import slot_state
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-kendra_client = boto3.client("kendra")
+# reply of AskKendraFAQ turns the webhook answers with its speculative Kendra query
+SPECULATIVE_PLACEHOLDER = "One moment, let me look that up."
 
 """ --- Functions (Intent Handlers) that control the bot's behavior --- """
 
 
 def welcome_handler(intent_request):
-    user_id = intent_request["userId"]
-
-    output_session_attributes = (
-        intent_request["sessionAttributes"]
-        if intent_request["sessionAttributes"] is not None
-        else {}
-    )
-
-    try:
-        remembered_slots = json.loads(output_session_attributes["rememberedSlots"])
+    output_session_attributes = intent_request["sessionAttributes"]
+    full_name = intent_request["slotState"].remembered.get("FullName")
 
+    if full_name:
         message = f"""
-Hi {remembered_slots['FullName']}! How can I help you today?
+Hi {full_name}! How can I help you today?
 You can ask an IT Support question e.g. "Where is the IT Help Desk?"
 Text "Schedule" to schedule an appointment with IT Support."""
 
-    except:
+    else:
         message = """
 Hi there! How can I help you today?
 You can ask an IT Support question e.g. "Where is the IT Help Desk?"
@@ -49,23 +45,19 @@ Text "Schedule" to schedule an appointment with IT Support.
     )
 
 
-def transfer_to_flex_agent_handler(intent_request, user_id):
+def transfer_to_flex_agent_handler(intent_request):
     source = intent_request["invocationSource"]
 
-    output_session_attributes = (
-        intent_request["sessionAttributes"]
-        if intent_request["sessionAttributes"] is not None
-        else {}
-    )
+    output_session_attributes = intent_request["sessionAttributes"]
 
     output_session_attributes["connected_to_agent"] = True
     print(output_session_attributes)
+    full_name = intent_request["slotState"].remembered.get("FullName") or "there"
 
     try:
-        flex_code = os.environ['id']
+        flex_code = os.environ["id"]
         flex_code = flex_code.replace(" ", "%20")
-        print("environment variable: " + os.environ['id'])
-        full_name = json.loads(output_session_attributes["rememberedSlots"])["FullName"]
+        print("environment variable: " + os.environ["id"])
         message = f"Okay {full_name}. Please tap here: http://wa.me/14155238886?text={flex_code} and send the code 'join green-bad' to connect with an agent. Thank you!"
     except:
         message = f"Okay {full_name}. Please tap here: http://wa.me/14155238886?text=join%20green-bad and send the code 'join green-bad' to connect with an agent. Thank you!!!"
@@ -76,12 +68,13 @@ def transfer_to_flex_agent_handler(intent_request, user_id):
     )
 
 
-def kendra_query_handler(intent_request, session_attributes):
+def kendra_query_handler(intent_request):
+    session_attributes = intent_request["sessionAttributes"]
     session_attributes["fallbackCount"] = "0"
     fallbackCount = helpers.increment_counter(session_attributes, "fallbackCount")
 
     try:
-        slot_values = helpers.get_latest_slot_values(intent_request, session_attributes)
+        slot_values = intent_request["slotState"].latest_values(intent_request)
     except config.SlotError as err:
         return helpers.close(
             session_attributes,
@@ -94,6 +87,14 @@ def kendra_query_handler(intent_request, session_attributes):
         json.dumps(slot_values),
     )
 
+    if intent_request["speculativeKendra"]:
+        # the webhook is already querying Kendra and replaces this message with its answer
+        return helpers.close(
+            session_attributes,
+            "Fulfilled",
+            {"contentType": "CustomPayload", "content": SPECULATIVE_PLACEHOLDER},
+        )
+
     query_string = ""
     if intent_request.get("inputTranscript", None) is not None:
         query_string += intent_request["inputTranscript"]
@@ -103,7 +104,7 @@ def kendra_query_handler(intent_request, session_attributes):
         query_string,
     )
 
-    kendra_response = helpers.get_kendra_answer(query_string)
+    kendra_response = kendra_answers.get_kendra_answer(query_string)
     if kendra_response is None:
         response = "Sorry, I was not able to understand your question."
         return helpers.close(
@@ -124,11 +125,7 @@ def kendra_query_handler(intent_request, session_attributes):
 
 
 def confirm_appointment_handler(intent_request):
-    output_session_attributes = (
-        intent_request["sessionAttributes"]
-        if intent_request["sessionAttributes"] is not None
-        else {}
-    )
+    output_session_attributes = intent_request["sessionAttributes"]
 
     content = "You haven't scheduled any appointments yet."
 
@@ -144,7 +141,7 @@ def confirm_appointment_handler(intent_request):
     )
 
 
-def make_appointment_handler(intent_request, sentiment_label):
+def make_appointment_handler(intent_request):
     """
     Performs dialog management and fulfillment for booking a vaccination appointment.
 
@@ -154,16 +151,10 @@ def make_appointment_handler(intent_request, sentiment_label):
     on the bot model and the inferred slot values fully specify the intent.
     """
 
-    output_session_attributes = (
-        intent_request["sessionAttributes"]
-        if intent_request["sessionAttributes"] is not None
-        else {}
-    )
+    output_session_attributes = intent_request["sessionAttributes"]
 
     try:
-        slot_values = helpers.get_latest_slot_values(
-            intent_request, output_session_attributes
-        )
+        slot_values = intent_request["slotState"].latest_values(intent_request)
 
     except config.SlotError as err:
         return helpers.close(
@@ -183,11 +174,14 @@ def make_appointment_handler(intent_request, sentiment_label):
 
     source = intent_request["invocationSource"]
 
-    booking_map = json.loads(
-        helpers.try_ex(lambda: output_session_attributes["bookingMap"]) or "{}"
-    )
+    with metrics.span("BookingMapCodec"):
+        booking_map = booking_codec.BookingMap.decode(
+            output_session_attributes.get("bookingMap")
+        )
 
-    sentiment_string_suffix = " [ Current sentiment: {} ]".format(sentiment_label)
+    sentiment_string_suffix = " [ Current sentiment: {} ]".format(
+        intent_request["sentiment"].label
+    )
     # sentiment_string_suffix = ""
 
     if intent_request["inputTranscript"].lower() == ("cancel" or "cancel scheduling"):
@@ -330,12 +324,12 @@ def make_appointment_handler(intent_request, sentiment_label):
             and current_condition
             and date
         ):
-            # Fetch or generate the availabilities for the given date.
-            booking_availabilities = helpers.try_ex(lambda: booking_map[date])
-            if booking_availabilities is None:
-                booking_availabilities = helpers.get_availabilities(date)
-                booking_map[date] = booking_availabilities
-                output_session_attributes["bookingMap"] = json.dumps(booking_map)
+            # Fetch the availabilities for the given date from the shared calendar.  A snapshot is kept in
+            # sessionAttributes, but the booking itself is checked against the booking store at fulfillment time.
+            booking_availabilities = helpers.get_open_availabilities([date])[date]
+            booking_map.set(date, booking_availabilities)
+            with metrics.span("BookingMapCodec"):
+                output_session_attributes["bookingMap"] = booking_map.encode()
 
             vaccine_type_availabilities = helpers.get_availabilities_for_duration(
                 helpers.get_duration(vaccine_type), booking_availabilities
@@ -363,9 +357,9 @@ def make_appointment_handler(intent_request, sentiment_label):
 
             message_content = "What time on {} works for you? ".format(date)
             if appointment_time:
-                output_session_attributes[
-                    "formattedTime"
-                ] = helpers.build_time_output_string(appointment_time)
+                output_session_attributes["formattedTime"] = (
+                    helpers.build_time_output_string(appointment_time)
+                )
                 # Validate that proposed time for the appointment can be booked by first fetching the availabilities for the given day.  To
                 # give consistent behavior in the sample, this is stored in sessionAttributes after the first lookup.
                 if helpers.is_available(
@@ -422,35 +416,68 @@ def make_appointment_handler(intent_request, sentiment_label):
                 helpers.build_response_card(
                     "Specify Time",
                     "What time works best for you?",
-                    helpers.build_options("Time", vaccine_type, date, booking_map),
+                    helpers.build_time_options(vaccine_type_availabilities),
                 ),
             )
 
         return helpers.delegate(output_session_attributes, slot_values)
 
-    # Book the appointment.  In a real bot, this would likely involve a call to a backend service.
+    # Book the appointment by claiming its slots in the shared booking store, unless another user got them first.
     duration = helpers.get_duration(vaccine_type)
-    booking_availabilities = booking_map[date]
-    if booking_availabilities:
-        # Remove the availability slot for the given date as it has now been booked.
-        booking_availabilities.remove(appointment_time)
-        if duration == 60:
-            second_half_hour_time = helpers.increment_time_by_thirty_mins(
-                appointment_time
-            )
-            booking_availabilities.remove(second_half_hour_time)
-
-        booking_map[date] = booking_availabilities
-        output_session_attributes["bookingMap"] = json.dumps(booking_map)
-    else:
-        # This is not treated as an error as this code sample supports functionality either as fulfillment or dialog code hook.
-        logger.debug(
-            "Availabilities for {} were null at fulfillment time.  "
-            "This should have been initialized if this function was configured as the dialog code hook".format(
-                date
+    booked = booking_map.engine.duration_mask(appointment_time, duration)
+    if not booked or not booking_store.get_booking_store().claim(
+        date, booked, intent_request["userId"]
+    ):
+        booking_availabilities = helpers.get_open_availabilities([date])[date]
+        booking_map.set(date, booking_availabilities)
+        with metrics.span("BookingMapCodec"):
+            output_session_attributes["bookingMap"] = booking_map.encode()
+        vaccine_type_availabilities = helpers.get_availabilities_for_duration(
+            duration, booking_availabilities
+        )
+        slot_values["Time"] = None
+        if len(vaccine_type_availabilities) == 0:
+            slot_values["Date"] = None
+            return helpers.elicit_slot(
+                output_session_attributes,
+                intent_request["currentIntent"]["name"],
+                slot_values,
+                "Date",
+                {
+                    "contentType": "PlainText",
+                    "content": "Sorry, that time has just been booked and there is no other availability on {}. "
+                    "Is there another day which works for you?".format(date),
+                },
+                helpers.build_response_card(
+                    "Specify Date",
+                    "What day works best for you?",
+                    helpers.build_options("Date", vaccine_type, date, booking_map),
+                ),
             )
+        return helpers.elicit_slot(
+            output_session_attributes,
+            intent_request["currentIntent"]["name"],
+            slot_values,
+            "Time",
+            {
+                "contentType": "PlainText",
+                "content": "Sorry, that time has just been booked. {}".format(
+                    helpers.build_available_time_string(vaccine_type_availabilities)
+                ),
+            },
+            helpers.build_response_card(
+                "Specify Time",
+                "What time works best for you?",
+                helpers.build_time_options(vaccine_type_availabilities),
+            ),
         )
 
+    booking_availabilities = booking_map.get(date)
+    if booking_availabilities is not None:
+        booking_map.set(date, booking_availabilities & ~booked)
+        with metrics.span("BookingMapCodec"):
+            output_session_attributes["bookingMap"] = booking_map.encode()
+
     output_session_attributes["appointment_time"] = "{} at {}".format(
         helpers.build_time_output_string(appointment_time), date
     )
@@ -471,39 +498,53 @@ def make_appointment_handler(intent_request, sentiment_label):
 """ --- Intents Dispatch --- """
 
 
+def default_handler(intent_request):
+    """
+    Handles intents without a registered handler, e.g. CancelScheduling and ThankYou: during dialog Lex is
+    left to continue with the bot's own configuration, at fulfillment the intent is simply closed.
+    """
+    if intent_request["invocationSource"] == "DialogCodeHook":
+        return helpers.delegate(
+            intent_request["sessionAttributes"],
+            intent_request["currentIntent"]["slots"],
+        )
+    return helpers.close(
+        intent_request["sessionAttributes"],
+        "Fulfilled",
+        {
+            "contentType": "PlainText",
+            "content": "Okay. Is there anything else I can help you with?",
+        },
+    )
+
+
+intent_router = router.IntentRouter(default_handler=default_handler)
+intent_router.use(router.normalize_session)
+intent_router.use(session_state.compact_session_state)
+intent_router.use(router.speculative_kendra)
+intent_router.use(slot_state.slot_state)
+intent_router.use(router.lazy_sentiment)
+
+intent_router.register("Greeting", welcome_handler)
+intent_router.register("MakeAppointment", make_appointment_handler)
+intent_router.register("AskKendraFAQ", kendra_query_handler)
+intent_router.register("AgentTransfer", transfer_to_flex_agent_handler)
+intent_router.register("ConfirmAppointment", confirm_appointment_handler)
+
+
 def dispatch(intent_request):
     """
     Called when the user specifies an intent for this bot.
     """
 
-    sentiment_response = intent_request["sentimentResponse"]
-    sentiment_scores = sentiment_response["sentimentScore"][1:-1].split(",")
-    sentiment_label = sentiment_response["sentimentLabel"]
-
+    # user's whatsapp phonenumber
     logger.debug(
         "dispatch userId={}, intentName={}".format(
             intent_request["userId"], intent_request["currentIntent"]["name"]
         )
     )
 
-    # user's whatsapp phonenumber
-    user_id = intent_request["userId"]
-    intent_name = intent_request["currentIntent"]["name"]
-
-    # Dispatch to your bot's intent handlers
-    if intent_name == "Greeting":
-        return welcome_handler(intent_request)
-    elif intent_name == "MakeAppointment":
-        return make_appointment_handler(intent_request, sentiment_label)
-    elif intent_name == "AskKendraFAQ":
-        session_attributes = intent_request["sessionAttributes"]
-        return kendra_query_handler(intent_request, session_attributes)
-    elif intent_name == "AgentTransfer":
-        return transfer_to_flex_agent_handler(intent_request, user_id)
-    elif intent_name == "ConfirmAppointment":
-        return confirm_appointment_handler(intent_request)
-
-    raise Exception("Intent with name " + intent_name + " not supported")
+    return intent_router.dispatch(intent_request)
 
 
 """ --- Main handler --- """
@@ -519,4 +560,5 @@ def lambda_handler(event, context):
     time.tzset()
     logger.debug("event.bot.name={}".format(event["bot"]["name"]))
 
-    return dispatch(event)
+    with metrics.invocation(Intent=event["currentIntent"]["name"]):
+        return dispatch(event)
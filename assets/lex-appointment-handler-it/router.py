@@ -0,0 +1,131 @@
+"""
+Table-driven intent router.
+
+Handlers are looked up by intent name in a dict and take the intent request as their
+only argument. Middleware wraps every handler call: middleware(intent_request, call_next)
+returns the response, usually by returning call_next(intent_request). The latency of
+every dispatch is recorded as the Dispatch span of the invocation's metrics, which the
+handler records with an Intent dimension, so CloudWatch keeps the percentiles per intent.
+"""
+
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger()
+
+
+class IntentRouter:
+    def __init__(self, default_handler=None):
+        self.default_handler = default_handler
+        self._handlers = {}
+        self._middleware = []
+        self._chains = {}
+
+    def register(self, intent_name, handler):
+        self._handlers[intent_name] = handler
+        self._chains.clear()
+
+    def route(self, intent_name):
+        """
+        Decorator registering a handler for an intent.
+        """
+
+        def decorator(handler):
+            self.register(intent_name, handler)
+            return handler
+
+        return decorator
+
+    def use(self, middleware):
+        self._middleware.append(middleware)
+        self._chains.clear()
+
+    def _chain(self, intent_name):
+        chain = self._chains.get(intent_name)
+        if chain is None:
+            chain = self._handlers.get(intent_name, self.default_handler)
+            if chain is None:
+                raise KeyError("Intent with name " + intent_name + " not supported")
+            for middleware in reversed(self._middleware):
+                chain = _bind(middleware, chain)
+            self._chains[intent_name] = chain
+        return chain
+
+    def dispatch(self, intent_request):
+        intent_name = intent_request["currentIntent"]["name"]
+        start = time.perf_counter()
+        try:
+            with metrics.span("Dispatch"):
+                return self._chain(intent_name)(intent_request)
+        finally:
+            logger.debug(
+                "Dispatched %s in %.3f ms",
+                intent_name,
+                (time.perf_counter() - start) * 1000,
+            )
+
+
+def _bind(middleware, call_next):
+    def call(intent_request):
+        return middleware(intent_request, call_next)
+
+    return call
+
+
+class LazySentiment:
+    """
+    Sentiment of the user input, parsed from sentimentResponse only when it is used.
+    """
+
+    __slots__ = ("_response", "_scores")
+
+    def __init__(self, sentiment_response):
+        self._response = sentiment_response or {}
+        self._scores = None
+
+    @property
+    def label(self):
+        return self._response.get("sentimentLabel")
+
+    @property
+    def scores(self):
+        """
+        Scores by sentiment, parsed from a string such as "{Positive: 0.1,Negative: 0.8,...}".
+        """
+        if self._scores is None:
+            self._scores = {}
+            for item in self._response.get("sentimentScore", "")[1:-1].split(","):
+                name, _, value = item.partition(":")
+                if value:
+                    self._scores[name.strip()] = float(value)
+        return self._scores
+
+
+def normalize_session(intent_request, call_next):
+    """
+    Middleware making sure sessionAttributes is a dict.
+    """
+    if intent_request.get("sessionAttributes") is None:
+        intent_request["sessionAttributes"] = {}
+    return call_next(intent_request)
+
+
+def lazy_sentiment(intent_request, call_next):
+    """
+    Middleware exposing the sentiment as intent_request["sentiment"], parsed on first use.
+    """
+    intent_request["sentiment"] = LazySentiment(intent_request.get("sentimentResponse"))
+    return call_next(intent_request)
+
+
+def speculative_kendra(intent_request, call_next):
+    """
+    Middleware moving the webhook's speculativeKendra session attribute to
+    intent_request["speculativeKendra"], so it only applies to the turn it was sent with.
+    """
+    intent_request["speculativeKendra"] = (
+        intent_request["sessionAttributes"].pop("speculativeKendra", None) == "1"
+    )
+    return call_next(intent_request)
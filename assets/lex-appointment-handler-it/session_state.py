@@ -0,0 +1,208 @@
+"""
+Compact, versioned encoding of the session attributes.
+
+Lex sends the session attributes with every turn in both directions, and the webhook sends
+them to post_text again. Instead of several separately encoded attributes
+(rememberedSlots, bookingMap, formattedTime, appointment_time, ...) the whole session
+state is kept in a single attribute:
+
+    st = "1.<schema>:<json>"      compact JSON
+    st = "1.<schema>z:<base64>"   zlib compressed JSON, above SESSION_STATE_COMPRESS_BYTES
+
+The JSON uses short keys, and the remembered slots are a list in config.SLOT_CONFIG order
+instead of an object. <schema> is a fingerprint of the slot names, so a state written
+with a different SLOT_CONFIG is recognised. Session attributes without "st" (the legacy
+layout, e.g. the initial attributes set by the webhook) are decoded as they are.
+
+Attributes the bot's prompts reference, like [formattedTime] in the MakeAppointment
+confirmation prompt, are filled in by Lex from the plain session attributes, so
+PROMPT_ATTRIBUTES stay top-level attributes next to "st".
+
+Handlers keep working on the legacy layout: the router middleware decodes the request's
+attributes before the handler runs and encodes the response's attributes afterwards.
+Decoded compact states hold rememberedSlots as a dict rather than a JSON string, see
+slot_state.SlotState, which accepts both.
+"""
+
+import base64
+import json
+import logging
+import os
+import zlib
+
+import config
+import metrics
+
+logger = logging.getLogger()
+
+# "compact" or "legacy", to roll back to the previous layout
+SESSION_STATE_ENCODING = os.environ.get("SESSION_STATE_ENCODING", "compact")
+SESSION_STATE_COMPRESS_BYTES = int(
+    os.environ.get("SESSION_STATE_COMPRESS_BYTES", "512")
+)
+# Lex V1 limits session and request attributes to 12 KB together
+SESSION_STATE_WARN_BYTES = int(os.environ.get("SESSION_STATE_WARN_BYTES", "8192"))
+
+STATE_KEY = "st"
+VERSION = "1"
+
+SLOT_NAMES = tuple(config.SLOT_CONFIG)
+SCHEMA = "{:04x}".format(zlib.crc32(",".join(SLOT_NAMES).encode()) & 0xFFFF)
+
+# attributes referenced as [name] in the bot's prompts, kept out of the compact state
+PROMPT_ATTRIBUTES = ("formattedTime", "ExpectedDuration")
+
+# legacy attribute name -> short key
+SHORT_KEYS = {
+    "bookingMap": "b",
+    "appointment_time": "a",
+}
+LONG_KEYS = {short: name for name, short in SHORT_KEYS.items()}
+# states written before formattedTime became a prompt attribute
+LONG_KEYS["f"] = "formattedTime"
+
+
+def encode_remembered_slots(remembered_slots):
+    """
+    List of the remembered slot values in SLOT_CONFIG order, without trailing Nones,
+    or None if the slots do not fit the schema.
+    """
+    slot_values = remembered_slots
+    if not isinstance(slot_values, dict):
+        try:
+            slot_values = json.loads(remembered_slots)
+        except (TypeError, ValueError):
+            return None
+    if not isinstance(slot_values, dict) or not set(slot_values) <= set(SLOT_NAMES):
+        return None
+    values = [slot_values.get(name) for name in SLOT_NAMES]
+    while values and values[-1] is None:
+        values.pop()
+    return values
+
+
+def decode_remembered_slots(values):
+    values = list(values) + [None] * (len(SLOT_NAMES) - len(values))
+    return dict(zip(SLOT_NAMES, values))
+
+
+def encode(session_attributes):
+    """
+    Encodes session attributes in the legacy layout into the compact layout.
+    """
+    if session_attributes is None:
+        return None
+    if SESSION_STATE_ENCODING == "legacy":
+        if isinstance(session_attributes.get("rememberedSlots"), dict):
+            session_attributes = dict(
+                session_attributes,
+                rememberedSlots=json.dumps(session_attributes["rememberedSlots"]),
+            )
+        return session_attributes
+
+    plain = {}
+    state = {}
+    extra = {}
+    for name, value in session_attributes.items():
+        if name == STATE_KEY:
+            continue
+        if name in PROMPT_ATTRIBUTES:
+            plain[name] = value
+            continue
+        if name == "rememberedSlots":
+            values = encode_remembered_slots(value)
+            if values is not None:
+                state["r"] = values
+                continue
+        if name in SHORT_KEYS:
+            state[SHORT_KEYS[name]] = value
+        else:
+            extra[name] = value
+    if extra:
+        state["x"] = extra
+    if not state:
+        return plain
+
+    payload = json.dumps(state, separators=(",", ":"))
+    if len(payload) > SESSION_STATE_COMPRESS_BYTES:
+        compressed = base64.b64encode(zlib.compress(payload.encode(), 9)).decode()
+        if len(compressed) < len(payload):
+            plain[STATE_KEY] = "{}.{}z:{}".format(VERSION, SCHEMA, compressed)
+            return plain
+    plain[STATE_KEY] = "{}.{}:{}".format(VERSION, SCHEMA, payload)
+    return plain
+
+
+def decode(session_attributes):
+    """
+    Decodes session attributes in either layout into the legacy layout.
+    Attributes set next to the compact state (e.g. by the webhook) are kept and win.
+    """
+    if not session_attributes or STATE_KEY not in session_attributes:
+        return dict(session_attributes or {})
+
+    decoded = {}
+    header, _, payload = session_attributes[STATE_KEY].partition(":")
+    version, _, schema = header.partition(".")
+    compressed = schema.endswith("z")
+    schema = schema.rstrip("z")
+    try:
+        if version != VERSION:
+            raise ValueError("unsupported session state version " + version)
+        if compressed:
+            payload = zlib.decompress(base64.b64decode(payload)).decode()
+        state = json.loads(payload)
+    except (ValueError, zlib.error) as err:
+        logger.warning("Ignoring undecodable session state: %s", err)
+        state = {}
+
+    decoded.update(state.get("x", {}))
+    for short, name in LONG_KEYS.items():
+        if short in state:
+            decoded[name] = state[short]
+    if "r" in state:
+        if schema == SCHEMA:
+            decoded["rememberedSlots"] = decode_remembered_slots(state["r"])
+        else:
+            logger.warning(
+                "Dropping remembered slots written with slot schema %s, current schema is %s",
+                schema,
+                SCHEMA,
+            )
+
+    for name, value in session_attributes.items():
+        if name != STATE_KEY:
+            decoded[name] = value
+    return decoded
+
+
+def encoded_size(session_attributes):
+    """
+    Size in bytes of session attributes as sent to Lex.
+    """
+    return sum(
+        len(str(name).encode()) + len(str(value).encode())
+        for name, value in (session_attributes or {}).items()
+    )
+
+
+def compact_session_state(intent_request, call_next):
+    """
+    Middleware decoding the session attributes for the handler and encoding the response's.
+    """
+    request_attributes = intent_request.get("sessionAttributes")
+    metrics.value("SessionStateRequestBytes", encoded_size(request_attributes), "Bytes")
+    intent_request["sessionAttributes"] = decode(request_attributes)
+
+    response = call_next(intent_request)
+
+    if response.get("sessionAttributes") is not None:
+        response["sessionAttributes"] = encode(response["sessionAttributes"])
+        size = encoded_size(response["sessionAttributes"])
+        metrics.value("SessionStateResponseBytes", size, "Bytes")
+        if size > SESSION_STATE_WARN_BYTES:
+            logger.warning(
+                "Session attributes are %d bytes, close to the Lex limit", size
+            )
+        logger.debug("<<covid_help_desk_bot>> session state size = %d bytes", size)
+    return response
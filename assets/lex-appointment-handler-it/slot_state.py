@@ -0,0 +1,104 @@
+"""
+Request-scoped slot state.
+
+The remembered slots are decoded from the session attributes at most once per request,
+merged with the slots of the current intent in one pass, and written back only when
+the merge changed them. Handlers get the state as intent_request["slotState"].
+"""
+
+import json
+import logging
+
+import config
+import metrics
+
+logger = logging.getLogger()
+
+
+class SlotState:
+    __slots__ = ("session_attributes", "dirty", "_remembered", "_values")
+
+    def __init__(self, session_attributes):
+        self.session_attributes = session_attributes
+        self.dirty = False
+        self._remembered = None
+        self._values = None
+
+    @property
+    def remembered(self):
+        """
+        The remembered slot values, decoded from the rememberedSlots session attribute on first use.
+        """
+        if self._remembered is None:
+            remembered_slots = self.session_attributes.get("rememberedSlots")
+            if isinstance(remembered_slots, dict):
+                self._remembered = dict(remembered_slots)
+            else:
+                try:
+                    self._remembered = json.loads(remembered_slots or "{}")
+                except ValueError:
+                    self._remembered = {}
+        return self._remembered
+
+    @metrics.timed("SlotMerge")
+    def latest_values(self, intent_request):
+        """
+        Returns the slot values of the request, falling back to the remembered value for
+        slots configured with "remember", and remembers the result.
+        Raises config.SlotError when a slot value cannot be resolved.
+        """
+        if self._values is None:
+            current_intent = intent_request["currentIntent"]
+            slots = current_intent.get("slots") or {}
+            remembered = self.remembered
+            values = {}
+            for key, slot_config in config.SLOT_CONFIG.items():
+                value = slots.get(key)
+                if value and (
+                    slot_config.get("type", config.ORIGINAL_VALUE)
+                    == config.TOP_RESOLUTION
+                ):
+                    # get the resolved slot name of what the user said/typed
+                    resolutions = current_intent["slotDetails"][key]["resolutions"]
+                    if not resolutions:
+                        raise config.SlotError(
+                            slot_config.get(
+                                "error", 'Sorry, I don\'t understand "{}".'
+                            ).format(value)
+                        )
+                    value = resolutions[0]["value"]
+                if value is None and slot_config.get("remember", False):
+                    value = remembered.get(key)
+                values[key] = value
+
+            if values != remembered:
+                self._remembered = dict(values)
+                self.dirty = True
+            self._values = values
+            logger.debug(
+                "<<covid_help_desk_bot>> SlotState.latest_values(): slot_values = %s, dirty = %s",
+                values,
+                self.dirty,
+            )
+        return dict(self._values)
+
+    def flush(self, session_attributes):
+        """
+        Writes the remembered slots to the session attributes if they changed.
+        """
+        if self.dirty:
+            session_attributes["rememberedSlots"] = dict(self._remembered)
+            self.dirty = False
+
+
+def slot_state(intent_request, call_next):
+    """
+    Middleware sharing one SlotState between the handler and its helpers, flushed into the
+    response's session attributes.
+    """
+    state = SlotState(intent_request["sessionAttributes"])
+    intent_request["slotState"] = state
+    response = call_next(intent_request)
+    if response.get("sessionAttributes") is not None:
+        state.flush(response["sessionAttributes"])
+    return response
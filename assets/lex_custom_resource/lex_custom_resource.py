@@ -4,24 +4,102 @@ Lex bot
 Associated Lex Intents
 Associated Lex Slot Types
 """
+
 import os
+import argparse
+import copy
+import hashlib
 import logging
 import json
+import random
+import threading
 import time
+from concurrent import futures
 import boto3
 from botocore import exceptions as botocore_exceptions
 from boto3 import exceptions as boto3_exceptions
 from crhelper import CfnResource
 
 logger = logging.getLogger(__name__)
+
+
 helper = CfnResource(
-    json_logging=False, log_level="DEBUG", boto_level="CRITICAL", sleep_on_delete=120
+    json_logging=False,
+    log_level="DEBUG",
+    boto_level="CRITICAL",
+    polling_interval=1,
+    sleep_on_delete=5,
 )
 
+# concurrent puts of intents and slot types
+PUT_WORKERS = int(os.environ.get("LEX_PUT_WORKERS", "4"))
+# client side limit of Lex model building API calls per second
+API_CALLS_PER_SECOND = float(os.environ.get("LEX_API_CALLS_PER_SECOND", "4"))
+# attempts of a call rejected with LimitExceededException
+LIMIT_EXCEEDED_ATTEMPTS = int(os.environ.get("LEX_LIMIT_EXCEEDED_ATTEMPTS", "6"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 20.0
+# attempts of a delete rejected because the resource is still in use
+CONFLICT_ATTEMPTS = int(os.environ.get("LEX_CONFLICT_ATTEMPTS", "8"))
+# numbered versions of the bot and of each intent and slot type kept by the pruner
+VERSION_RETENTION = int(os.environ.get("LEX_VERSION_RETENTION", "3"))
+# bot status polls start short and slow down over time
+POLL_FIRST_SECONDS = 1.0
+POLL_MAX_SECONDS = 15.0
+POLL_GROWTH = 1.6
+# longest wait in a poll invocation, crhelper polls every minute
+POLL_INVOCATION_SECONDS = 40
+# time kept for responding to CloudFormation before the Lambda times out
+DEADLINE_MARGIN_SECONDS = 20
+# pruning after a deployment only starts with at least this much time_left()
+PRUNE_MIN_SECONDS = 10
+
+# kind -> get method, its version parameter, put method, put operation, versions method, versions key
+RESOURCE_KINDS = {
+    "slotType": (
+        "get_slot_type",
+        "version",
+        "put_slot_type",
+        "PutSlotType",
+        "get_slot_type_versions",
+        "slotTypes",
+    ),
+    "intent": (
+        "get_intent",
+        "version",
+        "put_intent",
+        "PutIntent",
+        "get_intent_versions",
+        "intents",
+    ),
+    "bot": (
+        "get_bot",
+        "versionOrAlias",
+        "put_bot",
+        "PutBot",
+        "get_bot_versions",
+        "bots",
+    ),
+}
+VERSION_DELETE_METHODS = {
+    "slotType": "delete_slot_type_version",
+    "intent": "delete_intent_version",
+    "bot": "delete_bot_version",
+}
+# put parameters which are not part of the deployed definition
+UNHASHED_PARAMETERS = {"checksum", "createVersion", "processBehavior", "tags"}
+CREATE = "create"
+UPDATE = "update"
+UNCHANGED = "unchanged"
+# version of a definition that a dry run would create
+NEW_VERSION = "(new)"
+
+# (bucket, key) -> (ETag, bot definition) of bot files read by this container
+s3_json_cache = {}
+
 try:
     lex_client = boto3.client("lex-models", os.environ["AWS_REGION"])
     s3_resource = boto3.resource("s3")
-    SLEEP_TIME = 10
 except (
     botocore_exceptions.BotoCoreError,
     botocore_exceptions.ClientError,
@@ -30,6 +108,172 @@ except (
     helper.init_failure(exception)
 
 
+class RateLimiter:
+    """
+    Token bucket shared by the threads calling the Lex model building API.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a call may be made.
+        """
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+rate_limiter = RateLimiter(API_CALLS_PER_SECOND)
+
+
+def backoff_delay(attempt):
+    """
+    Exponential backoff with full jitter for the given attempt (0 based).
+    :param attempt: Number of failed attempts so far, minus one
+    :return: Seconds to wait
+    """
+    return random.uniform(
+        0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+    )
+
+
+def call_lex(operation, **kwargs):
+    """
+    Calls a Lex model building API operation through the rate limiter,
+    retrying with backoff while it is rejected with LimitExceededException.
+    :param operation: Name of the lex_client method, e.g. "put_intent"
+    :param kwargs: Parameters of the call
+    :return: Response of the call
+    """
+    for attempt in range(LIMIT_EXCEEDED_ATTEMPTS):
+        rate_limiter.acquire()
+        try:
+            return getattr(lex_client, operation)(**kwargs)
+        except lex_client.exceptions.LimitExceededException:
+            if attempt == LIMIT_EXCEEDED_ATTEMPTS - 1:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(
+                "%s was throttled, retrying in %.1f seconds", operation, delay
+            )
+            time.sleep(delay)
+
+
+def call_lex_retrying_conflicts(operation, **kwargs):
+    """
+    Calls a Lex model building API operation like call_lex, also retrying with backoff
+    while the resource is in use (ConflictException, ResourceInUseException).
+    :param operation: Name of the lex_client method, e.g. "delete_bot"
+    :param kwargs: Parameters of the call
+    :return: Response of the call
+    """
+    for attempt in range(CONFLICT_ATTEMPTS):
+        try:
+            return call_lex(operation, **kwargs)
+        except (
+            lex_client.exceptions.ConflictException,
+            lex_client.exceptions.ResourceInUseException,
+        ):
+            if attempt == CONFLICT_ATTEMPTS - 1:
+                raise
+            delay = backoff_delay(attempt)
+            logger.info("%s conflicted, retrying in %.1f seconds", operation, delay)
+            time.sleep(delay)
+
+
+def wait_until(condition, timeout, description):
+    """
+    Polls a condition, first after short intervals which grow over time, with jitter.
+    :param condition: Function returning True once the wait is over
+    :param timeout: Maximum seconds to wait
+    :param description: What is waited for, for the log
+    :return: True if the condition was met, False on timeout
+    """
+    started = time.monotonic()
+    interval = POLL_FIRST_SECONDS
+    while True:
+        if condition():
+            logger.info(
+                "%s after %.1f seconds", description, time.monotonic() - started
+            )
+            return True
+        remaining = timeout - (time.monotonic() - started)
+        if remaining <= 0:
+            logger.info("Still waiting: %s", description)
+            return False
+        time.sleep(min(remaining, random.uniform(interval / 2, interval)))
+        interval = min(POLL_MAX_SECONDS, interval * POLL_GROWTH)
+
+
+def time_left(context, limit=None):
+    """
+    Seconds the handler may still wait, keeping DEADLINE_MARGIN_SECONDS to respond.
+    :param context: Lambda context
+    :param limit: Optional upper bound
+    :return: Seconds, at least 0
+    """
+    seconds = context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_MARGIN_SECONDS
+    if limit is not None:
+        seconds = min(seconds, limit)
+    return max(0, seconds)
+
+
+def run_with_dependencies(tasks, dependencies, max_workers=PUT_WORKERS):
+    """
+    Runs tasks concurrently on a bounded thread pool, each one only after the tasks it
+    depends on have finished.
+    Raises the first exception of a task; tasks that did not start yet are cancelled.
+    :param tasks: Map of task name to function taking the map of finished results
+    :param dependencies: Map of task name to the set of task names it depends on
+    :param max_workers: Maximum number of tasks running at the same time
+    :return: Map of task name to result
+    """
+    results = {}
+    waiting = {name: set(dependencies.get(name, ())) for name in tasks}
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+
+        def submit_ready():
+            for name in [name for name, needs in waiting.items() if not needs]:
+                del waiting[name]
+                running[executor.submit(tasks[name], results)] = name
+
+        submit_ready()
+        while running:
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for pending in running:
+                        pending.cancel()
+                    raise
+                for needs in waiting.values():
+                    needs.discard(name)
+            submit_ready()
+    if waiting:
+        raise ValueError("Unresolvable dependencies: " + ", ".join(sorted(waiting)))
+    return results
+
+
 def check_required_properties(dictionary, key):
     """
     Check if a key is present in dictionary,
@@ -51,149 +295,552 @@ def read_json_file_from_s3(bucket_name, object_key):
     """
     bucket = s3_resource.Bucket(bucket_name)
     lex_json_obj = bucket.Object(object_key)
-    return json.loads(lex_json_obj.get()["Body"].read().decode("utf-8"))
+    cached = s3_json_cache.get((bucket_name, object_key))
+    try:
+        if cached is not None:
+            response = lex_json_obj.get(IfNoneMatch=cached[0])
+        else:
+            response = lex_json_obj.get()
+    except botocore_exceptions.ClientError as error:
+        if cached is None or error.response["Error"]["Code"] not in (
+            "304",
+            "NotModified",
+        ):
+            raise
+        logger.info(
+            "s3://%s/%s is unchanged, using the cached copy", bucket_name, object_key
+        )
+        return copy.deepcopy(cached[1])
+    lex_json = json.loads(response["Body"].read().decode("utf-8"))
+    s3_json_cache[(bucket_name, object_key)] = (
+        response["ETag"],
+        copy.deepcopy(lex_json),
+    )
+    return lex_json
+
+
+class DeploymentPlan:
+    """
+    What a deployment does with each slot type, intent and the bot.
+    With dry_run set nothing is put, the plan is only recorded.
+    """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, action, version=None):
+        with self.lock:
+            self.entries.append(
+                {"kind": kind, "name": name, "action": action, "version": version}
+            )
+
+    def changes(self):
+        return [entry for entry in self.entries if entry["action"] != UNCHANGED]
+
+    def __str__(self):
+        lines = []
+        for kind in RESOURCE_KINDS:
+            for entry in sorted(self.entries, key=lambda entry: entry["name"]):
+                if entry["kind"] == kind:
+                    lines.append(
+                        "{:<9} {:<9} {}{}".format(
+                            entry["action"],
+                            kind,
+                            entry["name"],
+                            (
+                                " (version {})".format(entry["version"])
+                                if entry["version"]
+                                else ""
+                            ),
+                        )
+                    )
+        lines.append(
+            "{} change(s), {} unchanged".format(
+                len(self.changes()), len(self.entries) - len(self.changes())
+            )
+        )
+        return "\n".join(lines)
 
 
-def create_lex_intents(
+def normalize_definition(value):
+    """
+    Canonical form of a definition for hashing: empty values dropped and lists sorted,
+    since Lex does not preserve their order.
+    """
+    if isinstance(value, dict):
+        normalized = {key: normalize_definition(item) for key, item in value.items()}
+        return {
+            key: item
+            for key, item in normalized.items()
+            if item not in (None, "", [], {})
+        }
+    if isinstance(value, list):
+        return sorted(
+            (normalize_definition(item) for item in value),
+            key=lambda item: json.dumps(item, sort_keys=True),
+        )
+    return value
+
+
+def definition_hash(put_operation, definition):
+    """
+    Content hash of the parameters of a put operation in a definition,
+    the same for a local definition and the deployed one returned by the get operation.
+    :param put_operation: Name of the put operation, e.g. "PutIntent"
+    :param definition: Intent, slot type or bot definition
+    :return: SHA-256 hex digest
+    """
+    parameters = lex_client.meta.service_model.operation_model(
+        put_operation
+    ).input_shape.members
+    hashed = {
+        key: value
+        for key, value in definition.items()
+        if key in parameters and key not in UNHASHED_PARAMETERS
+    }
+    return hashlib.sha256(
+        json.dumps(
+            normalize_definition(hashed), sort_keys=True, separators=(",", ":")
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def list_versions(kind, name):
+    """
+    Numbered versions of a slot type, intent or bot, oldest first.
+    :param kind: "slotType", "intent" or "bot"
+    :param name: Name of the slot type, intent or bot
+    :return: List of versions
+    """
+    _, _, _, _, versions_method, versions_key = RESOURCE_KINDS[kind]
+    versions = []
+    parameters = {"name": name, "maxResults": 50}
+    while True:
+        response = call_lex(versions_method, **parameters)
+        versions.extend(
+            int(item["version"])
+            for item in response[versions_key]
+            if item["version"].isdigit()
+        )
+        if not response.get("nextToken"):
+            break
+        parameters["nextToken"] = response["nextToken"]
+    return [str(version) for version in sorted(versions)]
+
+
+def latest_version(kind, name):
+    """
+    Highest numbered version of a slot type, intent or bot.
+    :param kind: "slotType", "intent" or "bot"
+    :param name: Name of the slot type, intent or bot
+    :return: Version or None if there is no numbered version
+    """
+    versions = list_versions(kind, name)
+    return versions[-1] if versions else None
+
+
+def deploy_definition(kind, definition, plan):
+    """
+    Puts a slot type, intent or bot with createVersion=True unless the definition is
+    the same as the deployed $LATEST.
+    :param kind: "slotType", "intent" or "bot"
+    :param definition: Definition, updated in place with the put parameters
+    :param plan: DeploymentPlan recording the action
+    :return: New version, latest version if unchanged, NEW_VERSION in a dry run
+    """
+    get_method, version_parameter, put_method, put_operation, _, _ = RESOURCE_KINDS[
+        kind
+    ]
+    name = definition["name"]
+    definition.pop("version", None)
+    try:
+        deployed = call_lex(get_method, name=name, **{version_parameter: "$LATEST"})
+    except lex_client.exceptions.NotFoundException:
+        deployed = None
+
+    if deployed is not None and definition_hash(
+        put_operation, definition
+    ) == definition_hash(put_operation, deployed):
+        version = latest_version(kind, name)
+        if version is not None:
+            logger.info("%s %s is unchanged (version %s)", kind, name, version)
+            plan.record(kind, name, UNCHANGED, version)
+            return version
+
+    plan.record(kind, name, CREATE if deployed is None else UPDATE)
+    if plan.dry_run:
+        return NEW_VERSION
+    if deployed is not None:
+        definition["checksum"] = deployed["checksum"]
+    definition["createVersion"] = True
+    response = call_lex(put_method, **definition)
+    logger.info("Created/updated %s %s", kind, name)
+    return response["version"]
+
+
+def prepare_intent(
+    intent, fulfillment_lambda, kendra_search_role_arn, kendra_index_id, account_id
+):
+    """
+    Points the intent at the fulfillment Lambda and Kendra index of this stack.
+    :param intent: Lex intent, updated in place
+    :param fulfillment_lambda: ARN of fulfillment Lambda
+    :param kendra_search_role_arn: ARN of role created for creating custom Lex bot
+    :param kendra_index_id: Kendra Index ID
+    :param account_id: AWS Account ID
+    :return: None
+    """
+    if (
+        "parentIntentSignature" in intent
+        and intent["parentIntentSignature"] == "AMAZON.KendraSearchIntent"
+    ):
+        intent["kendraConfiguration"]["kendraIndex"] = (
+            "arn:aws:kendra:"
+            + os.environ["AWS_REGION"]
+            + ":"
+            + account_id
+            + ":index/"
+            + kendra_index_id
+        )
+        intent["kendraConfiguration"]["role"] = kendra_search_role_arn
+    intent.pop("version", None)
+    if intent["fulfillmentActivity"]["type"] == "CodeHook":
+        intent["fulfillmentActivity"]["codeHook"]["uri"] = fulfillment_lambda
+    if "dialogCodeHook" in intent:
+        intent["dialogCodeHook"]["uri"] = fulfillment_lambda
+
+
+def put_lex_intent(intent, slot_type_version, plan):
+    """
+    Creates or updates a Lex intent and creates a new version of it, if it changed.
+    :param intent: Lex intent, prepared with prepare_intent
+    :param slot_type_version: Map of Slot type versions.
+    :param plan: DeploymentPlan recording the action
+    :return: Intent version
+    """
+    for slot in intent.get("slots", []):
+        if "slotType" in slot and slot["slotType"] in slot_type_version:
+            slot["slotTypeVersion"] = slot_type_version[slot["slotType"]]
+    return deploy_definition("intent", intent, plan)
+
+
+def create_lex_intents_and_slot_types(
     fulfillment_lambda,
     intents,
+    slot_types,
     kendra_search_role_arn,
     kendra_index_id,
     account_id,
-    slot_type_version,
+    plan,
 ):
     """
-    Creates Lex intents.
+    Creates Lex slot types and intents concurrently, skipping the unchanged ones.
+    An intent is put as soon as the slot types it references are created.
     :param fulfillment_lambda: ARN of fulfillment Lambda
     :param intents: List of Lex intents
+    :param slot_types: List of Lex slot types
     :param kendra_search_role_arn: ARN of role created for creating custom Lex bot
     :param kendra_index_id: Kendra Index ID
     :param account_id: AWS Account ID
-    :param slot_type_version: Map of Slot type versions.
-    :return: List of intents (Name and Version)
+    :param plan: DeploymentPlan recording the actions
+    :return: List of intents (Name and Version), Map of Slot type versions
     """
-    intent_list = []
-    for intent in intents:
-        if "slots" in intent:
-            for slot in intent["slots"]:
-                if "slotType" in slot and slot["slotType"] in slot_type_version:
-                    slot["slotTypeVersion"] = slot_type_version[slot["slotType"]]
+    tasks = {}
+    dependencies = {}
+    for slot_type in slot_types:
+        tasks["slotType:" + slot_type["name"]] = (
+            lambda results, slot_type=slot_type: deploy_definition(
+                "slotType", slot_type, plan
+            )
+        )
+
+    def slot_type_version(results):
+        return {
+            name.split(":", 1)[1]: version
+            for name, version in results.items()
+            if name.startswith("slotType:")
+        }
 
+    for intent in intents:
         if intent["name"].startswith("AMAZON."):
             continue
-        if (
-            "parentIntentSignature" in intent
-            and intent["parentIntentSignature"] == "AMAZON.KendraSearchIntent"
-        ):
-            intent["kendraConfiguration"]["kendraIndex"] = (
-                "arn:aws:kendra:"
-                + os.environ["AWS_REGION"]
-                + ":"
-                + account_id
-                + ":index/"
-                + kendra_index_id
-            )
-            intent["kendraConfiguration"]["role"] = kendra_search_role_arn
-        intent.pop("version", None)
-        if intent["fulfillmentActivity"]["type"] == "CodeHook":
-            intent["fulfillmentActivity"]["codeHook"]["uri"] = fulfillment_lambda
-        if "dialogCodeHook" in intent:
-            intent["dialogCodeHook"]["uri"] = fulfillment_lambda
-        try:
-            intent_get_response = lex_client.get_intent(
-                name=intent["name"], version="$LATEST"
-            )
-            intent["checksum"] = intent_get_response["checksum"]
-        except lex_client.exceptions.NotFoundException:
-            pass
-        intent["createVersion"] = True
-        intent_response = lex_client.put_intent(**intent)
-        intent_list.append(
-            {"intentName": intent["name"], "intentVersion": intent_response["version"]}
+        prepare_intent(
+            intent,
+            fulfillment_lambda,
+            kendra_search_role_arn,
+            kendra_index_id,
+            account_id,
         )
-        logger.info("Created/updated intent %s", str(intent["name"]))
-    return intent_list
-
+        task_name = "intent:" + intent["name"]
+        tasks[task_name] = lambda results, intent=intent: put_lex_intent(
+            intent, slot_type_version(results), plan
+        )
+        dependencies[task_name] = {
+            "slotType:" + slot["slotType"]
+            for slot in intent.get("slots", [])
+            if "slotType:" + slot.get("slotType", "") in tasks
+        }
 
-def create_lex_slot_types(slot_types):
-    """
-    Creates Lex slot types.
-    :param slot_types: List of Lex slot types.
-    :return: Map of Slot type versions.
-    """
-    slot_type_version = {}
-    for slot_type in slot_types:
-        slot_type.pop("version", None)
-        try:
-            slot_get_response = lex_client.get_slot_type(
-                name=slot_type["name"], version="$LATEST"
-            )
-            slot_type["checksum"] = slot_get_response["checksum"]
-        except lex_client.exceptions.NotFoundException:
-            pass
-        slot_type["createVersion"] = True
-        slot_type_response = lex_client.put_slot_type(**slot_type)
-        slot_type_version[slot_type["name"]] = slot_type_response["version"]
-        logger.info("Created/updated slot type %s", str(slot_type["name"]))
-    return slot_type_version
+    results = run_with_dependencies(tasks, dependencies)
+    intent_list = [
+        {
+            "intentName": intent["name"],
+            "intentVersion": results["intent:" + intent["name"]],
+        }
+        for intent in intents
+        if "intent:" + intent["name"] in results
+    ]
+    return intent_list, slot_type_version(results)
 
 
 def create_lex_bot(
-    lex_bot, fulfillment_lambda, kendra_search_role_arn, kendra_index_id, account_id
+    lex_bot,
+    fulfillment_lambda,
+    kendra_search_role_arn,
+    kendra_index_id,
+    account_id,
+    plan=None,
 ):
     """
-    Creates Lex Bot.
+    Creates Lex Bot. Intents, slot types and the bot are only put if they changed.
     :param lex_bot: Bot description
     :param fulfillment_lambda: ARN of fulfillment Lambda
     :param kendra_search_role_arn: ARN of role created for creating custom Lex bot
     :param kendra_index_id: Kendra Index ID
     :param account_id: AWS Account ID
+    :param plan: DeploymentPlan, e.g. for a dry run
     :return: Lex Bot Name & version
     """
-    intent_list = []
-    slot_type_version = {}
-    if "slotTypes" in lex_bot:
-        slot_type_version = create_lex_slot_types(lex_bot["slotTypes"])
-        del lex_bot["slotTypes"]
-    if "intents" in lex_bot:
-        intent_list = create_lex_intents(
-            fulfillment_lambda,
-            lex_bot["intents"],
-            kendra_search_role_arn,
-            kendra_index_id,
-            account_id,
-            slot_type_version,
-        )
+    if plan is None:
+        plan = DeploymentPlan()
+    # every intent and slot type is created before the bot that references them
+    intent_list, _ = create_lex_intents_and_slot_types(
+        fulfillment_lambda,
+        lex_bot.get("intents", []),
+        lex_bot.pop("slotTypes", []),
+        kendra_search_role_arn,
+        kendra_index_id,
+        account_id,
+        plan,
+    )
     lex_bot["intents"] = intent_list
     lex_bot["processBehavior"] = "BUILD"
-    lex_bot["createVersion"] = True
-    lex_bot.pop("version", None)
+    bot_version = deploy_definition("bot", lex_bot, plan)
+    logger.info("Bot Name: %s", str(lex_bot["name"]))
+    logger.info("Deployment plan:\n%s", plan)
+
+    return lex_bot["name"], bot_version
+
+
+def versions_to_prune(versions, keep, protected):
+    """
+    Versions which are neither among the keep newest nor protected.
+    :param versions: Numbered versions, oldest first
+    :param keep: Number of newest versions to keep
+    :param protected: Set of versions to keep in any case
+    :return: List of versions
+    """
+    newest = set(versions[-keep:]) if keep > 0 else set()
+    return [
+        version
+        for version in versions
+        if version not in newest and version not in protected
+    ]
+
+
+def bot_alias_versions(bot_name):
+    """
+    Bot versions referenced by an alias.
+    :param bot_name: Lex Bot Name
+    :return: Set of versions
+    """
+    versions = set()
+    parameters = {"botName": bot_name, "maxResults": 50}
+    while True:
+        response = call_lex("get_bot_aliases", **parameters)
+        versions.update(alias["botVersion"] for alias in response["BotAliases"])
+        if not response.get("nextToken"):
+            break
+        parameters["nextToken"] = response["nextToken"]
+    return versions
+
+
+def delete_version(kind, name, version):
+    """
+    Deletes a numbered version of a slot type, intent or bot.
+    Versions still in use are left for a later run.
+    :param kind: "slotType", "intent" or "bot"
+    :param name: Name of the slot type, intent or bot
+    :param version: Version to delete
+    :return: True if the version was deleted
+    """
     try:
-        bot_get_response = lex_client.get_bot(
-            name=lex_bot["name"], versionOrAlias="$LATEST"
-        )
-        lex_bot["checksum"] = bot_get_response["checksum"]
+        call_lex(VERSION_DELETE_METHODS[kind], name=name, version=version)
+    except (
+        lex_client.exceptions.ConflictException,
+        lex_client.exceptions.ResourceInUseException,
+    ) as error:
+        logger.info("Keeping %s %s version %s: %s", kind, name, version, error)
+        return False
     except lex_client.exceptions.NotFoundException:
-        pass
-    bot_response = lex_client.put_bot(**lex_bot)
-    logger.info("Bot Name: %s", str(bot_response["name"]))
+        return False
+    logger.info("Deleted %s %s version %s", kind, name, version)
+    return True
+
+
+def past_deadline(deadline):
+    """
+    :param deadline: time.monotonic() value, or None for no deadline
+    :return: True if the deadline has passed
+    """
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def delete_versions(kind, versions_by_name, dry_run, deadline=None):
+    """
+    Deletes versions concurrently, throttled by the rate limiter.
+    Versions not started by the deadline are left for a later run.
+    :param kind: "slotType", "intent" or "bot"
+    :param versions_by_name: Map of name to the list of versions to delete
+    :param dry_run: Only log the versions
+    :param deadline: time.monotonic() value after which no delete is started, or None
+    :return: List of (kind, name, version) deleted
+    """
+    targets = [
+        (name, version)
+        for name, versions in sorted(versions_by_name.items())
+        for version in versions
+    ]
+    if dry_run:
+        for name, version in targets:
+            logger.info("Would delete %s %s version %s", kind, name, version)
+        return [(kind, name, version) for name, version in targets]
+    results = run_with_dependencies(
+        {
+            (name, version): lambda results, name=name, version=version: (
+                not past_deadline(deadline) and delete_version(kind, name, version)
+            )
+            for name, version in targets
+        },
+        {},
+    )
+    return [
+        (kind, name, version) for (name, version), deleted in results.items() if deleted
+    ]
+
+
+def prune_lex_versions(bot_name, keep=VERSION_RETENTION, dry_run=False, deadline=None):
+    """
+    Deletes old numbered versions of a bot and of its intents and slot types.
+    Keeps the keep newest versions of each, every bot version referenced by an alias,
+    and the intent and slot type versions referenced by a version that is kept.
+    Bot versions are deleted before the intent versions they use, intent versions
+    before slot type versions.
+    At the deadline it stops, deleting nothing it has not started yet; every run works
+    out the old versions afresh, so the next run carries on where this one stopped.
+    :param bot_name: Lex Bot Name
+    :param keep: Number of newest versions to keep of each
+    :param dry_run: Only log what would be deleted
+    :param deadline: time.monotonic() value to stop at, or None
+    :return: List of (kind, name, version) deleted
+    """
+    started_at = time.time()
+    bot_versions = list_versions("bot", bot_name)
+    pruned_bot_versions = versions_to_prune(
+        bot_versions, keep, bot_alias_versions(bot_name)
+    )
+
+    # intent versions used by the bot versions which are kept
+    used_intent_versions = {}
+    for version in ["$LATEST"] + bot_versions:
+        if version in pruned_bot_versions:
+            continue
+        if past_deadline(deadline):
+            return stop_pruning(bot_name, [], started_at)
+        bot = call_lex("get_bot", name=bot_name, versionOrAlias=version)
+        for intent in bot.get("intents", []):
+            used_intent_versions.setdefault(intent["intentName"], set()).add(
+                intent["intentVersion"]
+            )
+
+    pruned_intent_versions = {}
+    used_slot_type_versions = {}
+    for intent_name, used_versions in used_intent_versions.items():
+        intent_versions = list_versions("intent", intent_name)
+        pruned = versions_to_prune(intent_versions, keep, used_versions)
+        pruned_intent_versions[intent_name] = pruned
+        # slot type versions used by the intent versions which are kept
+        for version in ["$LATEST"] + intent_versions:
+            if version in pruned:
+                continue
+            if past_deadline(deadline):
+                return stop_pruning(bot_name, [], started_at)
+            intent = call_lex("get_intent", name=intent_name, version=version)
+            for slot in intent.get("slots", []):
+                if "slotTypeVersion" in slot:
+                    used_slot_type_versions.setdefault(slot["slotType"], set()).add(
+                        slot["slotTypeVersion"]
+                    )
+
+    pruned_slot_type_versions = {
+        slot_type: versions_to_prune(
+            list_versions("slotType", slot_type), keep, used_versions
+        )
+        for slot_type, used_versions in used_slot_type_versions.items()
+        if not slot_type.startswith("AMAZON.")
+    }
+
+    deleted = delete_versions("bot", {bot_name: pruned_bot_versions}, dry_run, deadline)
+    deleted += delete_versions("intent", pruned_intent_versions, dry_run, deadline)
+    deleted += delete_versions("slotType", pruned_slot_type_versions, dry_run, deadline)
+    if past_deadline(deadline):
+        return stop_pruning(bot_name, deleted, started_at)
+    logger.info(
+        "%s %d old version(s) of Lex bot %s and its intents and slot types in %.1f seconds",
+        "Would delete" if dry_run else "Deleted",
+        len(deleted),
+        bot_name,
+        time.time() - started_at,
+    )
+    return deleted
+
 
-    return bot_response["name"], bot_response["version"]
+def stop_pruning(bot_name, deleted, started_at):
+    """
+    Logs that pruning ran out of time.
+    :param bot_name: Lex Bot Name
+    :param deleted: List of (kind, name, version) deleted so far
+    :param started_at: time.time() when pruning started
+    :return: deleted
+    """
+    logger.info(
+        "Stopped pruning Lex bot %s after %.1f seconds with %d old version(s) deleted, "
+        "the next run continues",
+        bot_name,
+        time.time() - started_at,
+        len(deleted),
+    )
+    return deleted
 
 
 @helper.create
 @helper.update
-def create(event, _):
+def create(event, context):
     """
     Helper function for resource creation.
-    Populates Data with Lex Bot Name so poll_create helper can refer to it.
+    Waits for the bot to be ready as long as the Lambda timeout allows.
+    Otherwise populates Data with Lex Bot Name and hands off to crhelper polling,
+    so poll_create can refer to it.
     Raises Exception if required resource properties are missing.
     Any exception raised is displayed in CloudFormation console.
     :param event: Event body
-    :param _: Context (unused)
-    :return: None
+    :param context: Lambda context
+    :return: Physical Resource (Lex Bot Name) if the bot is ready, None otherwise
     """
     logger.info("Got Create")
+    started_at = time.time()
 
     if "ResourceProperties" not in event:
         raise ValueError("Please provide resource properties")
@@ -213,7 +860,7 @@ def create(event, _):
         event["ResourceProperties"]["LexS3Bucket"],
         event["ResourceProperties"]["LexFileKey"],
     )
-    
+
     lex_json["resource"]["name"] = event["ResourceProperties"]["LexBotName"]
 
     bot_name, bot_version = create_lex_bot(
@@ -226,6 +873,17 @@ def create(event, _):
 
     helper.Data["BotName"] = bot_name
     helper.Data["BotVersion"] = bot_version
+    helper.Data["StartedAt"] = "{:.3f}".format(started_at)
+
+    if not wait_until(
+        lambda: check_bot_status(bot_name),
+        time_left(context),
+        "Lex bot " + bot_name + " is ready",
+    ):
+        use_polling(True)
+        return None
+    finish_deployment(event, context, bot_name, bot_version, started_at)
+    return bot_name
 
 
 def check_bot_status(bot_name):
@@ -235,7 +893,7 @@ def check_bot_status(bot_name):
     :param bot_name: Lex Bot Name
     :return: True if index is Ready, False otherwise
     """
-    bot = lex_client.get_bot(name=bot_name, versionOrAlias="$LATEST")
+    bot = call_lex("get_bot", name=bot_name, versionOrAlias="$LATEST")
     status = bot["status"]
     if status == "FAILED":
         raise Exception(
@@ -250,35 +908,109 @@ def check_bot_status(bot_name):
     raise Exception("Lex Bot is in " + status + " state")
 
 
-@helper.poll_create
-@helper.poll_update
-def poll_create(event, _):
+def use_polling(enabled):
     """
-    Helper function for resource creation, triggered every 2 minutes till resource is created.
+    Registers poll_create with crhelper for create and update requests, or removes it.
+    crhelper only schedules polls while a poll function is registered, so the create
+    handler registers it when the bot is not ready in time and the poll invocations
+    register it before dispatching; a bot that is ready right away is reported at once.
+    :param enabled: True to register poll_create, False to remove it
+    """
+    poll_function = poll_create if enabled else None
+    helper.poll_create(poll_function)
+    helper.poll_update(poll_function)
+
+
+def poll_create(event, context):
+    """
+    Helper function for resource creation, triggered every minute till resource is created.
+    Each poll watches the bot status for up to POLL_INVOCATION_SECONDS.
     Any exception raised is displayed in CloudFormation console.
     :param event: Event body
-    :param _: Context (unused)
-    :return: None if Index is still being created.
-             Physical Resource (Kendra IndexId) upon successful completion.
+    :param context: Lambda context
+    :return: None if the bot is still being built.
+             Physical Resource (Lex Bot Name) upon successful completion.
     """
     logger.info("Got create poll")
     bot_name = event["CrHelperData"]["BotName"]
+
+    if not wait_until(
+        lambda: check_bot_status(bot_name),
+        time_left(context, POLL_INVOCATION_SECONDS),
+        "Lex bot " + bot_name + " is ready",
+    ):
+        return None
+    finish_deployment(
+        event,
+        context,
+        bot_name,
+        event["CrHelperData"]["BotVersion"],
+        event["CrHelperData"].get("StartedAt"),
+    )
+    return bot_name
+
+
+def finish_deployment(event, context, bot_name, bot_version, started_at):
+    """
+    Points the quickstart alias at the ready bot version and, on updates, prunes old
+    versions for as long as time_left() allows; what is left is pruned on the next
+    update. A failed pruning is logged but does not fail the stack update.
+    :param event: Event body
+    :param context: Lambda context
+    :param bot_name: Lex Bot Name
+    :param bot_version: Lex Bot version
+    :param started_at: time.time() when the operation started, or None
+    :return: None
+    """
+    put_quickstart_alias(bot_name, bot_version)
+    log_elapsed(event, started_at)
+    if event["RequestType"] == "Update":
+        seconds = time_left(context)
+        if seconds < PRUNE_MIN_SECONDS:
+            logger.info(
+                "Not pruning old versions of %s, %.1f seconds left", bot_name, seconds
+            )
+            return
+        try:
+            prune_lex_versions(bot_name, deadline=time.monotonic() + seconds)
+        except Exception as error:
+            logger.warning("Pruning old versions of %s failed: %s", bot_name, error)
+
+
+def put_quickstart_alias(bot_name, bot_version):
+    """
+    Points the quickstart alias at a bot version.
+    :param bot_name: Lex Bot Name
+    :param bot_version: Lex Bot version
+    :return: None
+    """
     bot_alias = {}
     bot_alias["name"] = "quickstart"
-    bot_alias["botVersion"] = event["CrHelperData"]["BotVersion"]
+    bot_alias["botVersion"] = bot_version
     bot_alias["botName"] = bot_name
-
-    if not check_bot_status(bot_name):
-        return None
     try:
-        bot_get_alias_response = lex_client.get_bot_alias(
-            name="quickstart", botName=bot_name
+        bot_get_alias_response = call_lex(
+            "get_bot_alias", name="quickstart", botName=bot_name
         )
         bot_alias["checksum"] = bot_get_alias_response["checksum"]
     except lex_client.exceptions.NotFoundException:
         pass
-    lex_client.put_bot_alias(**bot_alias)
-    return bot_name
+    call_lex_retrying_conflicts("put_bot_alias", **bot_alias)
+
+
+def log_elapsed(event, started_at):
+    """
+    Logs how long the stack operation on the bot took.
+    :param event: Event body
+    :param started_at: time.time() when the operation started, or None
+    :return: None
+    """
+    if started_at is not None:
+        logger.info(
+            "%s of the Lex bot took %.1f seconds",
+            event["RequestType"],
+            time.time() - float(started_at),
+        )
 
 
 def delete_intents(bot_name, intents):
@@ -293,16 +1025,15 @@ def delete_intents(bot_name, intents):
         try:
             if intent["intentName"].startswith("AMAZON."):
                 continue
-            intent_response = lex_client.get_intent(
-                name=intent["intentName"], version="$LATEST"
+            intent_response = call_lex(
+                "get_intent", name=intent["intentName"], version="$LATEST"
             )
             for slot in intent_response["slots"]:
                 if not slot["slotType"].startswith("AMAZON."):
                     slot_types.add(slot["slotType"])
-            lex_client.delete_intent(name=intent["intentName"])
-        except lex_client.exceptions.ConflictException:
-            time.sleep(SLEEP_TIME)
-            lex_client.delete_intent(name=intent["intentName"])
+            call_lex_retrying_conflicts("delete_intent", name=intent["intentName"])
+        except lex_client.exceptions.NotFoundException:
+            pass
         logger.info("Deleted intent %s of bot %s", str(intent["intentName"]), bot_name)
     return slot_types
 
@@ -316,10 +1047,9 @@ def delete_slot_types(bot_name, slot_types):
     """
     for slot_type in slot_types:
         try:
-            lex_client.delete_slot_type(name=slot_type)
-        except lex_client.exceptions.ConflictException:
-            time.sleep(SLEEP_TIME)
-            lex_client.delete_slot_type(name=slot_type)
+            call_lex_retrying_conflicts("delete_slot_type", name=slot_type)
+        except lex_client.exceptions.NotFoundException:
+            pass
         logger.info("Deleted slot type %s of bot %s", slot_type, bot_name)
 
 
@@ -329,55 +1059,165 @@ def delete_bot_aliases(bot_name):
     :param bot_name: Name of bot
     :return: None
     """
-    alias_response = lex_client.get_bot_aliases(botName=bot_name)
+    alias_response = call_lex("get_bot_aliases", botName=bot_name)
     for alias in alias_response["BotAliases"]:
         try:
-            lex_client.delete_bot_alias(name=alias["name"], botName=bot_name)
-        except lex_client.exceptions.ConflictException:
-            time.sleep(SLEEP_TIME)
-            lex_client.delete_bot_alias(name=alias["name"], botName=bot_name)
+            call_lex_retrying_conflicts(
+                "delete_bot_alias", name=alias["name"], botName=bot_name
+            )
+        except lex_client.exceptions.NotFoundException:
+            pass
         logger.info("Deleted bot alias %s of bot %s", alias["name"], bot_name)
 
 
-def delete_lex_bot(bot_name):
+def bot_deleted(bot_name):
+    """
+    Checks if a Lex Bot is gone.
+    :param bot_name: Lex Bot Name
+    :return: True if the bot does not exist
+    """
+    try:
+        call_lex("get_bot", name=bot_name, versionOrAlias="$LATEST")
+    except lex_client.exceptions.NotFoundException:
+        return True
+    return False
+
+
+def bot_aliases_deleted(bot_name):
+    """
+    Checks if a Lex Bot has no aliases left.
+    :param bot_name: Lex Bot Name
+    :return: True if the bot has no aliases
     """
-    Deletes Lex Bot.
+    return not call_lex("get_bot_aliases", botName=bot_name)["BotAliases"]
+
+
+def delete_lex_bot(bot_name, timeout):
+    """
+    Deletes Lex Bot and waits until it is gone.
     Note that associated intents and slot types are not deleted to properly support updates.
     An update which changes the bot name but uses one or more same intent or slot type names
     will cause issues otherwise.
     :param bot_name: Name of bot to be deleted
+    :param timeout: Maximum seconds to wait
     :return: None
     """
+    deadline = time.monotonic() + timeout
     # bot = lex_client.get_bot(name=bot_name, versionOrAlias='$LATEST')
     delete_bot_aliases(bot_name)
+    wait_until(
+        lambda: bot_aliases_deleted(bot_name),
+        deadline - time.monotonic(),
+        "Aliases of Lex bot " + bot_name + " are deleted",
+    )
     try:
-        lex_client.delete_bot(name=bot_name)
-    except lex_client.exceptions.ConflictException:
-        time.sleep(SLEEP_TIME)
-        lex_client.delete_bot(name=bot_name)
+        call_lex_retrying_conflicts("delete_bot", name=bot_name)
+    except lex_client.exceptions.NotFoundException:
+        pass
+    wait_until(
+        lambda: bot_deleted(bot_name),
+        deadline - time.monotonic(),
+        "Lex bot " + bot_name + " is deleted",
+    )
     # slot_types = delete_intents(bot_name, bot['intents'])
     # delete_slot_types(bot_name, slot_types)
 
 
 @helper.delete
-def delete(event, _):
+def delete(event, context):
     """
     Helper function for resource deletion.
     Should not fail if the underlying resources are already deleted.
     :param event: Event body
-    :param _: Context (unused)
+    :param context: Lambda context
     :return: None
     """
     logger.info("Got Delete")
-    delete_lex_bot(event["PhysicalResourceId"])
+    started_at = time.time()
+    delete_lex_bot(event["PhysicalResourceId"], time_left(context))
+    log_elapsed(event, started_at)
 
 
 def lambda_handler(event, context):
     print(event)
     """
     Base lambda handler.
+    Besides CloudFormation events it accepts {"PruneVersions": {"BotName": ..., "Keep": ...,
+    "DryRun": ...}} to prune old versions on its own, e.g. on a schedule.
     :param event: Event body passed to Lambda
     :param context: Context passed to Lambda
-    :return: None
+    :return: None, or the number of deleted versions when pruning
     """
+    if "PruneVersions" in event:
+        options = event["PruneVersions"]
+        return len(
+            prune_lex_versions(
+                options["BotName"],
+                int(options.get("Keep", VERSION_RETENTION)),
+                bool(options.get("DryRun", False)),
+                time.monotonic() + time_left(context),
+            )
+        )
+    use_polling("CrHelperData" in event)
     helper(event, context)
+
+
+def main():
+    """
+    Command line: "plan" prints what deploying a bot definition would change (dry run),
+    "prune" deletes old versions of a deployed bot.
+    Needs AWS_REGION and credentials allowed to read (and for prune, change) the Lex bot.
+    """
+    parser = argparse.ArgumentParser(description="Lex bot deployment tools.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser(
+        "plan", help="print the deployment plan of a bot definition (dry run)"
+    )
+    plan_parser.add_argument(
+        "bot_file", help="bot definition JSON, a local path or s3://bucket/key"
+    )
+    plan_parser.add_argument("--bot-name", help="LexBotName of the stack")
+    plan_parser.add_argument("--fulfillment-lambda", required=True)
+    plan_parser.add_argument("--kendra-search-role", required=True)
+    plan_parser.add_argument("--kendra-index", required=True)
+    plan_parser.add_argument("--account-id", required=True)
+    prune_parser = commands.add_parser(
+        "prune", help="delete old versions of a bot, its intents and slot types"
+    )
+    prune_parser.add_argument("bot_name")
+    prune_parser.add_argument("--keep", type=int, default=VERSION_RETENTION)
+    prune_parser.add_argument(
+        "--dry-run", action="store_true", help="only list the versions"
+    )
+    args = parser.parse_args()
+
+    if args.command == "prune":
+        for kind, name, version in prune_lex_versions(
+            args.bot_name, args.keep, args.dry_run
+        ):
+            print("{:<9} {} version {}".format(kind, name, version))
+        return
+
+    if args.bot_file.startswith("s3://"):
+        bucket_name, _, object_key = args.bot_file[len("s3://") :].partition("/")
+        lex_json = read_json_file_from_s3(bucket_name, object_key)
+    else:
+        with open(args.bot_file, encoding="utf-8") as bot_file:
+            lex_json = json.load(bot_file)
+    if args.bot_name:
+        lex_json["resource"]["name"] = args.bot_name
+
+    plan = DeploymentPlan(dry_run=True)
+    create_lex_bot(
+        lex_json["resource"],
+        args.fulfillment_lambda,
+        args.kendra_search_role,
+        args.kendra_index,
+        args.account_id,
+        plan,
+    )
+    print(plan)
+
+
+if __name__ == "__main__":
+    main()
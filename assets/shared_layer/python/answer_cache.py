@@ -0,0 +1,189 @@
+"""
+Answer cache for Kendra queries.
+
+A bounded in-memory LRU with per-entry TTL that survives warm invocations, backed by
+an optional second tier store so new containers can start warm.
+"""
+
+import collections
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+
+logger = logging.getLogger()
+
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_FILE = os.environ.get("ANSWER_CACHE_FILE")
+
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]+")
+
+_answer_cache = None
+
+
+def normalize_query(text):
+    """
+    Cache key for a query: Unicode NFKC, casefolded, punctuation and whitespace collapsed.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(PUNCTUATION_PATTERN.sub(" ", text).split())
+
+
+class DictStore:
+    """
+    In-process key-value store, a stand-in for a shared store such as DynamoDB or Redis.
+    Values are stored as (answer, expires_at) pairs.
+    """
+
+    def __init__(self):
+        self._items = {}
+
+    def get(self, key):
+        return self._items.get(key)
+
+    def set(self, key, value, expires_at):
+        self._items[key] = (value, expires_at)
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+
+class FileStore:
+    """
+    Key-value store kept in a JSON file, e.g. under /tmp. Writes are atomic and expired
+    entries are dropped whenever the file is rewritten.
+    """
+
+    def __init__(self, path, max_entries=ANSWER_CACHE_SIZE * 4):
+        self.path = path
+        self.max_entries = max_entries
+        self._items = None
+
+    def _load(self):
+        if self._items is None:
+            try:
+                with open(self.path, encoding="utf-8") as cache_file:
+                    self._items = json.load(cache_file)
+            except (OSError, ValueError):
+                self._items = {}
+        return self._items
+
+    def _save(self):
+        now = time.time()
+        items = {key: value for key, value in self._items.items() if value[1] > now}
+        if len(items) > self.max_entries:
+            by_expiry = sorted(items.items(), key=lambda item: item[1][1])
+            items = dict(by_expiry[len(by_expiry) - self.max_entries :])
+        self._items = items
+
+        temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(temp_path, "w", encoding="utf-8") as cache_file:
+                json.dump(items, cache_file)
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            logger.warning("Could not write answer cache file %s: %s", self.path, err)
+
+    def get(self, key):
+        value = self._load().get(key)
+        return tuple(value) if value is not None else None
+
+    def set(self, key, value, expires_at):
+        self._load()[key] = [value, expires_at]
+        self._save()
+
+    def delete(self, key):
+        if self._load().pop(key, None) is not None:
+            self._save()
+
+
+class AnswerCache:
+    """
+    LRU cache with per-entry TTL and an optional second tier store.
+    Keys are expected to be normalized with normalize_query().
+    """
+
+    def __init__(
+        self,
+        max_size=ANSWER_CACHE_SIZE,
+        ttl=ANSWER_CACHE_TTL,
+        store=None,
+        clock=time.time,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+                self.expirations += 1
+
+        if self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None and entry[1] > now:
+                with self._lock:
+                    self._put(key, entry[0], entry[1])
+                    self.store_hits += 1
+                return entry[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        expires_at = self.clock() + self.ttl
+        with self._lock:
+            self._put(key, value, expires_at)
+        if self.store is not None:
+            self.store.set(key, value, expires_at)
+
+    def _put(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def get_answer_cache():
+    """
+    Returns the module level answer cache, using ANSWER_CACHE_FILE as second tier if set.
+    """
+    global _answer_cache
+    if _answer_cache is None:
+        store = FileStore(ANSWER_CACHE_FILE) if ANSWER_CACHE_FILE else None
+        _answer_cache = AnswerCache(store=store)
+    return _answer_cache
@@ -0,0 +1,30 @@
+"""
+Shared AWS clients, created on first use.
+
+Importing boto3 and building a client costs a noticeable part of a cold start, and most
+turns (Greeting, ConfirmAppointment, ...) never call AWS. Clients are thread safe and
+reused across warm invocations, one per service.
+"""
+
+import threading
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name, config=None):
+    """
+    Returns the shared client of a service. config (a botocore.config.Config) is only used
+    by the call that creates the client.
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                import boto3
+
+                client = _clients[service_name] = boto3.client(
+                    service_name, config=config
+                )
+    return client
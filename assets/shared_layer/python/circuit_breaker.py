@@ -0,0 +1,173 @@
+"""
+Circuit breaker for calls to a degraded dependency.
+
+closed     calls go through; after failure_threshold consecutive failures the breaker opens
+open       calls are short-circuited until reset_timeout seconds have passed
+half-open  one trial call goes through; success closes the breaker, failure opens it again
+
+Only errors is_failure() accepts count as failures, by default the transient errors of
+an AWS call (is_transient_error): throttling, timeouts, connection errors and 5xx
+responses. Other errors, such as a parameter validation error or AccessDenied from a
+misconfigured index, are raised without changing the state: opening the breaker would
+not make them go away.
+
+The state is kept per Lambda container. Transitions and short circuits are counted as
+metrics named after the breaker, e.g. KendraBreakerOpened and KendraShortCircuits.
+"""
+
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+# error codes of ClientErrors that mean the service is overloaded, not that the call is wrong
+THROTTLING_ERROR_CODES = frozenset(
+    [
+        "Throttling",
+        "ThrottlingException",
+        "ThrottledException",
+        "RequestThrottledException",
+        "TooManyRequestsException",
+        "ProvisionedThroughputExceededException",
+        "RequestLimitExceeded",
+        "LimitExceededException",
+        "ServiceUnavailable",
+        "ServiceUnavailableException",
+        "RequestTimeout",
+        "RequestTimeoutException",
+    ]
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_transient_error(error):
+    """
+    True for throttling, timeouts, connection errors and 5xx responses of AWS calls.
+    """
+    from botocore import exceptions as botocore_exceptions
+
+    if isinstance(
+        error,
+        (
+            botocore_exceptions.ConnectionError,
+            botocore_exceptions.HTTPClientError,
+            TimeoutError,
+            ConnectionError,
+        ),
+    ):
+        return True
+    if isinstance(error, botocore_exceptions.ClientError):
+        response = error.response or {}
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        code = response.get("Error", {}).get("Code")
+        return status >= 500 or code in THROTTLING_ERROR_CODES
+    return False
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        clock=time.monotonic,
+        is_failure=is_transient_error,
+    ):
+        self.name = name
+        self.is_failure = is_failure
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.short_circuits = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        logger.warning(
+            "Circuit breaker %s: %s -> %s after %d failure(s)",
+            self.name,
+            self.state,
+            state,
+            self.failures,
+        )
+        self.state = state
+        metrics.count(
+            "{}Breaker{}".format(
+                self.name,
+                {CLOSED: "Closed", OPEN: "Opened", HALF_OPEN: "HalfOpened"}[state],
+            )
+        )
+
+    def allow(self):
+        """
+        Returns True if a call may go through now, counting a short circuit otherwise.
+        """
+        with self._lock:
+            if (
+                self.state == OPEN
+                and self.clock() - self.opened_at >= self.reset_timeout
+            ):
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED or (
+                self.state == HALF_OPEN and not self._trial_running
+            ):
+                self._trial_running = self.state == HALF_OPEN
+                return True
+            self.short_circuits += 1
+        metrics.count("{}ShortCircuits".format(self.name))
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_ignored(self):
+        """
+        Ends a call whose error does not count, e.g. a half-open trial, keeping the state.
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED and self.failures >= self.failure_threshold
+            ):
+                self.opened_at = self.clock()
+                self._transition(OPEN)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func through the breaker. Raises CircuitOpenError without calling it while open.
+        """
+        if not self.allow():
+            raise CircuitOpenError("Circuit breaker {} is open".format(self.name))
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            if self.is_failure(error):
+                self.record_failure()
+            else:
+                self.record_ignored()
+            raise
+        self.record_success()
+        return result
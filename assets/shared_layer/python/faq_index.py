@@ -0,0 +1,226 @@
+"""
+In-process FAQ answer index.
+
+Builds a BM25 index over the questions in the FAQ CSV files (the same files
+that are loaded into Kendra) so near-verbatim FAQ questions can be answered
+without a Kendra round trip.
+"""
+
+import csv
+import glob
+import logging
+import math
+import os
+import re
+
+logger = logging.getLogger()
+
+FAQ_PATH = os.environ.get("FAQ_PATH")
+FAQ_MATCH_THRESHOLD = float(os.environ.get("FAQ_MATCH_THRESHOLD", "0.8"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+_faq_index = None
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+class FaqIndex:
+    """
+    BM25 index over FAQ questions.
+
+    Scores are normalized to [0, 1] so a single threshold can be configured: the BM25
+    score of the query against a question is divided by the score the question gets
+    against itself, and weighted by the share of the query (by IDF) found in the question.
+    """
+
+    def __init__(self, entries):
+        self.entries = []
+        self._documents = []
+        seen = set()
+        for question, answer in entries:
+            tokens = tokenize(question)
+            key = " ".join(tokens)
+            if not tokens or key in seen:
+                continue
+            seen.add(key)
+            self.entries.append((question, answer))
+            self._documents.append(self._term_frequencies(tokens))
+
+        self._lengths = [sum(doc.values()) for doc in self._documents]
+        self._average_length = (
+            sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        )
+
+        document_frequency = {}
+        for doc in self._documents:
+            for term in doc:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        self._idf = {
+            term: self._inverse_document_frequency(count)
+            for term, count in document_frequency.items()
+        }
+        self._unknown_idf = self._inverse_document_frequency(0)
+
+        self._postings = {}
+        for doc_id, doc in enumerate(self._documents):
+            for term in doc:
+                self._postings.setdefault(term, []).append(doc_id)
+
+        self._self_scores = [
+            self._score(set(doc), doc_id) for doc_id, doc in enumerate(self._documents)
+        ]
+
+    @classmethod
+    def from_csv_files(cls, paths):
+        """
+        Build an index from Kendra FAQ CSV files (Question,Answer,URL with a header row).
+        """
+        entries = []
+        for path in paths:
+            with open(path, newline="", encoding="utf-8-sig") as csv_file:
+                for row in csv.DictReader(csv_file):
+                    question = (row.get("Question") or "").strip()
+                    answer = (row.get("Answer") or "").strip()
+                    if question and answer:
+                        entries.append((question, answer))
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _term_frequencies(tokens):
+        frequencies = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+        return frequencies
+
+    def _inverse_document_frequency(self, count):
+        total = len(self._documents)
+        return math.log(1 + (total - count + 0.5) / (count + 0.5))
+
+    def _score(self, query_terms, doc_id):
+        doc = self._documents[doc_id]
+        length_norm = BM25_K1 * (
+            1 - BM25_B + BM25_B * self._lengths[doc_id] / self._average_length
+        )
+        score = 0.0
+        for term in query_terms:
+            frequency = doc.get(term)
+            if frequency:
+                score += (
+                    self._idf[term]
+                    * frequency
+                    * (BM25_K1 + 1)
+                    / (frequency + length_norm)
+                )
+        return score
+
+    def search(self, query):
+        """
+        Return (score, question, answer) for the best matching FAQ entry, or None.
+        """
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return None
+
+        candidates = set()
+        for term in query_terms:
+            candidates.update(self._postings.get(term, ()))
+        if not candidates:
+            return None
+
+        query_weight = sum(
+            self._idf.get(term, self._unknown_idf) for term in query_terms
+        )
+
+        best = None
+        for doc_id in candidates:
+            matched_weight = sum(
+                self._idf[term]
+                for term in query_terms
+                if term in self._documents[doc_id]
+            )
+            score = (
+                self._score(query_terms, doc_id)
+                / self._self_scores[doc_id]
+                * matched_weight
+                / query_weight
+            )
+            if best is None or score > best[0]:
+                best = (score, doc_id)
+
+        score, doc_id = best
+        question, answer = self.entries[doc_id]
+        return score, question, answer
+
+    def lookup(self, query, threshold=FAQ_MATCH_THRESHOLD):
+        """
+        Return the answer of the best matching FAQ entry if its score passes the threshold.
+        """
+        match = self.search(query)
+        if match is None or match[0] < threshold:
+            return None
+        return match[2]
+
+
+def faq_csv_paths():
+    """
+    FAQ CSV files to index: FAQ_PATH (comma separated files or directories) if set,
+    otherwise a "faq" directory bundled next to this module (in the layer) or the assets/faq
+    directory of the repository (when run from a checkout).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    if FAQ_PATH:
+        locations = [location.strip() for location in FAQ_PATH.split(",")]
+    else:
+        locations = [
+            os.path.join(here, "faq"),
+            os.path.join(here, os.pardir, os.pardir, "faq"),
+        ]
+
+    paths = []
+    for location in locations:
+        if os.path.isdir(location):
+            paths.extend(sorted(glob.glob(os.path.join(location, "*.csv"))))
+            if paths and not FAQ_PATH:
+                break
+        elif os.path.isfile(location):
+            paths.append(location)
+    return paths
+
+
+def get_faq_index():
+    """
+    Returns the module level FAQ index, building it on first use.
+    """
+    global _faq_index
+    if _faq_index is None:
+        paths = faq_csv_paths()
+        try:
+            _faq_index = FaqIndex.from_csv_files(paths)
+        except (OSError, csv.Error) as err:
+            logger.warning("Could not load FAQ files %s: %s", paths, err)
+            _faq_index = FaqIndex([])
+        if not len(_faq_index):
+            logger.warning(
+                "The local FAQ index is empty (FAQ files: %s), every question goes to "
+                "Kendra and nothing can be answered while Kendra is down; bundle the FAQ "
+                "CSV files or set FAQ_PATH",
+                paths,
+            )
+        else:
+            logger.debug("Loaded %d FAQ entries from %s", len(_faq_index), paths)
+    return _faq_index
+
+
+def lookup_answer(question, threshold=FAQ_MATCH_THRESHOLD):
+    if not question:
+        return None
+    return get_faq_index().lookup(question, threshold)
@@ -0,0 +1,221 @@
+"""
+Answers to FAQ questions: the lookup chain of the AskKendraFAQ intent.
+
+    1. the local FAQ index (faq_index), for near-verbatim FAQ questions
+    2. the answer cache (answer_cache), and paraphrases of cached questions
+       (similar_questions)
+    3. Kendra, queried through a circuit breaker, with all KENDRA_INDEXES queried
+       concurrently
+    4. the local FAQ index with a slightly lower bar, when Kendra fails or the breaker
+       is open, and otherwise DEGRADED_ANSWER asking the user to try again later
+
+Part of the shared layer: the fulfillment Lambda answers AskKendraFAQ turns with it and
+the webhook uses it for its speculative queries, so both give the same answers.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+
+import answer_cache
+import aws_clients
+import circuit_breaker
+import faq_index
+import kendra_response
+import metrics
+import similar_questions
+
+logger = logging.getLogger()
+
+KENDRA_CONNECT_TIMEOUT = float(os.environ.get("KENDRA_CONNECT_TIMEOUT", "1"))
+KENDRA_READ_TIMEOUT = float(os.environ.get("KENDRA_READ_TIMEOUT", "3"))
+KENDRA_MAX_ATTEMPTS = int(os.environ.get("KENDRA_MAX_ATTEMPTS", "2"))
+KENDRA_RETRY_MODE = os.environ.get("KENDRA_RETRY_MODE", "standard")
+KENDRA_BREAKER_FAILURES = int(os.environ.get("KENDRA_BREAKER_FAILURES", "5"))
+KENDRA_BREAKER_RESET_SECONDS = float(
+    os.environ.get("KENDRA_BREAKER_RESET_SECONDS", "30")
+)
+# bar for local FAQ answers when Kendra is unavailable, a little below FAQ_MATCH_THRESHOLD:
+# much lower and unrelated questions get a confident wrong answer
+FAQ_FALLBACK_THRESHOLD = float(os.environ.get("FAQ_FALLBACK_THRESHOLD", "0.7"))
+DEGRADED_ANSWER = (
+    "Sorry, I can't look up answers right now. Please try again in a few minutes."
+)
+
+kendra_breaker = circuit_breaker.CircuitBreaker(
+    "Kendra", KENDRA_BREAKER_FAILURES, KENDRA_BREAKER_RESET_SECONDS
+)
+kendra_executor = None
+kendra_executor_lock = threading.Lock()
+
+
+def get_kendra_answer(question):
+    # answer near-verbatim FAQ questions locally, Kendra is only queried when there is no confident match
+    with metrics.span("FaqLookup"):
+        local_answer = faq_index.lookup_answer(question)
+    if local_answer is not None:
+        logger.debug(
+            "<<covid_help_desk_bot>> get_kendra_answer() - answered from local FAQ index"
+        )
+        return local_answer
+
+    kendra_indexes = get_kendra_indexes()
+    if not kendra_indexes:
+        return "Configuration error - please set the Kendra index IDs in the environment variable KENDRA_INDEXES (or KENDRA_INDEX)."
+
+    kendra_answer_cache = answer_cache.get_answer_cache()
+    cache_key = answer_cache.normalize_query(question)
+    cached_answer = kendra_answer_cache.get(cache_key)
+    if cached_answer is not None:
+        logger.debug(
+            "<<covid_help_desk_bot>> get_kendra_answer() - answer cache hit, stats = %s",
+            kendra_answer_cache.stats(),
+        )
+        return cached_answer
+
+    # a paraphrase of a question Kendra already answered reuses that answer
+    answered_questions = similar_questions.get_similar_questions()
+    with metrics.span("SimilarQuestionLookup"):
+        similar = answered_questions.find(cache_key)
+    if similar is not None:
+        similar_answer = kendra_answer_cache.get(similar[1])
+        if similar_answer is not None:
+            metrics.count("SimilarQuestionMatches")
+            logger.info(
+                'Answering "%s" with the cached answer of "%s" (similarity %.2f)',
+                cache_key,
+                similar[1],
+                similar[0],
+            )
+            return similar_answer
+        answered_questions.discard(similar[1])
+
+    try:
+        with metrics.span("KendraQuery"):
+            response = query_kendra_indexes(question, kendra_indexes)
+    except circuit_breaker.CircuitOpenError:
+        logger.debug(
+            "<<covid_help_desk_bot>> get_kendra_answer() - Kendra circuit open, answering from local FAQ"
+        )
+        return get_fallback_answer(question)
+    except Exception as err:
+        if circuit_breaker.is_transient_error(err):
+            logger.warning("Kendra query failed: %r", err)
+        else:
+            # not counted by the breaker, e.g. a wrong index ID or missing permission
+            logger.error("Kendra query rejected: %r", err)
+            metrics.count("KendraQueryErrors")
+        return get_fallback_answer(question)
+
+    logger.debug(
+        "<<covid_help_desk_bot>> get_kendra_answer() - response = "
+        + json.dumps(response)
+    )
+
+    answer = kendra_response.answer_from_response(response)
+    if answer is not None:
+        kendra_answer_cache.set(cache_key, answer)
+        answered_questions.add(cache_key)
+    logger.debug(
+        "<<covid_help_desk_bot>> get_kendra_answer() - answer cache stats = %s, similar questions = %s",
+        kendra_answer_cache.stats(),
+        answered_questions.stats(),
+    )
+    return answer
+
+
+def get_kendra_indexes():
+    """
+    IDs of the Kendra indexes to query: KENDRA_INDEXES (comma separated), or KENDRA_INDEX.
+    """
+    index_ids = os.environ.get("KENDRA_INDEXES") or os.environ.get("KENDRA_INDEX", "")
+    return [index_id.strip() for index_id in index_ids.split(",") if index_id.strip()]
+
+
+def kendra_concurrency():
+    """
+    Threads and pooled connections for the fan-out. Queries the fan-out stopped waiting for
+    keep running until they complete, so there are spare ones for the next turn.
+    """
+    return max(10, 2 * len(get_kendra_indexes()))
+
+
+def get_kendra_client():
+    from botocore.config import Config
+
+    return aws_clients.get_client(
+        "kendra",
+        Config(
+            connect_timeout=KENDRA_CONNECT_TIMEOUT,
+            read_timeout=KENDRA_READ_TIMEOUT,
+            retries={"max_attempts": KENDRA_MAX_ATTEMPTS, "mode": KENDRA_RETRY_MODE},
+            max_pool_connections=kendra_concurrency(),
+        ),
+    )
+
+
+def get_kendra_executor():
+    global kendra_executor
+    if kendra_executor is None:
+        with kendra_executor_lock:
+            if kendra_executor is None:
+                kendra_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=kendra_concurrency(),
+                    thread_name_prefix="kendra",
+                )
+    return kendra_executor
+
+
+def query_kendra_index(question, index_id):
+    return kendra_breaker.call(
+        get_kendra_client().query, IndexId=index_id, QueryText=question
+    )
+
+
+def query_kendra_indexes(question, index_ids):
+    """
+    Queries the indexes concurrently and returns their merged response, or the first
+    response with a high confidence FAQ answer without waiting for the slower indexes.
+    Raises the last error if no index answered.
+    """
+    if len(index_ids) == 1:
+        return query_kendra_index(question, index_ids[0])
+
+    futures = {
+        get_kendra_executor().submit(
+            metrics.bind(query_kendra_index), question, index_id
+        ): index_id
+        for index_id in index_ids
+    }
+    responses = []
+    error = None
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            response = future.result()
+        except Exception as err:
+            logger.warning("Kendra query of index %s failed: %r", futures[future], err)
+            error = err
+            continue
+        if kendra_response.is_confident_faq_answer(response):
+            for pending in futures:
+                pending.cancel()
+            return response
+        responses.append(response)
+
+    if not responses:
+        raise error
+    return kendra_response.merge_responses(responses)
+
+
+def get_fallback_answer(question):
+    """
+    Best local FAQ answer for when Kendra is unavailable, or DEGRADED_ANSWER.
+    """
+    with metrics.span("FaqLookup"):
+        answer = faq_index.lookup_answer(question, threshold=FAQ_FALLBACK_THRESHOLD)
+    if answer is None:
+        metrics.count("DegradedAnswers")
+        return DEGRADED_ANSWER
+    return answer
@@ -0,0 +1,114 @@
+"""
+Turns Kendra query responses into the reply sent to the user.
+
+Part of the shared layer used by the fulfillment and webhook Lambdas (the webhook queries
+Kendra speculatively).
+"""
+
+# result types, best first
+TYPE_PRECEDENCE = ("QUESTION_ANSWER", "ANSWER", "DOCUMENT")
+# ScoreAttributes.ScoreConfidence, best first
+CONFIDENCE_LEVELS = ("VERY_HIGH", "HIGH", "MEDIUM", "LOW", "NOT_AVAILABLE")
+CONFIDENT = ("VERY_HIGH", "HIGH")
+
+
+def _rank(levels, value):
+    return levels.index(value) if value in levels else len(levels)
+
+
+def result_rank(item):
+    """
+    Sort key of a result item: type precedence first, then confidence.
+    """
+    return (
+        _rank(TYPE_PRECEDENCE, item.get("Type")),
+        _rank(
+            CONFIDENCE_LEVELS,
+            item.get("ScoreAttributes", {}).get("ScoreConfidence"),
+        ),
+    )
+
+
+def is_confident_faq_answer(response):
+    """
+    True if the top result of the response is a high confidence FAQ answer.
+    """
+    try:
+        item = response["ResultItems"][0]
+    except (KeyError, IndexError):
+        return False
+    return (
+        item.get("Type") == "QUESTION_ANSWER"
+        and item.get("ScoreAttributes", {}).get("ScoreConfidence") in CONFIDENT
+    )
+
+
+def merge_responses(responses):
+    """
+    Merges the responses of several indexes into one response whose result items are
+    ordered by type precedence and confidence. Items of equal rank keep their order.
+    """
+    items = []
+    for response in responses:
+        items.extend(response.get("ResultItems", []))
+    return {"ResultItems": sorted(items, key=result_rank)}
+
+
+def answer_from_response(response):
+    #
+    # determine which is the top result from Kendra, based on the Type attribue
+    #  - QUESTION_ANSWER = a result from a FAQ: just return the FAQ answer
+    #  - ANSWER = text found in a document: return the text passage found in the document plus a link to the document
+    #  - DOCUMENT = link(s) to document(s): check for several documents and return the links
+    #
+
+    first_result_type = ""
+    try:
+        first_result_type = response["ResultItems"][0]["Type"]
+    except (KeyError, IndexError):
+        return None
+
+    if first_result_type == "QUESTION_ANSWER":
+        try:
+            faq_answer_text = response["ResultItems"][0]["DocumentExcerpt"]["Text"]
+        except KeyError:
+            faq_answer_text = "Sorry, I could not find an answer in our FAQs."
+
+        return faq_answer_text
+
+    elif first_result_type == "ANSWER":
+        # return the text answer from the document, plus the URL link to the document
+        try:
+            document_title = response["ResultItems"][0]["DocumentTitle"]["Text"]
+            document_excerpt_text = response["ResultItems"][0]["DocumentExcerpt"][
+                "Text"
+            ]
+            document_url = response["ResultItems"][0]["DocumentURI"]
+            answer_text = "I couldn't find a specific answer, but here's an excerpt from a document ("
+            answer_text += "<" + document_url + "|" + document_title + ">"
+            answer_text += ") that might help:\n\n" + document_excerpt_text + "...\n"
+        except KeyError:
+            answer_text = "Sorry, I could not find the answer in our documents."
+
+        return answer_text
+
+    elif first_result_type == "DOCUMENT":
+        # assemble the list of document links
+        document_list = "Here are some documents you could review:\n"
+        for item in response["ResultItems"]:
+            document_title = None
+            document_url = None
+            if item["Type"] == "DOCUMENT":
+                if item.get("DocumentTitle", None):
+                    if item["DocumentTitle"].get("Text", None):
+                        document_title = item["DocumentTitle"]["Text"]
+                if item.get("DocumentId", None):
+                    document_url = item["DocumentURI"]
+
+            if document_title is not None:
+                document_list += "-  <" + document_url + "|" + document_title + ">\n"
+
+        return document_list
+
+    else:
+        return None
@@ -0,0 +1,329 @@
+"""
+Per-stage latency metrics, emitted as one CloudWatch Embedded Metric Format (EMF) record
+per invocation.
+
+Stages are timed with spans:
+
+    with metrics.span("KendraQuery"):
+        ...
+
+    @metrics.timed("ResponseBuilding")
+    def close(...):
+        ...
+
+and the handler wraps the whole invocation:
+
+    with metrics.invocation(Intent=intent_name):
+        ...
+
+Other per-invocation values, such as payload sizes, are recorded with
+metrics.value("SessionStateBytes", size, "Bytes"), and events are counted with
+metrics.count("KendraShortCircuits").
+
+Timings are taken with time.perf_counter_ns() and summed per stage name. At the end of
+the invocation the record is written to stdout, where CloudWatch Logs extracts the
+metrics without any PutMetricData call. Nested spans with the name of a span that is
+already open are not counted twice.
+
+Every invocation records into its own buffer, held in a context variable. Work handed to
+another thread must be wrapped with metrics.bind() to record into the invocation that
+started it; whatever such a thread records after the invocation has been flushed is
+dropped rather than counted in the next invocation.
+
+Metrics are off unless METRICS_ENABLED is set; disabled spans are a shared no-op object.
+This module is part of the shared layer used by the fulfillment and webhook Lambdas.
+"""
+
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "CovidHelpDeskBot")
+SERVICE_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+_recorder = None
+
+
+class StdoutSink:
+    """
+    Writes records to stdout, one JSON document per line, as EMF expects.
+    """
+
+    def emit(self, record):
+        print(json.dumps(record, separators=(",", ":")))
+
+
+class MemorySink:
+    """
+    Keeps emitted records in a list, for tests.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("recorder", "name", "start")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.recorder._open(self.name)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed_ns = time.perf_counter_ns() - self.start
+        self.recorder._close(self.name)
+        self.recorder.add(self.name, elapsed_ns)
+        return False
+
+
+class _Buffer:
+    """
+    Stage timings and values of one invocation.
+    """
+
+    __slots__ = ("timings", "values", "lock", "closed")
+
+    def __init__(self):
+        self.timings = {}
+        self.values = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+
+class Recorder:
+    def __init__(
+        self,
+        enabled=METRICS_ENABLED,
+        sink=None,
+        namespace=METRICS_NAMESPACE,
+        service=SERVICE_NAME,
+    ):
+        self.enabled = enabled
+        self.sink = sink or StdoutSink()
+        self.namespace = namespace
+        self.service = service
+        # buffer of the current invocation, the default one outside of invocations
+        self._current = contextvars.ContextVar("metrics_buffer", default=None)
+        self._default = _Buffer()
+        self._local = threading.local()
+
+    def _buffer(self):
+        return self._current.get() or self._default
+
+    def _open_spans(self):
+        open_spans = getattr(self._local, "open_spans", None)
+        if open_spans is None:
+            open_spans = self._local.open_spans = set()
+        return open_spans
+
+    def _open(self, name):
+        self._open_spans().add(name)
+
+    def _close(self, name):
+        self._open_spans().discard(name)
+
+    def span(self, name):
+        if not self.enabled or name in self._open_spans():
+            return _NOOP_SPAN
+        return Span(self, name)
+
+    def add(self, name, elapsed_ns):
+        buffer = self._buffer()
+        with buffer.lock:
+            if not buffer.closed:
+                buffer.timings[name] = buffer.timings.get(name, 0) + elapsed_ns
+
+    def value(self, name, amount, unit="Count"):
+        """
+        Records a value of the current invocation, the last one recorded under a name wins.
+        """
+        if self.enabled:
+            buffer = self._buffer()
+            with buffer.lock:
+                if not buffer.closed:
+                    buffer.values[name] = (amount, unit)
+
+    def count(self, name, amount=1):
+        """
+        Adds to a counter of the current invocation.
+        """
+        if self.enabled:
+            buffer = self._buffer()
+            with buffer.lock:
+                if not buffer.closed:
+                    previous = buffer.values.get(name, (0, "Count"))[0]
+                    buffer.values[name] = (previous + amount, "Count")
+
+    def timings(self):
+        """
+        Stage timings of the current invocation, in nanoseconds.
+        """
+        buffer = self._buffer()
+        with buffer.lock:
+            return dict(buffer.timings)
+
+    def reset(self):
+        buffer = self._buffer()
+        with buffer.lock:
+            buffer.timings = {}
+            buffer.values = {}
+
+    def record(self, **dimensions):
+        """
+        Builds the EMF record of the current invocation, with stage timings in milliseconds.
+        """
+        dimensions = dict(dimensions, Service=self.service)
+        buffer = self._buffer()
+        with buffer.lock:
+            values = {
+                name: (elapsed_ns / 1e6, "Milliseconds")
+                for name, elapsed_ns in buffer.timings.items()
+            }
+            values.update(buffer.values)
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [sorted(dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, (_, unit) in values.items()
+                        ],
+                    }
+                ],
+            }
+        }
+        record.update(dimensions)
+        for name, (amount, _) in values.items():
+            record[name] = amount
+        return record
+
+    def flush(self, **dimensions):
+        if self.enabled:
+            self.sink.emit(self.record(**dimensions))
+        self.reset()
+
+    def invocation(self, **dimensions):
+        return _Invocation(self, dimensions)
+
+
+class _Invocation:
+    """
+    Times a whole invocation as the "Invocation" stage and flushes the record when it ends.
+    Dimensions can be added while the invocation runs, e.g. once the intent is known.
+    """
+
+    def __init__(self, recorder, dimensions):
+        self.recorder = recorder
+        self.dimensions = dimensions
+        self.start = 0
+        self.token = None
+
+    def __enter__(self):
+        if self.recorder.enabled:
+            self.token = self.recorder._current.set(_Buffer())
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.recorder.enabled:
+            self.recorder.add("Invocation", time.perf_counter_ns() - self.start)
+            self.recorder.flush(**self.dimensions)
+            buffer = self.recorder._buffer()
+            with buffer.lock:
+                # late records of threads started by this invocation are dropped
+                buffer.closed = True
+            self.recorder._current.reset(self.token)
+        return False
+
+
+def get_recorder():
+    """
+    Returns the module level recorder, writing to stdout.
+    """
+    global _recorder
+    if _recorder is None:
+        _recorder = Recorder()
+    return _recorder
+
+
+def set_recorder(recorder):
+    """
+    Replaces the module level recorder, e.g. with Recorder(enabled=True, sink=MemorySink()) in tests.
+    """
+    global _recorder
+    _recorder = recorder
+
+
+def span(name):
+    return get_recorder().span(name)
+
+
+def invocation(**dimensions):
+    return get_recorder().invocation(**dimensions)
+
+
+def value(name, amount, unit="Count"):
+    get_recorder().value(name, amount, unit)
+
+
+def count(name, amount=1):
+    get_recorder().count(name, amount)
+
+
+def bind(func):
+    """
+    Wraps func to record into the current invocation when it runs on another thread, e.g.
+    executor.submit(metrics.bind(query), question).
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def timed(name):
+    """
+    Decorator timing every call of the function as the given stage.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_recorder().span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,205 @@
+"""
+Near-duplicate matching of questions already answered by Kendra.
+
+Users phrase the same question in many ways ("Can I use WorkDocs on my mobile device?",
+"can i use amazon workdocs on my mobile device"). Each question answered by Kendra is
+added to a MinHash index over its token shingles (articles, pronouns and prepositions
+removed; question words, modals and negations kept, so "where is ..." never matches
+"when is ..."); a new question whose estimated Jaccard similarity to an answered one
+reaches SIMILAR_QUESTION_THRESHOLD reuses that question's cached answer instead of
+querying Kendra again.
+
+Candidates come from LSH buckets (SIMILAR_QUESTION_BANDS bands of SIMILAR_QUESTION_ROWS
+MinHash values each), and the best candidate is confirmed with the exact Jaccard
+similarity of the shingle sets, so a lookup touches a handful of entries. The most recent
+matches are kept as audit samples to spot false matches.
+"""
+
+import collections
+import functools
+import logging
+import os
+import random
+import threading
+import zlib
+
+import answer_cache
+
+logger = logging.getLogger()
+
+SIMILAR_QUESTION_THRESHOLD = float(os.environ.get("SIMILAR_QUESTION_THRESHOLD", "0.8"))
+SIMILAR_QUESTION_MAX_SIZE = int(os.environ.get("SIMILAR_QUESTION_MAX_SIZE", "1024"))
+SIMILAR_QUESTION_SHINGLE = int(os.environ.get("SIMILAR_QUESTION_SHINGLE", "1"))
+SIMILAR_QUESTION_BANDS = int(os.environ.get("SIMILAR_QUESTION_BANDS", "16"))
+SIMILAR_QUESTION_ROWS = int(os.environ.get("SIMILAR_QUESTION_ROWS", "4"))
+AUDIT_SAMPLES = 20
+SHINGLE_HASH_CACHE_SIZE = 4096
+
+# articles, pronouns and prepositions only: interrogatives ("where" vs "when"), modals
+# ("can" vs "should") and negations decide what a question asks and stay in the shingles
+STOP_WORDS = frozenset(
+    "a an and are at be do does for from i in is it me my of on or "
+    "the to we with you your".split()
+)
+
+# Mersenne prime for the universal hash family h(x) = (a * x + b) mod p
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_similar_questions = None
+
+
+def shingles(text, size=SIMILAR_QUESTION_SHINGLE):
+    """
+    Set of the size-word shingles of the normalized text without stop words.
+    """
+    words = [
+        word
+        for word in answer_cache.normalize_query(text).split()
+        if word not in STOP_WORDS
+    ]
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def jaccard(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+class SimilarQuestionIndex:
+    """
+    MinHash/LSH index over question keys, with LRU eviction beyond max_size.
+    """
+
+    def __init__(
+        self,
+        threshold=SIMILAR_QUESTION_THRESHOLD,
+        max_size=SIMILAR_QUESTION_MAX_SIZE,
+        bands=SIMILAR_QUESTION_BANDS,
+        rows=SIMILAR_QUESTION_ROWS,
+        seed=1,
+    ):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.bands = bands
+        self.rows = rows
+        generator = random.Random(seed)
+        self._coefficients = [
+            (generator.randrange(1, _PRIME), generator.randrange(0, _PRIME))
+            for _ in range(bands * rows)
+        ]
+        # the hash values of a shingle only depend on the shingle, and words recur a lot
+        self._shingle_hashes = functools.lru_cache(maxsize=SHINGLE_HASH_CACHE_SIZE)(
+            self._shingle_hashes
+        )
+        # key -> (shingles, band keys)
+        self._entries = collections.OrderedDict()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.matches = 0
+        self.audit = collections.deque(maxlen=AUDIT_SAMPLES)
+
+    def _shingle_hashes(self, shingle):
+        value = zlib.crc32(shingle.encode())
+        return tuple(
+            ((a * value + b) % _PRIME) & _MAX_HASH for a, b in self._coefficients
+        )
+
+    def _band_keys(self, shingle_set):
+        # the MinHash signature: per hash function the minimum over the shingles
+        signature = list(map(min, zip(*map(self._shingle_hashes, shingle_set))))
+        return [
+            (band, tuple(signature[band * self.rows : (band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def add(self, key):
+        """
+        Adds an answered question, normalized with answer_cache.normalize_query().
+        """
+        shingle_set = shingles(key)
+        if not shingle_set:
+            return
+        band_keys = self._band_keys(shingle_set)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = (shingle_set, band_keys)
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, band_keys = self._entries.pop(key)
+        for band_key in band_keys:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def find(self, key):
+        """
+        Returns (similarity, answered key) for the most similar answered question at or
+        above the threshold, or None.
+        """
+        shingle_set = shingles(key)
+        band_keys = self._band_keys(shingle_set) if shingle_set else []
+        best = None
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band_key in band_keys:
+                candidates.update(self._buckets.get(band_key, ()))
+            for candidate in candidates:
+                similarity = jaccard(shingle_set, self._entries[candidate][0])
+                if similarity >= self.threshold and (
+                    best is None or similarity > best[0]
+                ):
+                    best = (similarity, candidate)
+            if best is not None:
+                self.matches += 1
+                self._entries.move_to_end(best[1])
+                self.audit.append(
+                    {"query": key, "match": best[1], "similarity": round(best[0], 3)}
+                )
+        return best
+
+    def __len__(self):
+        return len(self._entries)
+
+    def match_rate(self):
+        return self.matches / self.lookups if self.lookups else 0.0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "match_rate": round(self.match_rate(), 3),
+        }
+
+    def audit_samples(self):
+        """
+        The most recent matches, to check by hand that they really are paraphrases.
+        """
+        with self._lock:
+            return list(self.audit)
+
+
+def get_similar_questions():
+    global _similar_questions
+    if _similar_questions is None:
+        _similar_questions = SimilarQuestionIndex()
+    return _similar_questions
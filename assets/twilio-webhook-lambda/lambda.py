@@ -1,64 +1,334 @@
 import json
+import math
 import os
+import time
 import boto3
 from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
+import session_cache
+import work_queue
+import metrics
+import speculation
 
 BOT_NAME = os.environ.get("BOT_NAME")
 BOT_ALIAS = os.environ.get("BOT_ALIAS")
 
+# "sync" replies in the webhook response, "deferred" queues the message and replies through the Twilio REST API
+REPLY_MODE = os.environ.get("REPLY_MODE", "sync")
+WORK_QUEUE_URL = os.environ.get("WORK_QUEUE_URL")
+# merge bursts of messages from the same user into one Lex turn (deferred mode only)
+COALESCE_WINDOW_MS = int(os.environ.get("COALESCE_WINDOW_MS", "0"))
+# receives after which an SQS message is handled even if its user is still typing
+COALESCE_MAX_RECEIVES = int(os.environ.get("COALESCE_MAX_RECEIVES", "3"))
+# explicit opt-in to the in-process work queue when running in Lambda
+LOCAL_WORK_QUEUE = os.environ.get("LOCAL_WORK_QUEUE", "false").lower() == "true"
+TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
+
 lex_client = boto3.client("lex-runtime")
+twilio_client = None
+message_queue = None
 
 
-def lambda_handler(event, context):
-    print(event)
+def initial_session_attributes(profile_name):
+    """
+    Session attributes for a user without a Lex session: remember the WhatsApp profile name as FullName.
+    """
+    remembered_slots = json.dumps(
+        {
+            "VaccineType": None,
+            "FullName": profile_name,
+            "Result": None,
+            "ContactResult": None,
+            "CurrentCondition": None,
+            "Date": None,
+            "Time": None,
+        }
+    )
+    return {"rememberedSlots": remembered_slots}
 
-    xml_response = MessagingResponse()
 
-    profile_name = event["data"]["ProfileName"]
-    incoming_message = event["data"]["Body"]
-    from_number = event["data"]["From"]
-    num_media = event["data"]["NumMedia"]
+def session_attributes_size(session_attributes):
+    """
+    Size in bytes of the session attributes sent to post_text, Lex allows 12 KB.
+    """
+    return sum(
+        len(name.encode()) + len(str(value).encode())
+        for name, value in session_attributes.items()
+    )
+
+
+def get_twilio_client():
+    global twilio_client
+    if twilio_client is None:
+        twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    return twilio_client
+
+
+def get_message_queue():
+    """
+    Work queue for deferred replies: the SQS FIFO queue WORK_QUEUE_URL if set,
+    otherwise an in-process queue (for local runs and tests). In Lambda the in-process
+    queue would be frozen once the handler returns, so it needs LOCAL_WORK_QUEUE there.
+    """
+    global message_queue
+    if message_queue is None:
+        if WORK_QUEUE_URL:
+            message_queue = work_queue.SqsWorkQueue(WORK_QUEUE_URL)
+        elif os.environ.get("AWS_LAMBDA_FUNCTION_NAME") and not LOCAL_WORK_QUEUE:
+            raise ValueError(
+                "REPLY_MODE deferred needs WORK_QUEUE_URL in Lambda, the in-process "
+                "queue stops when the invocation ends (set LOCAL_WORK_QUEUE=true to use it anyway)"
+            )
+        else:
+            message_queue = work_queue.LocalWorkQueue(
+                handle_queued_message, coalesce_window=COALESCE_WINDOW_MS / 1000.0
+            )
+    return message_queue
+
+
+def post_to_lex(user_id, profile_name, incoming_message, raise_errors=False):
+    """
+    Sends the user's message to Lex and returns the reply text. A failed post_text
+    returns an apology, or raises with raise_errors so a queued message is redelivered.
+    """
+    # session attributes returned by the previous post_text save a get_session round trip
+    sessions = session_cache.get_session_cache()
+    with metrics.span("SessionCacheLookup"):
+        session_attributes = sessions.get(user_id)
+    if session_attributes is None:
+        try:
+            with metrics.span("LexGetSession"):
+                lex_session = lex_client.get_session(
+                    botName=BOT_NAME, botAlias=BOT_ALIAS, userId=user_id
+                )
+            session_attributes = speculation.strip_marker(
+                lex_session.get("sessionAttributes", {})
+            )
 
-    from_number = from_number.replace("+", "")
+        except Exception as e:
+            session_attributes = initial_session_attributes(profile_name)
 
+    # a question may be answered by Kendra: start the query while Lex handles the turn
+    speculative_query = speculation.start(incoming_message)
+    if speculative_query is not None:
+        session_attributes = dict(
+            session_attributes, **{speculation.SESSION_ATTRIBUTE: "1"}
+        )
+
+    metrics.value(
+        "SessionAttributesBytes", session_attributes_size(session_attributes), "Bytes"
+    )
+    lex_response = None
     try:
-        lex_session = lex_client.get_session(
-            botName=BOT_NAME, botAlias=BOT_ALIAS, userId=from_number
+        with metrics.span("LexPostText"):
+            lex_response = lex_client.post_text(
+                botName=BOT_NAME,
+                botAlias=BOT_ALIAS,
+                userId=user_id,
+                inputText=incoming_message,
+                sessionAttributes=session_attributes,
+            )
+        print(lex_response)
+        session_attributes = speculation.strip_marker(
+            lex_response.get("sessionAttributes", {})
         )
-        session_attributes = lex_session.get("sessionAttributes", {})
+        sessions.set(user_id, session_attributes)
+        resp_message = lex_response.get("message", "Empty....")
 
     except Exception as e:
-        remembered_slots = json.dumps(
-            {
-                "VaccineType": None,
-                "FullName": profile_name,
-                "Result": None,
-                "ContactResult": None,
-                "CurrentCondition": None,
-                "Date": None,
-                "Time": None,
-            }
+        print(e)
+        sessions.delete(user_id)
+        if raise_errors:
+            speculation.resolve(speculative_query, None)
+            raise
+        resp_message = "Sorry, we ran into a problem at our LEX end."
+
+    speculative_reply = speculation.resolve(speculative_query, lex_response)
+    if speculative_reply is not None:
+        resp_message = speculative_reply
+
+    return resp_message
+
+
+def send_reply(message, resp_message):
+    with metrics.span("TwilioSend"):
+        get_twilio_client().messages.create(
+            from_=message["To"], to=message["From"], body=resp_message
         )
 
-        session_attributes = {"rememberedSlots": remembered_slots}
 
+def handle_queued_message(message):
+    """
+    Worker for deferred replies: posts the message to Lex and sends the reply with the Twilio REST client.
+    Lex errors propagate, so SQS redelivers the message. A reply Twilio did not take is
+    queued on its own ("Reply" message), so retrying it does not post the turn to Lex again.
+    """
+    if "Reply" in message:
+        send_reply(message, message["Reply"])
+        return
+
+    resp_message = post_to_lex(
+        message["userId"], message["ProfileName"], message["Body"], raise_errors=True
+    )
     try:
-        lex_response = lex_client.post_text(
-            botName=BOT_NAME,
-            botAlias=BOT_ALIAS,
-            userId=from_number,
-            inputText=incoming_message,
-            sessionAttributes=session_attributes,
+        send_reply(message, resp_message)
+    except Exception as e:
+        if not WORK_QUEUE_URL:
+            raise
+        print(e)
+        metrics.count("TwilioSendRequeued")
+        reply = {
+            "userId": message["userId"],
+            "From": message["From"],
+            "To": message["To"],
+            "Reply": resp_message,
+        }
+        if message.get("MessageSid"):
+            # deduplicated apart from the message it answers
+            reply["MessageSid"] = message["MessageSid"] + ":reply"
+        get_message_queue().put(reply)
+
+
+def queued_turns(user_records):
+    """
+    (message ids, message) per Lex turn of one user's (message id, message) records.
+    With COALESCE_WINDOW_MS consecutive messages are merged into one turn; queued
+    replies are never merged.
+    """
+    groups = []
+    for message_id, message in user_records:
+        if (
+            groups
+            and COALESCE_WINDOW_MS
+            and "Reply" not in message
+            and "Reply" not in groups[-1][-1][1]
+        ):
+            groups[-1].append((message_id, message))
+        else:
+            groups.append([(message_id, message)])
+    return [
+        (
+            [message_id for message_id, _ in group],
+            (
+                group[0][1]
+                if "Reply" in group[0][1]
+                else work_queue.merge_messages([message for _, message in group])
+            ),
         )
-        print(lex_response)
-        session_attributes = lex_response.get("sessionAttributes", {})
-        resp_message = lex_response.get("message", "Empty....")
+        for group in groups
+    ]
 
+
+def defer_until_quiet(user_records):
+    """
+    Puts one user's SQS records back on the queue until the user has been quiet for
+    COALESCE_WINDOW_MS, so the messages that arrive meanwhile are handled in the same
+    batch and merged. FIFO event source mappings have no batching window, and while the
+    records are invisible the user's message group stays blocked, keeping the order.
+    Returns True if the records were deferred.
+    """
+    sent = [
+        int(record["attributes"]["SentTimestamp"])
+        for record, message in user_records
+        if "Reply" not in message and "SentTimestamp" in record.get("attributes", {})
+    ]
+    if not sent:
+        return False
+    quiet_ms = time.time() * 1000 - max(sent)
+    receives = max(
+        int(record.get("attributes", {}).get("ApproximateReceiveCount", "1"))
+        for record, _ in user_records
+    )
+    if quiet_ms >= COALESCE_WINDOW_MS or receives >= COALESCE_MAX_RECEIVES:
+        return False
+    try:
+        get_message_queue().defer(
+            [record["receiptHandle"] for record, _ in user_records],
+            math.ceil((COALESCE_WINDOW_MS - quiet_ms) / 1000),
+        )
     except Exception as e:
         print(e)
-        resp_message = "Sorry, we ran into a problem at our LEX end."
+        return False
+    metrics.count("CoalesceDeferrals")
+    return True
+
+
+def handle_records(records):
+    """
+    Handles the messages of an SQS batch user by user and reports the failed records, so
+    SQS only redelivers those (the event source mapping needs ReportBatchItemFailures).
+    After a failure the user's later messages are reported too, to keep their order.
+    With COALESCE_WINDOW_MS the records of a user who is not quiet yet are deferred.
+    """
+    failed = []
+    deferred = []
+    for user_records in work_queue.group_by_user(
+        (record, json.loads(record["body"])) for record in records
+    ):
+        if COALESCE_WINDOW_MS and defer_until_quiet(user_records):
+            deferred.extend(record["messageId"] for record, _ in user_records)
+            continue
+        turns = queued_turns(
+            [(record["messageId"], message) for record, message in user_records]
+        )
+        for index, (message_ids, message) in enumerate(turns):
+            try:
+                handle_queued_message(message)
+            except Exception as e:
+                print(e)
+                failed.extend(
+                    message_id
+                    for message_ids, _ in turns[index:]
+                    for message_id in message_ids
+                )
+                break
+    if failed:
+        metrics.count("QueuedMessageFailures", len(failed))
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": item} for item in deferred + failed
+        ]
+    }
+
+
+def lambda_handler(event, context):
+    print(event)
+
+    with metrics.invocation(Source="sqs" if "Records" in event else "webhook"):
+        return handle_event(event)
+
+
+def handle_event(event):
+
+    # deferred replies: messages delivered by the SQS event source mapping, in order per user
+    if "Records" in event:
+        return handle_records(event["Records"])
+
+    xml_response = MessagingResponse()
+
+    profile_name = event["data"]["ProfileName"]
+    incoming_message = event["data"]["Body"]
+    from_number = event["data"]["From"]
+    num_media = event["data"]["NumMedia"]
+
+    user_id = from_number.replace("+", "")
 
-    xml_response.message(resp_message)
+    if REPLY_MODE == "deferred":
+        with metrics.span("QueuePut"):
+            get_message_queue().put(
+                {
+                    "userId": user_id,
+                    "ProfileName": profile_name,
+                    "Body": incoming_message,
+                    "From": from_number,
+                    "To": event["data"]["To"],
+                    "MessageSid": event["data"].get("MessageSid"),
+                }
+            )
+        return str(xml_response)
 
-    return str(xml_response)
+    resp_message = post_to_lex(user_id, profile_name, incoming_message)
+    with metrics.span("TwimlBuild"):
+        xml_response.message(resp_message)
+        return str(xml_response)
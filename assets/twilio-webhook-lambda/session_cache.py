@@ -0,0 +1,170 @@
+"""
+Cache of Lex session attributes by WhatsApp user.
+
+post_text already returns the session attributes after every turn, so keeping them
+avoids a get_session round trip before the next message. Entries expire after
+SESSION_CACHE_TTL seconds, which should match the bot's idleSessionTTLInSeconds.
+
+Both tiers are local to one Lambda container. A user's messages may be handled by
+different containers, and a container holding an older entry would send it back to
+post_text and overwrite the newer Lex session state, so get_session stays the source of
+truth: the cache is off unless SESSION_CACHE_ENABLED is set, which is only safe when one
+container handles all messages (e.g. local runs, or reserved concurrency of 1).
+"""
+
+import collections
+import dbm
+import json
+import os
+import threading
+import time
+
+SESSION_CACHE_ENABLED = os.environ.get("SESSION_CACHE_ENABLED", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "1024"))
+SESSION_CACHE_TTL = int(os.environ.get("SESSION_CACHE_TTL", "300"))
+SESSION_CACHE_FILE = os.environ.get("SESSION_CACHE_FILE")
+
+_session_cache = None
+
+
+class MemorySessionCache:
+    """
+    In-memory LRU cache with a TTL, kept across warm invocations.
+    """
+
+    def __init__(
+        self, max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL, clock=time.time
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self.get_entry(user_id)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, user_id):
+        """
+        Returns (session attributes, expires_at), or None if missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[1] <= self.clock():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return dict(entry[0]), entry[1]
+
+    def set(self, user_id, session_attributes, expires_at=None):
+        if expires_at is None:
+            expires_at = self.clock() + self.ttl
+        with self._lock:
+            self._entries[user_id] = (dict(session_attributes), expires_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+class KeyValueSessionCache:
+    """
+    Session cache in a local dbm key-value file, a stand-in for a shared store such as
+    DynamoDB or Redis.
+    """
+
+    def __init__(self, path, ttl=SESSION_CACHE_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self.get_entry(user_id)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, user_id):
+        """
+        Returns (session attributes, expires_at), or None if missing or expired.
+        """
+        with self._lock, dbm.open(self.path, "c") as store:
+            value = store.get(user_id)
+        if value is None:
+            return None
+        entry = json.loads(value)
+        if entry["expires_at"] <= self.clock():
+            self.delete(user_id)
+            return None
+        return entry["sessionAttributes"], entry["expires_at"]
+
+    def set(self, user_id, session_attributes, expires_at=None):
+        if expires_at is None:
+            expires_at = self.clock() + self.ttl
+        value = json.dumps(
+            {"sessionAttributes": session_attributes, "expires_at": expires_at}
+        )
+        with self._lock, dbm.open(self.path, "c") as store:
+            store[user_id] = value
+
+    def delete(self, user_id):
+        with self._lock, dbm.open(self.path, "c") as store:
+            if user_id in store:
+                del store[user_id]
+
+
+class TieredSessionCache:
+    """
+    Looks up the in-memory tier first and falls back to the key-value tier. Entries found
+    in a slower tier are copied to the faster ones with their original expiry.
+    """
+
+    def __init__(self, *tiers):
+        self.tiers = tiers
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        for index, tier in enumerate(self.tiers):
+            entry = tier.get_entry(user_id)
+            if entry is not None:
+                session_attributes, expires_at = entry
+                for faster_tier in self.tiers[:index]:
+                    faster_tier.set(user_id, session_attributes, expires_at)
+                self.hits += 1
+                return session_attributes
+        self.misses += 1
+        return None
+
+    def set(self, user_id, session_attributes):
+        for tier in self.tiers:
+            tier.set(user_id, session_attributes)
+
+    def delete(self, user_id):
+        for tier in self.tiers:
+            tier.delete(user_id)
+
+
+def get_session_cache():
+    """
+    Returns the module level session cache, with SESSION_CACHE_FILE as second tier if set.
+    Without SESSION_CACHE_ENABLED it has no tiers: every lookup misses and sets are dropped.
+    """
+    global _session_cache
+    if _session_cache is None:
+        tiers = []
+        if SESSION_CACHE_ENABLED:
+            tiers.append(MemorySessionCache())
+            if SESSION_CACHE_FILE:
+                tiers.append(KeyValueSessionCache(SESSION_CACHE_FILE))
+        _session_cache = TieredSessionCache(*tiers)
+    return _session_cache
@@ -0,0 +1,182 @@
+"""
+Speculative Kendra queries.
+
+A FAQ turn is serial: webhook -> Lex -> fulfillment Lambda -> Kendra. When a message looks
+like a question, the webhook starts the lookup in a thread before calling post_text and
+tells the fulfillment Lambda with the speculativeKendra session attribute, so its
+AskKendraFAQ handler skips its own query. If Lex routes the turn to AskKendraFAQ, the
+speculative answer is the reply; otherwise the speculation was wasted.
+
+The lookup is kendra_answers.get_kendra_answer from the shared layer, the one the
+fulfillment Lambda uses: local FAQ index, answer cache, circuit breaker, then the
+KENDRA_INDEXES fan-out.
+
+Speculation only saves time when AskKendraFAQ has a fulfillment code hook. When Lex
+answers the intent itself (a built-in KendraSearchIntent), the marker comes back in the
+session attributes untouched by the Lambda; speculation then turns itself off for the
+lifetime of the container and Lex's reply is kept.
+
+The outcomes are counted (KendraSpeculationUsed, KendraSpeculationWasted,
+KendraSpeculationFailed) so the question heuristic can be tuned.
+"""
+
+import collections
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import kendra_answers
+import metrics
+
+logger = logging.getLogger()
+
+SPECULATIVE_KENDRA = os.environ.get("SPECULATIVE_KENDRA", "false").lower() == "true"
+# how long to wait for the speculative answer once Lex has answered
+SPECULATION_TIMEOUT_MS = int(os.environ.get("SPECULATION_TIMEOUT_MS", "3000"))
+SPECULATION_WORKERS = int(os.environ.get("SPECULATION_WORKERS", "4"))
+
+FAQ_INTENT = "AskKendraFAQ"
+SESSION_ATTRIBUTE = "speculativeKendra"
+QUESTION_WORDS = ("where", "how", "what", "can")
+NO_ANSWER = "Sorry, I was not able to understand your question."
+
+USED = "used"
+WASTED = "wasted"
+FAILED = "failed"
+
+Speculation = collections.namedtuple("Speculation", ["question", "future"])
+
+_executor = None
+_lock = threading.Lock()
+# set when a FAQ turn showed that AskKendraFAQ has no code hook
+_no_code_hook = False
+
+
+class SpeculationStats:
+    def __init__(self):
+        self.started = 0
+        self.outcomes = {USED: 0, WASTED: 0, FAILED: 0}
+        self._lock = threading.Lock()
+
+    def record_start(self):
+        with self._lock:
+            self.started += 1
+
+    def record(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] += 1
+        metrics.count("KendraSpeculation" + outcome.capitalize())
+
+    def wasted_rate(self):
+        finished = sum(self.outcomes.values())
+        return self.outcomes[WASTED] / finished if finished else 0.0
+
+    def as_dict(self):
+        return dict(self.outcomes, started=self.started, wasted_rate=self.wasted_rate())
+
+
+stats = SpeculationStats()
+
+
+def looks_like_question(text):
+    """
+    True if the message ends with "?" or starts with one of QUESTION_WORDS.
+    """
+    text = (text or "").strip().lower()
+    if not text:
+        return False
+    return text.endswith("?") or text.split(None, 1)[0] in QUESTION_WORDS
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=SPECULATION_WORKERS,
+                    thread_name_prefix="speculative-kendra",
+                )
+    return _executor
+
+
+def query(question):
+    with metrics.span("SpeculativeKendraQuery"):
+        return kendra_answers.get_kendra_answer(question)
+
+
+def start(message):
+    """
+    Starts a speculative lookup for the message and returns a Speculation, or None when
+    speculation is disabled or the message does not look like a question.
+    """
+    if not (
+        SPECULATIVE_KENDRA
+        and not _no_code_hook
+        and kendra_answers.get_kendra_indexes()
+        and looks_like_question(message)
+    ):
+        return None
+    stats.record_start()
+    return Speculation(message, get_executor().submit(metrics.bind(query), message))
+
+
+def answered_by_lex(lex_response):
+    """
+    True if the fulfillment Lambda did not see the turn: the marker it removes is still
+    in the session attributes Lex returned.
+    """
+    return SESSION_ATTRIBUTE in (lex_response.get("sessionAttributes") or {})
+
+
+def strip_marker(session_attributes):
+    """
+    The session attributes without the marker: it only applies to the turn it was sent
+    with, but Lex keeps and returns it when the fulfillment Lambda did not remove it.
+    """
+    return {
+        name: value
+        for name, value in session_attributes.items()
+        if name != SESSION_ATTRIBUTE
+    }
+
+
+def disable():
+    global _no_code_hook
+    if not _no_code_hook:
+        _no_code_hook = True
+        logger.warning(
+            "%s has no fulfillment code hook, disabling speculative Kendra queries",
+            FAQ_INTENT,
+        )
+        metrics.count("KendraSpeculationDisabled")
+
+
+def resolve(speculation, lex_response):
+    """
+    The reply for a turn Lex routed to AskKendraFAQ: the speculative answer, or
+    kendra_answers.get_fallback_answer() if the lookup failed or timed out. None if there was no speculation, Lex
+    routed the turn elsewhere or answered it without the fulfillment Lambda.
+    """
+    if speculation is None:
+        return None
+    if lex_response is None or lex_response.get("intentName") != FAQ_INTENT:
+        stats.record(WASTED)
+        reply = None
+    elif answered_by_lex(lex_response):
+        disable()
+        stats.record(WASTED)
+        reply = None
+    else:
+        try:
+            reply = speculation.future.result(timeout=SPECULATION_TIMEOUT_MS / 1000.0)
+        except Exception as err:
+            logger.warning("Speculative Kendra query failed: %r", err)
+            stats.record(FAILED)
+            reply = kendra_answers.get_fallback_answer(speculation.question)
+        else:
+            stats.record(USED)
+        reply = reply or NO_ANSWER
+    logger.debug("Kendra speculation stats: %s", stats.as_dict())
+    return reply
@@ -0,0 +1,193 @@
+"""
+Work queues for the deferred reply mode of the webhook.
+
+Queued messages are dicts with at least "userId" and "Body" keys; messages of the same
+user are always handled one at a time and in the order they were put on the queue.
+Bursts of messages from one user ("hi" / "my laptop" / "wont boot") can be coalesced
+into a single message, so they become one Lex turn.
+"""
+
+import collections
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+
+import boto3
+
+import metrics
+
+logger = logging.getLogger()
+
+
+class CoalescingStats:
+    """
+    Messages received versus Lex turns issued after coalescing.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.turns = 0
+        self._lock = threading.Lock()
+
+    def record(self, message_count):
+        with self._lock:
+            self.messages += message_count
+            self.turns += 1
+
+    def as_dict(self):
+        return {"messages": self.messages, "turns": self.turns}
+
+
+coalescing_stats = CoalescingStats()
+
+
+def merge_messages(messages):
+    """
+    Merges messages of one user into a single message, keeping the metadata of the latest one.
+    Counts the messages (QueuedMessages) and the Lex turns they become (QueuedTurns) in the
+    current invocation's metrics.
+    """
+    coalescing_stats.record(len(messages))
+    metrics.count("QueuedMessages", len(messages))
+    metrics.count("QueuedTurns")
+    if len(messages) == 1:
+        return messages[0]
+    merged = dict(messages[-1])
+    merged["Body"] = " ".join(message["Body"] for message in messages)
+    logger.info(
+        "Coalesced %d messages of %s, stats = %s",
+        len(messages),
+        merged["userId"],
+        coalescing_stats.as_dict(),
+    )
+    return merged
+
+
+def group_by_user(items):
+    """
+    Splits (key, message) pairs (e.g. the records of one SQS event) into a list per user,
+    in order of each user's first message and keeping the order of each user's messages.
+    """
+    by_user = collections.OrderedDict()
+    for key, message in items:
+        by_user.setdefault(message["userId"], []).append((key, message))
+    return list(by_user.values())
+
+
+class SqsWorkQueue:
+    """
+    SQS FIFO queue, the user id is used as message group so ordering is kept per user.
+    The same Lambda consumes the queue through an SQS event source mapping.
+    """
+
+    def __init__(self, queue_url, client=None):
+        self.queue_url = queue_url
+        self.client = client or boto3.client("sqs")
+
+    def put(self, message):
+        kwargs = {
+            "QueueUrl": self.queue_url,
+            "MessageBody": json.dumps(message),
+            "MessageGroupId": message["userId"],
+        }
+        if message.get("MessageSid"):
+            kwargs["MessageDeduplicationId"] = message["MessageSid"]
+        self.client.send_message(**kwargs)
+
+    def defer(self, receipt_handles, seconds):
+        """
+        Makes received messages visible again only after the given number of seconds.
+        """
+        for start in range(0, len(receipt_handles), 10):
+            self.client.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {
+                        "Id": str(index),
+                        "ReceiptHandle": receipt_handle,
+                        "VisibilityTimeout": seconds,
+                    }
+                    for index, receipt_handle in enumerate(
+                        receipt_handles[start : start + 10]
+                    )
+                ],
+            )
+
+
+class LocalWorkQueue:
+    """
+    In-process stand-in for the SQS queue: messages are handled by a thread pool, with at
+    most one worker per user at a time. With a coalesce window (in seconds) a user's
+    messages are held until the user has been quiet for that long, then merged.
+    """
+
+    def __init__(self, handler, max_workers=4, coalesce_window=0):
+        self.handler = handler
+        self.coalesce_window = coalesce_window
+        self._pending = {}
+        self._last_put = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def put(self, message):
+        user_id = message["userId"]
+        with self._lock:
+            self._last_put[user_id] = time.monotonic()
+            queue = self._pending.get(user_id)
+            if queue is not None:
+                queue.append(message)
+                return
+            self._pending[user_id] = collections.deque([message])
+        self._executor.submit(self._drain, user_id)
+
+    def _wait_until_quiet(self, user_id):
+        while True:
+            with self._lock:
+                remaining = (
+                    self._last_put[user_id] + self.coalesce_window - time.monotonic()
+                )
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def _next_messages(self, user_id):
+        """
+        Takes the next message of a user off the queue, or everything queued when coalescing,
+        or returns None when the user's queue is empty.
+        """
+        with self._lock:
+            queue = self._pending[user_id]
+            if not queue:
+                del self._pending[user_id]
+                del self._last_put[user_id]
+                self._idle.notify_all()
+                return None
+            if not self.coalesce_window:
+                return [queue.popleft()]
+            messages = list(queue)
+            queue.clear()
+        return messages
+
+    def _drain(self, user_id):
+        while True:
+            if self.coalesce_window:
+                self._wait_until_quiet(user_id)
+            messages = self._next_messages(user_id)
+            if messages is None:
+                return
+            try:
+                # handled outside of the webhook invocation that queued it
+                with metrics.invocation(Source="queue"):
+                    self.handler(merge_messages(messages))
+            except Exception:
+                logger.exception("Failed to handle queued message for %s", user_id)
+
+    def join(self, timeout=None):
+        """
+        Waits until every queued message has been handled.
+        """
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
@@ -0,0 +1,142 @@
+"""
+Cold start benchmark for the fulfillment Lambda.
+
+Starts fresh Python processes that import lambda.py and handle one Greeting turn, and
+reports:
+  - the wall-clock time of the import and of the first invocation (median over --runs)
+  - the modules with the largest cumulative import time, from python -X importtime
+
+Usage:
+    python tools/cold_start.py [--runs 10] [--top 15] [--json]
+
+AWS calls are not made for a Greeting turn, so no credentials are needed.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "assets",
+    "lex-appointment-handler-it",
+)
+SHARED_DIR = os.path.join(LAMBDA_DIR, "..", "shared_layer", "python")
+
+# runs in the child process, prints the import and first invocation times in milliseconds
+CHILD = """
+import importlib, json, time
+start = time.perf_counter()
+handler = importlib.import_module("lambda")
+imported = time.perf_counter()
+handler.lambda_handler(
+    {
+        "bot": {"name": "benchmark"},
+        "userId": "benchmark",
+        "inputTranscript": "hi",
+        "invocationSource": "DialogCodeHook",
+        "sessionAttributes": {},
+        "currentIntent": {"name": "Greeting", "slots": {}},
+    },
+    None,
+)
+invoked = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "invoke_ms": (invoked - imported) * 1000}))
+"""
+
+IMPORT_MARKER = "-- import lambda --"
+IMPORT_CHILD = """
+import importlib, sys
+sys.stderr.write("{}\\n")
+sys.stderr.flush()
+importlib.import_module("lambda")
+""".format(IMPORT_MARKER)
+
+
+def child_env():
+    env = dict(os.environ)
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    # where the Lambda runtime finds the shared layer (/opt/python)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [SHARED_DIR, env.get("PYTHONPATH")])
+    )
+    return env
+
+
+def measure_cold_starts(runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD],
+            cwd=LAMBDA_DIR,
+            env=child_env(),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        key: statistics.median(sample[key] for sample in samples)
+        for key in ("import_ms", "invoke_ms")
+    }
+
+
+def measure_import_times(top):
+    """
+    Returns the top modules by cumulative import time (in milliseconds) when importing lambda.py.
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_CHILD],
+        cwd=LAMBDA_DIR,
+        env=child_env(),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    # skip the modules imported during interpreter startup, before the marker
+    stderr = stderr[stderr.index(IMPORT_MARKER) :]
+    modules = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules.append((int(cumulative) / 1000, name.rstrip()[1:]))
+    modules.sort(reverse=True)
+    return modules[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", action="store_true", help="print a JSON report")
+    args = parser.parse_args()
+
+    cold_start = measure_cold_starts(args.runs)
+    import_times = measure_import_times(args.top)
+
+    if args.json:
+        report = dict(cold_start)
+        report["imports"] = [
+            {"module": name.strip(), "cumulative_ms": ms} for ms, name in import_times
+        ]
+        print(json.dumps(report, indent=2))
+        return
+
+    print("Cold start (median of {} runs)".format(args.runs))
+    print("  import lambda.py   {:8.1f} ms".format(cold_start["import_ms"]))
+    print("  first invocation   {:8.1f} ms".format(cold_start["invoke_ms"]))
+    print()
+    print("Largest cumulative import times")
+    for ms, name in import_times:
+        print("  {:8.1f} ms  {}".format(ms, name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Micro-benchmarks for the helpers that run on every scheduling turn of the fulfillment Lambda.
+
+Every benchmark calls one function of helpers.py (or slot_state.py, similar_questions.py) with fixed inputs. The loop count is
+calibrated so a sample takes at least --min-time seconds, and the median of --repeat
+samples is reported in microseconds per call.
+
+Usage:
+    python tools/helpers_benchmark.py                        # run and print
+    python tools/helpers_benchmark.py --save baseline.json   # keep the results
+    python tools/helpers_benchmark.py --compare baseline.json --threshold 25
+
+With --compare the exit status is 1 when the median of a benchmark is more than
+--threshold percent slower than in the baseline, and the slowdown is also more than
+twice the relative standard deviation of the samples of either run, so a noisy sample
+on a busy machine does not count as a regression.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import statistics
+import sys
+import time
+
+LAMBDA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "assets",
+    "lex-appointment-handler-it",
+)
+SHARED_DIR = os.path.join(LAMBDA_DIR, "..", "shared_layer", "python")
+
+# a Wednesday far enough in the future to always pass the "a day in advance" check
+DATE = "2099-06-03"
+TIME = "16:30"
+VACCINE_TYPE = "macbook repair"
+AVAILABLE_TIMES = ["10:00", "10:30", "11:30", "14:00", "16:00", "16:30"]
+REMEMBERED_SLOTS = {
+    "VaccineType": VACCINE_TYPE,
+    "FullName": "Ann Lee",
+    "Result": "no",
+    "ContactResult": "no",
+    "CurrentCondition": "no",
+    "Date": None,
+    "Time": None,
+}
+
+ANSWERED_QUESTIONS = [
+    "where is the it help desk",
+    "how do i reset my password",
+    "can i use amazon workdocs on my mobile device",
+    "what is amazon workdocs",
+    "how do i connect to the vpn",
+]
+PARAPHRASE = "can i use workdocs from my mobile device"
+
+
+def intent_request():
+    slots = dict(REMEMBERED_SLOTS, Date=DATE, Time=TIME)
+    return {
+        "invocationSource": "DialogCodeHook",
+        "userId": "benchmark",
+        "sessionAttributes": {},
+        "inputTranscript": TIME,
+        "currentIntent": {
+            "name": "MakeAppointment",
+            "slots": slots,
+            "slotDetails": {
+                name: {"resolutions": [{"value": value}], "originalValue": value}
+                for name, value in slots.items()
+            },
+            "confirmationStatus": "None",
+        },
+    }
+
+
+def benchmarks():
+    """
+    Returns (name, function) pairs; each function makes one call with its fixture.
+    """
+    sys.path[:0] = [LAMBDA_DIR, SHARED_DIR]
+    import availability
+    import booking_codec
+    import helpers
+    import similar_questions
+    import slot_state
+
+    engine = availability.get_engine()
+    free_slots = engine.mask_from_times(AVAILABLE_TIMES)
+    booking_map = booking_codec.BookingMap({DATE: free_slots})
+    request = intent_request()
+    # a turn answering the Time slot, the other slots come from the remembered ones
+    time_request = intent_request()
+    time_request["currentIntent"]["slots"] = dict.fromkeys(REMEMBERED_SLOTS, None)
+    time_request["currentIntent"]["slots"]["Time"] = TIME
+    legacy_session = {"rememberedSlots": json.dumps(REMEMBERED_SLOTS)}
+    compact_session = {"rememberedSlots": dict(REMEMBERED_SLOTS)}
+    answered_questions = similar_questions.SimilarQuestionIndex()
+    for question in ANSWERED_QUESTIONS:
+        answered_questions.add(question)
+
+    return [
+        (
+            "validate_book_appointment",
+            lambda: helpers.validate_book_appointment(VACCINE_TYPE, DATE, TIME),
+        ),
+        (
+            "SlotState.latest_values",
+            lambda: slot_state.SlotState(dict(compact_session)).latest_values(request),
+        ),
+        (
+            "SlotState.latest_values[remembered]",
+            lambda: slot_state.SlotState(dict(compact_session)).latest_values(
+                time_request
+            ),
+        ),
+        (
+            "SlotState.latest_values[legacy]",
+            lambda: slot_state.SlotState(dict(legacy_session)).latest_values(
+                time_request
+            ),
+        ),
+        ("build_options[Date]", lambda: helpers.build_options("Date")),
+        (
+            "build_options[Time]",
+            lambda: helpers.build_options("Time", VACCINE_TYPE, DATE, booking_map),
+        ),
+        (
+            "get_availabilities_for_duration",
+            lambda: helpers.get_availabilities_for_duration(30, free_slots),
+        ),
+        (
+            "build_available_time_string",
+            lambda: helpers.build_available_time_string(AVAILABLE_TIMES),
+        ),
+        (
+            "SimilarQuestionIndex.find",
+            lambda: answered_questions.find(PARAPHRASE),
+        ),
+    ]
+
+
+def time_loops(function, loops):
+    start = time.perf_counter()
+    for _ in range(loops):
+        function()
+    return time.perf_counter() - start
+
+
+def calibrate(function, min_time):
+    loops = 1
+    while time_loops(function, loops) < min_time:
+        loops *= 2
+    return loops
+
+
+def run_benchmark(function, repeat, min_time):
+    loops = calibrate(function, min_time)
+    samples = [time_loops(function, loops) / loops * 1e6 for _ in range(repeat)]
+    return {
+        "median_us": statistics.median(samples),
+        "stdev_us": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "loops": loops,
+    }
+
+
+def noise_percent(result):
+    """
+    Twice the standard deviation of the samples, in percent of their median.
+    """
+    if not result["median_us"]:
+        return 0.0
+    return 200.0 * result.get("stdev_us", 0.0) / result["median_us"]
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change against the baseline and returns the names of regressed benchmarks.
+    """
+    regressions = []
+    print()
+    print("{:<38} {:>12} {:>12} {:>9}".format("benchmark", "baseline", "now", "change"))
+    for name, result in results.items():
+        if name not in baseline:
+            print("{:<38} {:>12} {:>12.3f}".format(name, "-", result["median_us"]))
+            continue
+        before = baseline[name]["median_us"]
+        change = (result["median_us"] - before) / before * 100
+        flag = ""
+        if change > max(
+            threshold, noise_percent(result), noise_percent(baseline[name])
+        ):
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            "{:<38} {:>12.3f} {:>12.3f} {:>+8.1f}%{}".format(
+                name, before, result["median_us"], change, flag
+            )
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument(
+        "--min-time", type=float, default=0.2, help="minimum seconds per sample"
+    )
+    parser.add_argument("--filter", help="only run benchmarks matching this pattern")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file written by --save")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        # runs in separate processes differ by up to ~15% on a shared machine
+        default=25.0,
+        help="allowed slowdown against the baseline, in percent",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    print("{:<38} {:>12} {:>10}".format("benchmark", "median us", "stdev"))
+    for name, function in benchmarks():
+        if args.filter and not fnmatch.fnmatch(name, args.filter):
+            continue
+        results[name] = run_benchmark(function, args.repeat, args.min_time)
+        print(
+            "{:<38} {:>12.3f} {:>10.3f}".format(
+                name, results[name]["median_us"], results[name]["stdev_us"]
+            )
+        )
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print()
+            print(
+                "{} benchmark(s) regressed by more than {}%: {}".format(
+                    len(regressions), args.threshold, ", ".join(regressions)
+                )
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1127 @@
+"""
+In-process Lex V1 runtime emulator for offline end-to-end runs.
+
+LexRuntimeEmulator stands in for the boto3 "lex-runtime" client (post_text and
+get_session) with the bot of assets/lex_bot/HelpDesk_lex_bot.json: it matches the input
+against the sample utterances of the intents, elicits the required slots in priority
+order with the bot's prompts, resolves slot values (custom slot types, AMAZON.DATE,
+AMAZON.TIME), asks the confirmation prompt and invokes the fulfillment Lambda as the
+dialog and fulfillment code hook with Lex V1 events. Input nothing matches goes to the
+AMAZON.KendraSearchIntent intent, answered from the FAQ files instead of Kendra.
+Latency can be injected per Lex call, per code hook invocation and per Kendra search.
+
+Utterance matching is a plain token overlap, not Lex's NLU: drive the bot with its own
+sample utterances for predictable routing.
+
+Run as a script it pushes WhatsApp messages through the webhook Lambda, the emulator and
+the fulfillment Lambda in one process and reports p50/p95/p99 latency of the whole chain:
+
+Usage:
+    python tools/lex_emulator.py [--threads 8] [--sessions 200] [--lex-latency-ms 40]
+    python tools/lex_emulator.py --chat
+"""
+
+import argparse
+import collections
+import contextlib
+import datetime
+import importlib
+import importlib.util
+import io
+import json
+import os
+import queue
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ElementTree
+
+from botocore.exceptions import ClientError
+
+import load_test
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LAMBDA_DIR = os.path.join(ROOT_DIR, "assets", "lex-appointment-handler-it")
+WEBHOOK_DIR = os.path.join(ROOT_DIR, "assets", "twilio-webhook-lambda")
+SHARED_DIR = os.path.join(ROOT_DIR, "assets", "shared_layer", "python")
+BOT_FILE = os.path.join(ROOT_DIR, "assets", "lex_bot", "HelpDesk_lex_bot.json")
+FAQ_DIR = os.path.join(ROOT_DIR, "assets", "faq")
+
+# share of the utterance words an input needs for a fuzzy match
+MATCH_THRESHOLD = 0.5
+# FAQ index score a question needs to be answered by the emulated Kendra search
+KENDRA_MATCH_THRESHOLD = 0.5
+MAX_INPUT_LENGTH = 1024
+MAX_SESSION_ATTRIBUTES_BYTES = 12 * 1024
+RECENT_INTENTS = 3
+# times the driver answers the same slot before it gives up on an appointment
+MAX_SLOT_ATTEMPTS = 3
+
+# utterances of the built-in intents, which have none in the bot definition
+BUILTIN_UTTERANCES = {
+    "AMAZON.CancelIntent": ["cancel", "cancel scheduling", "never mind", "forget it"],
+    "AMAZON.HelpIntent": ["help", "help me"],
+    "AMAZON.StopIntent": ["stop", "quit"],
+}
+KENDRA_SEARCH_INTENT = "AMAZON.KendraSearchIntent"
+KENDRA_PLACEHOLDER = re.compile(
+    r"\(\(x-amz-lex:kendra-search-response-question_answer-(question|answer)-1\)\)"
+)
+PROMPT_PLACEHOLDER = re.compile(r"\{(\w+)\}|\[(\w+)\]")
+WORD_PATTERN = re.compile(r"[\w']+")
+YES_WORDS = frozenset(["yes", "yeah", "yep", "sure", "ok", "okay", "y", "correct"])
+NO_WORDS = frozenset(["no", "nope", "nah", "n"])
+WEEKDAYS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+DATE_FORMATS = ("%Y-%m-%d", "%A, %B %d, %Y", "%B %d, %Y", "%B %d %Y", "%m/%d/%Y")
+SHORT_DATE_FORMATS = ("%B %d", "%m/%d", "%m-%d")
+TIME_PATTERN = re.compile(r"^(\d{1,2})(?::(\d{2}))?\s*(?:([ap])\.?\s*m\.?)?$")
+SENTIMENT = load_test.SENTIMENT
+
+
+class LexRuntimeError(ClientError):
+    code = "InternalFailureException"
+    status = 500
+
+    def __init__(self, operation_name, message):
+        super().__init__(
+            {
+                "Error": {"Code": self.code, "Message": message},
+                "ResponseMetadata": {"HTTPStatusCode": self.status},
+            },
+            operation_name,
+        )
+
+
+class NotFoundException(LexRuntimeError):
+    code = "NotFoundException"
+    status = 404
+
+
+class BadRequestException(LexRuntimeError):
+    code = "BadRequestException"
+    status = 400
+
+
+class DependencyFailedException(LexRuntimeError):
+    code = "DependencyFailedException"
+    status = 424
+
+
+def words(text):
+    return WORD_PATTERN.findall((text or "").lower())
+
+
+def compile_utterance(utterance):
+    """
+    Regular expression matching the whole utterance, with a named group per {Slot}.
+    """
+    pattern = []
+    for part in re.split(r"(\{\w+\})", utterance.strip()):
+        if part.startswith("{"):
+            pattern.append(r"(?P<{}>.+?)".format(part[1:-1]))
+        elif part.strip():
+            pattern.append(r"\s+".join(re.escape(word) for word in part.split()))
+    return re.compile(r"\s*".join(pattern), re.IGNORECASE)
+
+
+def parse_date(text, today=None):
+    """
+    The ISO date AMAZON.DATE resolves the text to, or None.
+    """
+    today = today or datetime.date.today()
+    # a response card option such as "10-19 (Mon)"
+    text = re.sub(r"\(.*?\)", "", text).strip().rstrip(".").lower()
+    if text == "today":
+        return today.isoformat()
+    if text == "tomorrow":
+        return (today + datetime.timedelta(days=1)).isoformat()
+    weekday = text[5:] if text.startswith("next ") else text
+    if weekday in WEEKDAYS:
+        days = (WEEKDAYS.index(weekday) - today.weekday() - 1) % 7 + 1
+        return (today + datetime.timedelta(days=days)).isoformat()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            pass
+    for date_format in SHORT_DATE_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+        # dates without a year are the next such date
+        parsed = parsed.replace(year=today.year)
+        if parsed < today:
+            parsed = parsed.replace(year=today.year + 1)
+        return parsed.isoformat()
+    return None
+
+
+def parse_time(text):
+    """
+    The "HH:MM" AMAZON.TIME resolves the text to, or None.
+    """
+    text = text.strip().lower()
+    if text == "noon":
+        return "12:00"
+    match = TIME_PATTERN.match(text)
+    if match is None:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2) or 0)
+    if match.group(3):
+        hour = hour % 12 + (12 if match.group(3) == "p" else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return "{:02d}:{:02d}".format(hour, minute)
+
+
+class EmulatorSession:
+    """
+    Dialog state of one user.
+    """
+
+    def __init__(self, user_id, bot_alias):
+        self.user_id = user_id
+        self.bot_alias = bot_alias
+        self.session_id = "{}-{}".format(
+            datetime.datetime.now(datetime.timezone.utc).strftime(
+                "%Y-%m-%dT%H:%M:%S.%fZ"
+            ),
+            uuid.uuid4().hex[:10],
+        )
+        self.attributes = {}
+        self.recent_intents = collections.deque(maxlen=RECENT_INTENTS)
+        self.last_response = None
+        self.last_active = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.intent = None
+        self.confidence = None
+        self.slots = {}
+        self.original_values = {}
+        self.slot_to_elicit = None
+        self.confirming = False
+        self.confirmation_status = "None"
+        # (dialog state, message, response card) of the pending question
+        self.prompt = None
+
+
+class LexRuntimeEmulator:
+    """
+    Drop-in replacement for boto3.client("lex-runtime") with the bot definition, calling
+    code_hook(event, context) as the Lambda function of the intents that have one.
+    """
+
+    def __init__(
+        self,
+        bot,
+        code_hook,
+        kendra_search=None,
+        latency_ms=0.0,
+        jitter_ms=0.0,
+        code_hook_latency_ms=0.0,
+        kendra_latency_ms=0.0,
+        seed=0,
+        clock=time.monotonic,
+    ):
+        self.bot = bot
+        self.bot_name = bot["name"]
+        self.code_hook = code_hook
+        self.kendra_search = kendra_search
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.code_hook_latency_ms = code_hook_latency_ms
+        self.kendra_latency_ms = kendra_latency_ms
+        self.clock = clock
+        self.session_ttl = bot.get("idleSessionTTLInSeconds", 300)
+        self.intents = {intent["name"]: intent for intent in bot["intents"]}
+        self.slot_types = {
+            slot_type["name"]: slot_type for slot_type in bot.get("slotTypes", [])
+        }
+        self.utterances = [
+            (name, utterance, compile_utterance(utterance))
+            for name, intent in self.intents.items()
+            for utterance in intent.get("sampleUtterances")
+            or BUILTIN_UTTERANCES.get(intent.get("parentIntentSignature"), [])
+        ]
+        self.kendra_intent = next(
+            (
+                name
+                for name, intent in self.intents.items()
+                if intent.get("parentIntentSignature") == KENDRA_SEARCH_INTENT
+            ),
+            None,
+        )
+        self.exceptions = argparse.Namespace(
+            NotFoundException=NotFoundException,
+            BadRequestException=BadRequestException,
+            DependencyFailedException=DependencyFailedException,
+        )
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, code_hook, path=BOT_FILE, **kwargs):
+        with open(path) as bot_file:
+            return cls(json.load(bot_file)["resource"], code_hook, **kwargs)
+
+    # --- lex-runtime API ---
+
+    def post_text(
+        self,
+        botName,
+        botAlias,
+        userId,
+        inputText,
+        sessionAttributes=None,
+        requestAttributes=None,
+        activeContexts=None,
+    ):
+        self._delay(self.latency_ms, self.jitter_ms)
+        self._check_bot("PostText", botName)
+        if not inputText or len(inputText) > MAX_INPUT_LENGTH:
+            raise BadRequestException(
+                "PostText",
+                "inputText must be 1 to {} characters".format(MAX_INPUT_LENGTH),
+            )
+        if sessionAttributes is not None:
+            size = sum(
+                len(name.encode()) + len(str(value).encode())
+                for name, value in sessionAttributes.items()
+            )
+            if size > MAX_SESSION_ATTRIBUTES_BYTES:
+                raise BadRequestException(
+                    "PostText",
+                    "Session attributes are {} bytes, the limit is {}".format(
+                        size, MAX_SESSION_ATTRIBUTES_BYTES
+                    ),
+                )
+
+        session = self._session(userId, botAlias, create=True)
+        with session.lock:
+            session.last_response = None
+            if sessionAttributes is not None:
+                session.attributes = dict(sessionAttributes)
+            response = self._turn(session, inputText, requestAttributes)
+            session.last_response = response
+            return json.loads(json.dumps(response))
+
+    def get_session(self, botName, botAlias, userId, checkpointLabelFilter=None):
+        self._delay(self.latency_ms, self.jitter_ms)
+        self._check_bot("GetSession", botName)
+        session = self._session(userId, botAlias, create=False)
+        if session is None:
+            raise NotFoundException("GetSession", "Session not found")
+        with session.lock:
+            if session.intent is None:
+                dialog_action = {"type": "ElicitIntent"}
+            else:
+                dialog_action = {
+                    "type": session.prompt[0] if session.prompt else "Delegate",
+                    "intentName": session.intent,
+                    "slots": dict(session.slots),
+                    "slotToElicit": session.slot_to_elicit,
+                }
+            return json.loads(
+                json.dumps(
+                    {
+                        "recentIntentSummaryView": list(session.recent_intents),
+                        "sessionAttributes": dict(session.attributes),
+                        "sessionId": session.session_id,
+                        "dialogAction": _without_none(dialog_action),
+                        "activeContexts": [],
+                    }
+                )
+            )
+
+    def last_response(self, user_id):
+        """
+        The last post_text response of the user, None if the last turn failed.
+        """
+        with self._lock:
+            session = self._sessions.get(user_id)
+        return session.last_response if session is not None else None
+
+    # --- sessions ---
+
+    def _check_bot(self, operation_name, bot_name):
+        if bot_name != self.bot_name:
+            raise NotFoundException(
+                operation_name, "Bot {} does not exist".format(bot_name)
+            )
+
+    def _session(self, user_id, bot_alias, create):
+        now = self.clock()
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None and now - session.last_active > self.session_ttl:
+                del self._sessions[user_id]
+                session = None
+            if session is None and create:
+                session = self._sessions[user_id] = EmulatorSession(user_id, bot_alias)
+            if session is not None:
+                session.last_active = now
+            return session
+
+    def _delay(self, latency_ms, jitter_ms=0.0):
+        if latency_ms or jitter_ms:
+            with self._rng_lock:
+                delay_ms = latency_ms + self._rng.uniform(0, jitter_ms)
+            time.sleep(delay_ms / 1000)
+
+    def _choice(self, items):
+        with self._rng_lock:
+            return self._rng.choice(items)
+
+    # --- natural language understanding ---
+
+    def match_intent(self, text):
+        """
+        Returns (intent name, confidence, slot values) of the best matching sample
+        utterance, or None. A full match scores 1.0, otherwise the word overlap counts.
+        """
+        input_words = set(words(text))
+        best = None
+        for name, utterance, pattern in self.utterances:
+            match = pattern.fullmatch(text.strip().rstrip("?!."))
+            if match is not None:
+                return name, 1.0, match.groupdict()
+            utterance_words = set(words(re.sub(r"\{\w+\}", "", utterance)))
+            if not utterance_words or not input_words:
+                continue
+            score = len(input_words & utterance_words) / len(
+                input_words | utterance_words
+            )
+            if score >= MATCH_THRESHOLD and (best is None or score > best[1]):
+                best = (name, score, {})
+        return best
+
+    def resolve_slot_value(self, slot_type, text):
+        """
+        Returns (slot value, resolved values) of what the user said for a slot type.
+        """
+        text = text.strip()
+        if slot_type == "AMAZON.DATE":
+            return parse_date(text), []
+        if slot_type == "AMAZON.TIME":
+            return parse_time(text), []
+        definition = self.slot_types.get(slot_type)
+        if definition is None:
+            return text, []
+        resolved = self._resolve_enumeration(definition, text)
+        if resolved is None:
+            return text, []
+        if definition.get("valueSelectionStrategy") == "TOP_RESOLUTION":
+            return resolved, [resolved]
+        return text, [resolved]
+
+    def _resolve_enumeration(self, definition, text):
+        spoken = " ".join(words(text))
+        candidates = [
+            (" ".join(words(synonym)), value["value"])
+            for value in definition.get("enumerationValues", [])
+            for synonym in [value["value"]] + value.get("synonyms", [])
+        ]
+        for synonym, value in candidates:
+            if spoken == synonym:
+                return value
+        for synonym, value in candidates:
+            if re.search(r"\b{}\b".format(re.escape(synonym)), spoken):
+                return value
+        return None
+
+    # --- dialog management ---
+
+    def _turn(self, session, text, request_attributes):
+        match = self.match_intent(text)
+        if session.confirming:
+            answer = set(words(text))
+            if answer & YES_WORDS or answer & NO_WORDS:
+                session.confirming = False
+                session.confirmation_status = (
+                    "Confirmed" if answer & YES_WORDS else "Denied"
+                )
+                return self._continue(session, text, request_attributes)
+            if match is None or match[1] < 1.0:
+                # neither yes nor no: ask again
+                return self._response(session, *session.prompt)
+        elif session.slot_to_elicit and not (
+            match is not None and match[1] == 1.0 and match[0] != session.intent
+        ):
+            # the answer to the elicited slot, unless it is a sample utterance of
+            # another intent, which switches intents like Lex does
+            self._fill_slot(session, session.slot_to_elicit, text)
+            session.slot_to_elicit = None
+            return self._continue(session, text, request_attributes)
+
+        if match is None:
+            if self.kendra_intent is None:
+                return self._clarify(session)
+            match = (self.kendra_intent, None, {})
+        session.reset()
+        session.intent, session.confidence, captured = match
+        session.slots = {
+            slot["name"]: None for slot in self.intents[session.intent].get("slots", [])
+        }
+        for slot_name, value in captured.items():
+            self._fill_slot(session, slot_name, value)
+        return self._continue(session, text, request_attributes)
+
+    def _fill_slot(self, session, slot_name, text):
+        slot = self._slot(session.intent, slot_name)
+        value, _ = self.resolve_slot_value(slot["slotType"] if slot else None, text)
+        session.slots[slot_name] = value
+        session.original_values[slot_name] = text.strip()
+
+    def _slot(self, intent_name, slot_name):
+        for slot in self.intents[intent_name].get("slots", []):
+            if slot["name"] == slot_name:
+                return slot
+        return None
+
+    def _continue(self, session, text, request_attributes):
+        if "dialogCodeHook" in self.intents[session.intent]:
+            result = self._invoke(session, "DialogCodeHook", text, request_attributes)
+            action = result["dialogAction"]
+            if action["type"] != "Delegate":
+                return self._apply(session, action)
+            if action.get("slots") is not None:
+                self._set_slots(session, action["slots"])
+        # no code hook, or it delegates: Lex takes the next step itself
+        return self._delegate(session, text, request_attributes)
+
+    def _delegate(self, session, text, request_attributes):
+        intent = self.intents[session.intent]
+        for slot in sorted(intent.get("slots", []), key=lambda slot: slot["priority"]):
+            if slot["slotConstraint"] == "Required" and not session.slots.get(
+                slot["name"]
+            ):
+                session.slot_to_elicit = slot["name"]
+                prompt = slot.get("valueElicitationPrompt") or {}
+                return self._response(
+                    session,
+                    "ElicitSlot",
+                    self._prompt_message(session, prompt),
+                    _parse_response_card(prompt.get("responseCard")),
+                )
+
+        if intent.get("confirmationPrompt") and session.confirmation_status == "None":
+            session.confirming = True
+            prompt = intent["confirmationPrompt"]
+            return self._response(
+                session,
+                "ConfirmIntent",
+                self._prompt_message(session, prompt),
+                _parse_response_card(prompt.get("responseCard")),
+            )
+        if session.confirmation_status == "Denied":
+            return self._finish(
+                session,
+                "Failed",
+                self._prompt_message(session, intent.get("rejectionStatement")),
+            )
+
+        if intent["fulfillmentActivity"]["type"] == "CodeHook":
+            result = self._invoke(
+                session, "FulfillmentCodeHook", text, request_attributes
+            )
+            return self._apply(session, result["dialogAction"])
+        if session.intent == self.kendra_intent:
+            return self._kendra_search(session, text)
+        return self._finish(
+            session,
+            "ReadyForFulfillment",
+            self._prompt_message(session, intent.get("conclusionStatement")),
+        )
+
+    def _kendra_search(self, session, text):
+        self._delay(self.kendra_latency_ms)
+        found = self.kendra_search(text) if self.kendra_search else None
+        if found is None:
+            session.reset()
+            return self._clarify(session)
+        question, answer = found
+        message = self._prompt_message(
+            session, self.intents[session.intent].get("conclusionStatement")
+        ) or {"contentType": "PlainText", "content": answer}
+        message["content"] = KENDRA_PLACEHOLDER.sub(
+            lambda match: question if match.group(1) == "question" else answer,
+            message["content"],
+        )
+        return self._finish(session, "ReadyForFulfillment", message)
+
+    def _apply(self, session, action):
+        """
+        Applies the dialog action the code hook returned.
+        """
+        action_type = action.get("type")
+        intent_name = action.get("intentName")
+        if (
+            action_type in ("ElicitSlot", "ConfirmIntent")
+            and intent_name in self.intents
+            and intent_name != session.intent
+        ):
+            session.reset()
+            session.intent = intent_name
+        if action.get("slots") is not None and session.intent is not None:
+            self._set_slots(session, action["slots"])
+
+        if action_type == "Close":
+            return self._finish(
+                session,
+                action.get("fulfillmentState", "Fulfilled"),
+                action.get("message"),
+                action.get("responseCard"),
+            )
+        if action_type == "ElicitSlot":
+            session.slot_to_elicit = action["slotToElicit"]
+            message = action.get("message")
+            response_card = action.get("responseCard")
+            if message is None:
+                prompt = (self._slot(session.intent, session.slot_to_elicit) or {}).get(
+                    "valueElicitationPrompt"
+                ) or {}
+                message = self._prompt_message(session, prompt)
+                response_card = response_card or _parse_response_card(
+                    prompt.get("responseCard")
+                )
+            return self._response(session, "ElicitSlot", message, response_card)
+        if action_type == "ConfirmIntent":
+            session.confirming = True
+            session.confirmation_status = "None"
+            message = action.get("message") or self._prompt_message(
+                session, self.intents[session.intent].get("confirmationPrompt")
+            )
+            return self._response(
+                session, "ConfirmIntent", message, action.get("responseCard")
+            )
+        if action_type == "ElicitIntent":
+            response = self._response(
+                session,
+                "ElicitIntent",
+                action.get("message"),
+                action.get("responseCard"),
+            )
+            self._end_intent(session, "ElicitIntent", None)
+            return response
+        raise DependencyFailedException(
+            "PostText",
+            "Invalid Lambda Response: unknown dialog action {}".format(action_type),
+        )
+
+    def _set_slots(self, session, slots):
+        names = [slot["name"] for slot in self.intents[session.intent].get("slots", [])]
+        session.slots = {name: slots.get(name) for name in names}
+
+    def _finish(self, session, fulfillment_state, message, response_card=None):
+        response = self._response(session, fulfillment_state, message, response_card)
+        self._end_intent(session, "Close", fulfillment_state)
+        return response
+
+    def _end_intent(self, session, dialog_action_type, fulfillment_state):
+        session.recent_intents.appendleft(
+            _without_none(
+                {
+                    "intentName": session.intent,
+                    "slots": dict(session.slots),
+                    "confirmationStatus": session.confirmation_status,
+                    "dialogActionType": dialog_action_type,
+                    "fulfillmentState": fulfillment_state,
+                }
+            )
+        )
+        session.reset()
+
+    def _clarify(self, session):
+        return self._response(
+            session,
+            "ElicitIntent",
+            self._prompt_message(session, self.bot.get("clarificationPrompt")),
+        )
+
+    def _response(self, session, dialog_state, message=None, response_card=None):
+        response = {
+            "intentName": session.intent,
+            "nluIntentConfidence": (
+                {"score": session.confidence}
+                if session.confidence is not None
+                else None
+            ),
+            "slots": dict(session.slots) if session.intent else None,
+            "sessionAttributes": dict(session.attributes),
+            "sentimentResponse": SENTIMENT if self.bot.get("detectSentiment") else None,
+            "dialogState": dialog_state,
+            "slotToElicit": session.slot_to_elicit,
+            "responseCard": response_card,
+            "sessionId": session.session_id,
+            "botVersion": "$LATEST",
+        }
+        if dialog_state in ("ElicitSlot", "ConfirmIntent"):
+            session.prompt = (dialog_state, message, response_card)
+        if message:
+            response["message"] = message.get("content")
+            response["messageFormat"] = message.get("contentType", "PlainText")
+        return _without_none(response)
+
+    def _prompt_message(self, session, prompt):
+        """
+        One of the messages of a bot prompt or statement, with {Slot} and [attribute]
+        references filled in.
+        """
+        messages = (prompt or {}).get("messages")
+        if not messages:
+            return None
+        message = self._choice(messages)
+
+        def value(match):
+            if match.group(1):
+                return str(session.slots.get(match.group(1)) or "")
+            return str(session.attributes.get(match.group(2)) or "")
+
+        return {
+            "contentType": message.get("contentType", "PlainText"),
+            "content": PROMPT_PLACEHOLDER.sub(value, message["content"]),
+        }
+
+    # --- code hook ---
+
+    def _invoke(self, session, source, text, request_attributes):
+        event = self.code_hook_event(session, source, text, request_attributes)
+        self._delay(self.code_hook_latency_ms)
+        try:
+            # Lambda responses travel as JSON
+            result = json.loads(json.dumps(self.code_hook(event, None)))
+        except Exception as err:
+            raise DependencyFailedException(
+                "PostText", "Invalid Lambda Response: {!r}".format(err)
+            ) from err
+        if not isinstance(result, dict) or not isinstance(
+            result.get("dialogAction"), dict
+        ):
+            raise DependencyFailedException(
+                "PostText", "Invalid Lambda Response: no dialogAction"
+            )
+        if result.get("sessionAttributes") is not None:
+            session.attributes = dict(result["sessionAttributes"])
+        return result
+
+    def code_hook_event(self, session, source, text, request_attributes=None):
+        """
+        The Lex V1 event of a dialog or fulfillment code hook invocation.
+        """
+        slot_details = {}
+        for slot in self.intents[session.intent].get("slots", []):
+            name = slot["name"]
+            value = session.slots.get(name)
+            if value is None:
+                slot_details[name] = None
+                continue
+            original_value = session.original_values.get(name, value)
+            _, resolutions = self.resolve_slot_value(slot["slotType"], original_value)
+            if not resolutions:
+                # a value set by the code hook resolves like one the user said
+                _, resolutions = self.resolve_slot_value(slot["slotType"], value)
+            slot_details[name] = {
+                "resolutions": [{"value": resolved} for resolved in resolutions],
+                "originalValue": original_value,
+            }
+        event = {
+            "messageVersion": "1.0",
+            "invocationSource": source,
+            "userId": session.user_id,
+            "sessionAttributes": dict(session.attributes),
+            "requestAttributes": request_attributes,
+            "bot": {
+                "name": self.bot_name,
+                "alias": session.bot_alias,
+                "version": "$LATEST",
+            },
+            "outputDialogMode": "Text",
+            "inputTranscript": text,
+            "recentIntentSummaryView": list(session.recent_intents) or None,
+            "currentIntent": {
+                "name": session.intent,
+                "nluIntentConfidenceScore": session.confidence,
+                "slots": dict(session.slots),
+                "slotDetails": slot_details,
+                "confirmationStatus": session.confirmation_status,
+            },
+        }
+        if self.bot.get("detectSentiment"):
+            event["sentimentResponse"] = SENTIMENT
+        return event
+
+
+def _without_none(mapping):
+    return {key: value for key, value in mapping.items() if value is not None}
+
+
+def _parse_response_card(response_card):
+    # response cards are stored as JSON strings in the bot definition
+    if not response_card:
+        return None
+    try:
+        return json.loads(response_card)
+    except ValueError:
+        return None
+
+
+""" --- End-to-end driver: WhatsApp webhook -> emulator -> fulfillment Lambda --- """
+
+
+def load_lambda(module_name, directory):
+    """
+    Imports the lambda.py of a Lambda directory under module_name: both Lambda functions
+    have a lambda.py, so they cannot both be imported as "lambda".
+    """
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(directory, "lambda.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def faq_search(faq_index):
+    """
+    Kendra search stand-in: the best FAQ entry of the fulfillment Lambda's FAQ index.
+    """
+    index = faq_index.get_faq_index()
+
+    def search(question):
+        match = index.search(question)
+        if match is None or match[0] < KENDRA_MATCH_THRESHOLD:
+            return None
+        return match[1], match[2]
+
+    return search
+
+
+def sample_utterances(bot, intent_name):
+    for intent in bot["intents"]:
+        if intent["name"] == intent_name:
+            utterances = intent.get("sampleUtterances") or BUILTIN_UTTERANCES.get(
+                intent.get("parentIntentSignature"), []
+            )
+            return [utterance for utterance in utterances if "{" not in utterance]
+    return []
+
+
+class Conversation:
+    """
+    WhatsApp messages of one user; call run(send) to play them.
+    """
+
+    def __init__(self, kind, user_id, rng, messages):
+        self.kind = kind
+        self.user_id = user_id
+        self.phone_number = "+1555{:07d}".format(user_id)
+        self.profile_name = "Load Test {}".format(user_id)
+        self.rng = rng
+        self.messages = messages
+        self.booked = False
+
+    def run(self, send):
+        for message in self.messages:
+            send(self, message)
+
+
+class AppointmentConversation(Conversation):
+    """
+    MakeAppointment dialog: answers whatever the bot asks, choosing dates and times from
+    the response cards, and confirms. Gives up, like a user would, when the same slot is
+    asked for MAX_SLOT_ATTEMPTS times in a row, e.g. when no offered date has a free time.
+    """
+
+    def run(self, send):
+        response = send(self, self.messages[0])
+        attempts = collections.Counter()
+        for _ in range(load_test.MAX_DIALOG_TURNS):
+            if response is None:
+                return
+            state = response["dialogState"]
+            if state == "ConfirmIntent":
+                response = send(self, "yes")
+            elif state == "ElicitSlot":
+                attempts[response["slotToElicit"]] += 1
+                if attempts[response["slotToElicit"]] > MAX_SLOT_ATTEMPTS:
+                    return
+                response = send(self, self.answer(response))
+            else:
+                self.booked = (
+                    state == "Fulfilled"
+                    and response.get("intentName") == "MakeAppointment"
+                )
+                return
+
+    def answer(self, response):
+        slot = response["slotToElicit"]
+        buttons = [
+            button["value"]
+            for attachment in (response.get("responseCard") or {}).get(
+                "genericAttachments", []
+            )
+            for button in attachment.get("buttons") or []
+        ]
+        if slot in ("Date", "Time") and buttons:
+            return self.rng.choice(buttons)
+        if slot == "Date":
+            return self.rng.choice(load_test.next_weekdays(10))
+        if slot == "Time":
+            return "10:00 a.m."
+        if slot == "FullName":
+            return self.profile_name
+        return load_test.SLOT_ANSWERS.get(slot, "no")
+
+
+def generate_conversations(bot, count, seed):
+    rng = random.Random(seed)
+    questions = load_test.load_questions()
+    kinds = [
+        "MakeAppointment",
+        "Greeting",
+        "ConfirmAppointment",
+        "AgentTransfer",
+        "ThankYou",
+        "CancelScheduling",
+        "AskKendraFAQ",
+    ]
+    conversations = []
+    for number in range(count):
+        kind = rng.choice(kinds)
+        conversation_rng = random.Random(rng.random())
+        if kind == "AskKendraFAQ":
+            message = rng.choice(questions)
+        else:
+            message = rng.choice(sample_utterances(bot, kind))
+        if kind == "MakeAppointment":
+            conversations.append(
+                AppointmentConversation(kind, number, conversation_rng, [message])
+            )
+        else:
+            # a greeting first, as most WhatsApp users do
+            conversations.append(
+                Conversation(kind, number, conversation_rng, ["Hi", message])
+            )
+    return conversations
+
+
+def webhook_event(phone_number, profile_name, message):
+    return {
+        "data": {
+            "ProfileName": profile_name,
+            "Body": message,
+            "From": "whatsapp:" + phone_number,
+            "To": "whatsapp:+14155238886",
+            "NumMedia": "0",
+        }
+    }
+
+
+def reply_text(twiml):
+    root = ElementTree.fromstring(twiml)
+    return "\n".join(body.text or "" for body in root.iter("Body")) or "\n".join(
+        message.text or "" for message in root.iter("Message")
+    )
+
+
+def run(conversations, webhook, emulator, threads):
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    lock = threading.Lock()
+    work = queue.Queue()
+    for conversation in conversations:
+        work.put(conversation)
+
+    def send(conversation, message):
+        """
+        Sends a WhatsApp message through the webhook and returns the Lex response.
+        """
+        user_id = "whatsapp:" + conversation.phone_number.replace("+", "")
+        start = time.perf_counter()
+        try:
+            webhook.lambda_handler(
+                webhook_event(
+                    conversation.phone_number, conversation.profile_name, message
+                ),
+                None,
+            )
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+        # the webhook answers failed Lex calls with an apology, the emulator knows better
+        response = emulator.last_response(user_id)
+        with lock:
+            latencies[conversation.kind].append(elapsed_ms)
+            if response is None:
+                errors[conversation.kind] += 1
+        return response
+
+    def worker():
+        while True:
+            try:
+                conversation = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conversation.run(send)
+            except Exception:
+                with lock:
+                    errors[conversation.kind] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    dialogs = [
+        conversation
+        for conversation in conversations
+        if isinstance(conversation, AppointmentConversation)
+    ]
+    report = {
+        "threads": threads,
+        "elapsed_s": elapsed,
+        "appointment_dialogs": len(dialogs),
+        "appointments_booked": sum(conversation.booked for conversation in dialogs),
+        "intents": {},
+    }
+    all_samples = []
+    for kind in sorted(latencies):
+        samples = latencies[kind]
+        all_samples.extend(samples)
+        report["intents"][kind] = load_test.summarize(samples, errors[kind], elapsed)
+    if all_samples:
+        report["intents"]["ALL"] = load_test.summarize(
+            all_samples, sum(errors.values()), elapsed
+        )
+    return report
+
+
+def chat(webhook, emulator):
+    """
+    Reads messages from stdin and prints the replies of the whole chain.
+    """
+    phone_number, profile_name = "+15550000000", "Local User"
+    user_id = "whatsapp:" + phone_number.replace("+", "")
+    print("Type a message, an empty line ends the chat.")
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            break
+        with contextlib.redirect_stdout(io.StringIO()):
+            twiml = webhook.lambda_handler(
+                webhook_event(phone_number, profile_name, line), None
+            )
+        response = emulator.last_response(user_id) or {}
+        print(
+            "[{} {}] {}".format(
+                response.get("intentName", "-"),
+                response.get("dialogState", "error"),
+                reply_text(twiml).strip(),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument(
+        "--sessions", type=int, default=200, help="number of generated conversations"
+    )
+    parser.add_argument(
+        "--lex-latency-ms", type=float, default=0.0, help="added to every Lex call"
+    )
+    parser.add_argument(
+        "--lex-jitter-ms",
+        type=float,
+        default=0.0,
+        help="random extra Lex latency, uniform between 0 and this value",
+    )
+    parser.add_argument(
+        "--code-hook-latency-ms",
+        type=float,
+        default=0.0,
+        help="added to every fulfillment Lambda invocation",
+    )
+    parser.add_argument(
+        "--kendra-latency-ms",
+        type=float,
+        default=0.0,
+        help="added to every Kendra search of the AskKendraFAQ intent",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chat", action="store_true", help="chat on stdin instead")
+    parser.add_argument("--json", action="store_true", help="print a JSON report")
+    args = parser.parse_args()
+
+    with open(BOT_FILE) as bot_file:
+        bot = json.load(bot_file)["resource"]
+
+    # configure both Lambda functions before their modules read the environment
+    booking_dir = tempfile.mkdtemp(prefix="lex-emulator-")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("KENDRA_INDEX", "00000000-0000-0000-0000-000000000000")
+    os.environ.setdefault("id", "join lex-emulator")
+    os.environ.setdefault("FAQ_PATH", FAQ_DIR)
+    os.environ["BOOKING_STORE"] = "sqlite:" + os.path.join(booking_dir, "bookings.db")
+    os.environ["BOT_NAME"] = bot["name"]
+    os.environ.setdefault("BOT_ALIAS", "emulator")
+    os.environ["REPLY_MODE"] = "sync"
+    # the emulated Lex answers AskKendraFAQ itself
+    os.environ["SPECULATIVE_KENDRA"] = "false"
+    # the shared layer is on the path of both Lambda functions
+    sys.path.insert(0, SHARED_DIR)
+    fulfillment = load_lambda("fulfillment_lambda", LAMBDA_DIR)
+    webhook = load_lambda("webhook_lambda", WEBHOOK_DIR)
+
+    emulator = LexRuntimeEmulator(
+        bot,
+        fulfillment.lambda_handler,
+        kendra_search=faq_search(importlib.import_module("faq_index")),
+        latency_ms=args.lex_latency_ms,
+        jitter_ms=args.lex_jitter_ms,
+        code_hook_latency_ms=args.code_hook_latency_ms,
+        kendra_latency_ms=args.kendra_latency_ms,
+        seed=args.seed,
+    )
+    webhook.lex_client = emulator
+
+    if args.chat:
+        chat(webhook, emulator)
+        return
+
+    conversations = generate_conversations(bot, args.sessions, args.seed)
+    # both Lambda functions print to stdout, keep it out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = run(conversations, webhook, emulator, args.threads)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        load_test.print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,531 @@
+"""
+Offline load test and replay harness for the fulfillment Lambda.
+
+Drives lambda.lambda_handler in-process from several threads with Lex V1 events for the
+intents of assets/lex_bot/HelpDesk_lex_bot.json: single turn Greeting, ConfirmAppointment,
+AgentTransfer, ThankYou, CancelScheduling and AskKendraFAQ events, and full multi-turn
+MakeAppointment dialogs that answer every slot the handler elicits and end with the
+fulfillment turn. Kendra is stubbed with botocore's Stubber, with optional artificial
+latency, and bookings go to a throwaway SQLite file.
+
+Reports p50/p95/p99 latency and invocations per second for every intent.
+
+Usage:
+    python tools/load_test.py [--threads 8] [--sessions 500] [--kendra-latency-ms 80]
+    python tools/load_test.py --replay events.jsonl
+
+A replay file has one recorded Lex event per line, either the event itself or an object
+with the event under "event". Events of the same user are replayed in order.
+"""
+
+import argparse
+import collections
+import contextlib
+import csv
+import datetime
+import glob
+import importlib
+import io
+import json
+import os
+import queue
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LAMBDA_DIR = os.path.join(ROOT_DIR, "assets", "lex-appointment-handler-it")
+SHARED_DIR = os.path.join(ROOT_DIR, "assets", "shared_layer", "python")
+BOT_FILE = os.path.join(ROOT_DIR, "assets", "lex_bot", "HelpDesk_lex_bot.json")
+FAQ_DIR = os.path.join(ROOT_DIR, "assets", "faq")
+
+SENTIMENT = {
+    "sentimentLabel": "NEUTRAL",
+    "sentimentScore": "{Positive: 0.1,Negative: 0.0,Neutral: 0.9,Mixed: 0.0}",
+}
+SLOT_ANSWERS = {
+    "VaccineType": "macbook repair",
+    "Result": "no",
+    "ContactResult": "no",
+    "CurrentCondition": "no",
+}
+OFF_FAQ_QUESTIONS = [
+    "how do I reset my vpn token",
+    "my laptop fan is very loud what should I do",
+    "who approves new software licenses",
+    "can I get a second monitor for working from home",
+]
+MAX_DIALOG_TURNS = 20
+
+
+def load_bot():
+    with open(BOT_FILE) as bot_file:
+        bot = json.load(bot_file)["resource"]
+    return {intent["name"]: intent for intent in bot["intents"]}
+
+
+def load_questions():
+    """
+    FAQ questions, with some rephrased, plus questions the FAQ does not answer.
+    """
+    questions = []
+    for path in glob.glob(os.path.join(FAQ_DIR, "*.csv")):
+        with open(path, newline="", encoding="utf-8") as faq_file:
+            for row in csv.DictReader(faq_file):
+                questions.append(row["Question"])
+                questions.append("hi, " + row["Question"].lower().rstrip("?"))
+    return questions + OFF_FAQ_QUESTIONS
+
+
+class EventFactory:
+    """
+    Builds Lex V1 fulfillment events with the slots each intent defines in the bot.
+    """
+
+    def __init__(self, intents):
+        self.slot_names = {
+            name: [slot["name"] for slot in intent.get("slots", [])]
+            for name, intent in intents.items()
+        }
+        # required slots in the order Lex elicits them after a Delegate
+        self.required_slots = {
+            name: [
+                slot["name"]
+                for slot in sorted(intent.get("slots", []), key=lambda s: s["priority"])
+                if slot["slotConstraint"] == "Required"
+            ]
+            for name, intent in intents.items()
+        }
+
+    def event(
+        self,
+        intent_name,
+        user_id,
+        session_attributes,
+        slots=None,
+        transcript="",
+        source="DialogCodeHook",
+    ):
+        slots = slots or {}
+        return {
+            "messageVersion": "1.0",
+            "invocationSource": source,
+            "userId": user_id,
+            "sessionAttributes": dict(session_attributes),
+            "requestAttributes": None,
+            "bot": {"name": "HelpDesk", "alias": "load-test", "version": "$LATEST"},
+            "outputDialogMode": "Text",
+            "inputTranscript": transcript,
+            "sentimentResponse": SENTIMENT,
+            "currentIntent": {
+                "name": intent_name,
+                "slots": {
+                    name: slots.get(name) for name in self.slot_names[intent_name]
+                },
+                "slotDetails": {},
+                "confirmationStatus": "None",
+            },
+        }
+
+
+def parse_time_option(text):
+    """
+    Turns a displayed time such as "4:30 p.m." back into the "16:30" Lex would resolve.
+    """
+    match = re.match(r"(\d+):(\d+) ([ap])\.m\.", text)
+    if match is None:
+        return text
+    hour = int(match.group(1)) % 12 + (12 if match.group(3) == "p" else 0)
+    return "{:02d}:{}".format(hour, match.group(2))
+
+
+def next_weekdays(count):
+    dates = []
+    day = datetime.date.today()
+    while len(dates) < count:
+        day += datetime.timedelta(days=1)
+        if day.weekday() < 5:
+            dates.append(day.isoformat())
+    return dates
+
+
+class Session:
+    """
+    One conversation of a user; call run(invoke) to play all of its turns.
+    """
+
+    def __init__(self, factory, user_id, rng):
+        self.factory = factory
+        self.user_id = user_id
+        self.rng = rng
+        self.full_name = "Load Test {}".format(user_id)
+        # the WhatsApp webhook starts every Lex session with the profile name remembered
+        self.session_attributes = {
+            "rememberedSlots": json.dumps(
+                {
+                    "VaccineType": None,
+                    "FullName": self.full_name,
+                    "Result": None,
+                    "ContactResult": None,
+                    "CurrentCondition": None,
+                    "Date": None,
+                    "Time": None,
+                }
+            )
+        }
+
+    def turn(self, invoke, intent_name, **kwargs):
+        response = invoke(
+            self.factory.event(
+                intent_name, self.user_id, self.session_attributes, **kwargs
+            )
+        )
+        self.session_attributes = response.get("sessionAttributes") or {}
+        return response
+
+
+class SingleTurnSession(Session):
+    def __init__(self, factory, user_id, rng, intent_name, transcript):
+        super().__init__(factory, user_id, rng)
+        self.intent_name = intent_name
+        self.transcript = transcript
+
+    def run(self, invoke):
+        self.turn(invoke, self.intent_name, transcript=self.transcript)
+
+
+class AppointmentSession(Session):
+    """
+    MakeAppointment dialog: answers whatever slot is elicited, choosing times from the
+    response card, then sends the fulfillment turn.
+    """
+
+    def __init__(self, factory, user_id, rng, dates):
+        super().__init__(factory, user_id, rng)
+        self.dates = dates
+        self.answers = dict(SLOT_ANSWERS, FullName=self.full_name)
+        self.booked = False
+
+    def answer(self, slot, response):
+        if slot == "Date":
+            return self.rng.choice(self.dates)
+        if slot == "Time":
+            card = response["dialogAction"].get("responseCard") or {}
+            buttons = [
+                button
+                for attachment in card.get("genericAttachments", [])
+                for button in attachment.get("buttons") or []
+            ]
+            if buttons:
+                return parse_time_option(self.rng.choice(buttons)["value"])
+            return "10:00"
+        return self.answers.get(slot, "no")
+
+    def run(self, invoke):
+        slots = {}
+        for _ in range(MAX_DIALOG_TURNS):
+            response = self.turn(
+                invoke, "MakeAppointment", slots=slots, transcript="book an appointment"
+            )
+            action = response["dialogAction"]
+            if action["type"] == "ElicitSlot":
+                slot = action["slotToElicit"]
+                slots = dict(action.get("slots") or slots)
+                slots[slot] = self.answer(slot, response)
+            elif action["type"] in ("Delegate", "ConfirmIntent"):
+                slots = dict(action.get("slots") or slots)
+                missing = [
+                    slot
+                    for slot in self.factory.required_slots["MakeAppointment"]
+                    if not slots.get(slot)
+                ]
+                if missing:
+                    # Lex prompts for the next required slot itself
+                    slots[missing[0]] = self.answer(missing[0], response)
+                    continue
+                response = self.turn(
+                    invoke,
+                    "MakeAppointment",
+                    slots=slots,
+                    transcript="yes",
+                    source="FulfillmentCodeHook",
+                )
+                self.booked = (
+                    response["dialogAction"].get("fulfillmentState") == "Fulfilled"
+                )
+                return
+            else:
+                return
+
+
+class ReplaySession:
+    def __init__(self, events):
+        self.events = events
+
+    def run(self, invoke):
+        for event in self.events:
+            invoke(json.loads(json.dumps(event)))
+
+
+def generate_sessions(count, seed):
+    rng = random.Random(seed)
+    factory = EventFactory(load_bot())
+    questions = load_questions()
+    dates = next_weekdays(10)
+    single_turn = {
+        "Greeting": lambda: "hi",
+        "ConfirmAppointment": lambda: "when is my appointment",
+        "AgentTransfer": lambda: "talk to an agent",
+        "ThankYou": lambda: "thanks",
+        "CancelScheduling": lambda: "cancel",
+        "AskKendraFAQ": lambda: rng.choice(questions),
+    }
+    kinds = ["MakeAppointment"] + sorted(single_turn)
+    sessions = []
+    for number in range(count):
+        user_id = "loadtest{}".format(number)
+        kind = rng.choice(kinds)
+        session_rng = random.Random(rng.random())
+        if kind == "MakeAppointment":
+            sessions.append(AppointmentSession(factory, user_id, session_rng, dates))
+        else:
+            sessions.append(
+                SingleTurnSession(
+                    factory, user_id, session_rng, kind, single_turn[kind]()
+                )
+            )
+    return sessions
+
+
+def read_replay_sessions(path):
+    events_by_user = collections.OrderedDict()
+    with open(path) as replay_file:
+        for line in replay_file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            event = record.get("event", record) if isinstance(record, dict) else None
+            if not isinstance(event, dict) or "currentIntent" not in event:
+                continue
+            events_by_user.setdefault(event.get("userId"), []).append(event)
+    return [ReplaySession(events) for events in events_by_user.values()]
+
+
+def kendra_call_budget(sessions):
+    """
+    Upper bound of the Kendra calls the sessions can make, to preload the Stubber.
+    """
+    budget = 0
+    for session in sessions:
+        if isinstance(session, ReplaySession):
+            budget += sum(
+                event["currentIntent"]["name"] == "AskKendraFAQ"
+                for event in session.events
+            )
+        elif getattr(session, "intent_name", None) == "AskKendraFAQ":
+            budget += 1
+    return budget
+
+
+def stub_kendra(aws_clients, calls, latency_ms, jitter_ms, seed):
+    from botocore.stub import Stubber
+
+    client = aws_clients.get_client("kendra")
+    stubber = Stubber(client)
+    for number in range(calls):
+        stubber.add_response(
+            "query",
+            {
+                "ResultItems": [
+                    {
+                        "Id": str(number),
+                        "Type": "QUESTION_ANSWER",
+                        "DocumentExcerpt": {"Text": "Stubbed Kendra answer."},
+                    }
+                ]
+            },
+        )
+
+    if latency_ms or jitter_ms:
+        rng = random.Random(seed)
+        lock = threading.Lock()
+
+        def add_latency(**kwargs):
+            with lock:
+                delay_ms = latency_ms + rng.uniform(0, jitter_ms)
+            time.sleep(delay_ms / 1000)
+
+        # registered first so it runs before the Stubber returns the canned response
+        client.meta.events.register_first("before-call.kendra.Query", add_latency)
+    stubber.activate()
+    return stubber
+
+
+def percentile(samples, percent):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
+
+
+def run(sessions, handler, threads):
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    lock = threading.Lock()
+    work = queue.Queue()
+    for session in sessions:
+        work.put(session)
+
+    def invoke(event):
+        intent_name = event["currentIntent"]["name"]
+        start = time.perf_counter()
+        try:
+            return handler(event, None)
+        except Exception:
+            with lock:
+                errors[intent_name] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies[intent_name].append(elapsed_ms)
+
+    def worker():
+        while True:
+            try:
+                session = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                session.run(invoke)
+            except Exception:
+                # the failed invocation is already counted, move on to the next session
+                pass
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    dialogs = [
+        session for session in sessions if isinstance(session, AppointmentSession)
+    ]
+    report = {
+        "threads": threads,
+        "elapsed_s": elapsed,
+        "appointment_dialogs": len(dialogs),
+        "appointments_booked": sum(session.booked for session in dialogs),
+        "intents": {},
+    }
+    all_samples = []
+    for intent_name in sorted(latencies):
+        samples = latencies[intent_name]
+        all_samples.extend(samples)
+        report["intents"][intent_name] = summarize(
+            samples, errors[intent_name], elapsed
+        )
+    if all_samples:
+        report["intents"]["ALL"] = summarize(all_samples, sum(errors.values()), elapsed)
+    return report
+
+
+def summarize(samples, error_count, elapsed):
+    return {
+        "invocations": len(samples),
+        "errors": error_count,
+        "per_second": len(samples) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(samples, 50),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+    }
+
+
+def print_report(report):
+    print("{} threads, {:.2f} s".format(report["threads"], report["elapsed_s"]))
+    print(
+        "{} of {} MakeAppointment dialogs booked an appointment".format(
+            report["appointments_booked"], report["appointment_dialogs"]
+        )
+    )
+    print(
+        "{:<20} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "intent", "calls", "errors", "calls/s", "p50 ms", "p95 ms", "p99 ms"
+        )
+    )
+    for intent_name, stats in report["intents"].items():
+        print(
+            "{:<20} {:>8} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                intent_name,
+                stats["invocations"],
+                stats["errors"],
+                stats["per_second"],
+                stats["p50_ms"],
+                stats["p95_ms"],
+                stats["p99_ms"],
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument(
+        "--sessions", type=int, default=500, help="number of generated conversations"
+    )
+    parser.add_argument("--replay", help="JSON lines file of recorded Lex events")
+    parser.add_argument("--kendra-latency-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--kendra-jitter-ms",
+        type=float,
+        default=0.0,
+        help="random extra Kendra latency, uniform between 0 and this value",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print a JSON report")
+    args = parser.parse_args()
+
+    # configure the Lambda before its modules read the environment at import
+    booking_dir = tempfile.mkdtemp(prefix="load-test-")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("KENDRA_INDEX", "00000000-0000-0000-0000-000000000000")
+    os.environ.setdefault("id", "join load-test")
+    os.environ.setdefault("FAQ_PATH", FAQ_DIR)
+    os.environ["BOOKING_STORE"] = "sqlite:" + os.path.join(booking_dir, "bookings.db")
+    sys.path[:0] = [LAMBDA_DIR, SHARED_DIR]
+    handler_module = importlib.import_module("lambda")
+    aws_clients = importlib.import_module("aws_clients")
+
+    if args.replay:
+        sessions = read_replay_sessions(args.replay)
+    else:
+        sessions = generate_sessions(args.sessions, args.seed)
+    stub_kendra(
+        aws_clients,
+        kendra_call_budget(sessions),
+        args.kendra_latency_ms,
+        args.kendra_jitter_ms,
+        args.seed,
+    )
+
+    # the handler prints to stdout, keep it out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = run(sessions, handler_module.lambda_handler, args.threads)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
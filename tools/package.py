@@ -0,0 +1,114 @@
+"""
+Builds the deployment packages the CloudFormation template loads from S3.
+
+Writes, next to their sources:
+  - assets/lex-appointment-handler-it/lex-appointment-handler.zip (fulfillment Lambda)
+  - assets/twilio-webhook-lambda/twilio-webhook-lambda.zip (webhook Lambda)
+  - assets/lex_custom_resource/lex_custom_resource.zip (Lex custom resource)
+  - assets/shared_layer/shared_layer.zip (Lambda layer with the modules both Lambda
+    functions use, under python/ as the Python runtime expects, and the FAQ CSV files
+    of assets/faq under python/faq/ for the local FAQ index)
+
+Entries get a fixed timestamp, so unchanged sources give identical zips.
+
+Usage:
+    python tools/package.py [--check]
+"""
+
+import argparse
+import glob
+import io
+import os
+import sys
+import zipfile
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets")
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+
+# (zip file, source directory, glob patterns relative to the source directory,
+#  (directory under assets, glob pattern, directory in the zip) for files from elsewhere)
+PACKAGES = [
+    (
+        "lex-appointment-handler-it/lex-appointment-handler.zip",
+        "lex-appointment-handler-it",
+        ["*.py"],
+        [],
+    ),
+    (
+        "twilio-webhook-lambda/twilio-webhook-lambda.zip",
+        "twilio-webhook-lambda",
+        ["*.py"],
+        [],
+    ),
+    (
+        "lex_custom_resource/lex_custom_resource.zip",
+        "lex_custom_resource",
+        ["*.py"],
+        [],
+    ),
+    (
+        "shared_layer/shared_layer.zip",
+        "shared_layer",
+        ["python/*.py"],
+        [("faq", "*.csv", "python/faq")],
+    ),
+]
+
+
+def build(source_dir, patterns, extra_files=()):
+    """
+    Returns the bytes of a zip with the files matching the patterns and the extra files,
+    in sorted order of their names in the zip.
+    """
+    entries = [
+        (os.path.relpath(path, source_dir), path)
+        for pattern in patterns
+        for path in glob.glob(os.path.join(source_dir, pattern))
+    ]
+    entries += [
+        (os.path.join(zip_dir, os.path.basename(path)), path)
+        for extra_dir, pattern, zip_dir in extra_files
+        for path in glob.glob(os.path.join(ASSETS_DIR, extra_dir, pattern))
+    ]
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, path in sorted(entries):
+            info = zipfile.ZipInfo(name.replace(os.sep, "/"), ZIP_TIMESTAMP)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(path, "rb") as source:
+                archive.writestr(info, source.read())
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only report packages that are out of date, exit with status 1 if any",
+    )
+    args = parser.parse_args()
+
+    stale = []
+    for zip_name, source_name, patterns, extra_files in PACKAGES:
+        zip_path = os.path.join(ASSETS_DIR, zip_name)
+        content = build(os.path.join(ASSETS_DIR, source_name), patterns, extra_files)
+        try:
+            with open(zip_path, "rb") as existing:
+                up_to_date = existing.read() == content
+        except OSError:
+            up_to_date = False
+        if up_to_date:
+            continue
+        stale.append(zip_name)
+        if not args.check:
+            with open(zip_path, "wb") as output:
+                output.write(content)
+        print("{} {}".format("stale" if args.check else "built", zip_name))
+    if args.check and stale:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()